@@ -0,0 +1,106 @@
+import timeit
+
+from bs4 import BeautifulSoup, NavigableString
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from pybb.models import Post
+from mainpage.templatetags import wl_markdown
+
+
+# The smiley substitution before SMILEY_RE, as reference. It loops over all
+# SMILEYS for each text and word.
+def _old_find_smiley_Strings(bs4_string):
+    if bs4_string.parent.name.lower() == 'code':
+        return False
+    for sc in settings.SMILEYS:
+        if sc[0] in bs4_string:
+            return True
+    return False
+
+
+def _old_insert_smileys(text):
+    tmp_content = []
+    for content in text.parent.contents:
+        try:
+            words = content.split(' ')
+        except:
+            tmp_content.append(content)
+            continue
+
+        for i, word in enumerate(words):
+            smiley = ''
+            for sc, img in settings.SMILEYS:
+                if word == sc:
+                    smiley = img
+            if smiley:
+                img_tag = BeautifulSoup(features='lxml').new_tag('img')
+                img_tag['src'] = '{}{}'.format(settings.SMILEY_DIR, smiley)
+                img_tag['alt'] = smiley
+                tmp_content.append(img_tag)
+                tmp_content.append(NavigableString(' '))
+            else:
+                if i < (len(words) - 1):
+                    word = word + ' '
+                tmp_content.append(NavigableString(word))
+
+    text.parent.contents = tmp_content
+
+
+class Command(BaseCommand):
+    help = 'Measure the time needed to render the markup of recent forum posts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=1000,
+                            help='Number of recent markdown posts to render')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Take the best of this many runs')
+
+    def handle(self, *args, **options):
+        bodies = list(Post.objects.filter(markup='markdown').order_by(
+            '-created').values_list('body', flat=True)[:options['posts']])
+        if not bodies:
+            self.stdout.write('No posts found')
+            return
+
+        # Parsed html of each post, like it is used for inserting smileys
+        htmls = [wl_markdown.markdown(body, extensions=wl_markdown.md_extensions)
+                 for body in bodies]
+
+        def smileys():
+            for html in htmls:
+                soup = BeautifulSoup(html, features='lxml')
+                for text in soup.find_all(string=wl_markdown.find_smiley_Strings):
+                    wl_markdown._insert_smileys(text, soup)
+
+        def old_smileys():
+            for html in htmls:
+                soup = BeautifulSoup(html, features='lxml')
+                for text in soup.find_all(string=_old_find_smiley_Strings):
+                    _old_insert_smileys(text)
+
+        def parse_only():
+            for html in htmls:
+                BeautifulSoup(html, features='lxml')
+
+        def render():
+            for body in bodies:
+                wl_markdown._render_wl_markdown(body, True, True)
+
+        def best(func):
+            return min(timeit.repeat(func, number=1, repeat=options['repeat']))
+
+        parse_time = best(parse_only)
+        old_smiley_time = best(old_smileys) - parse_time
+        smiley_time = best(smileys) - parse_time
+        render_time = best(render)
+
+        self.stdout.write('Rendered {} posts'.format(len(bodies)))
+        for name, seconds in (('Old smileys', old_smiley_time),
+                              ('Smiley substitution', smiley_time),
+                              ('Full rendering', render_time)):
+            self.stdout.write('{:<20} {:8.1f} ms total, {:6.3f} ms per post'.format(
+                name, seconds * 1000, seconds * 1000 / len(bodies)))
+        if smiley_time > 0:
+            self.stdout.write('Smileys are {:.1f}x faster than before'.format(
+                old_smiley_time / smiley_time))
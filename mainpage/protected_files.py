@@ -0,0 +1,172 @@
+"""Sending files which are not served as static media, like map files and
+forum attachments.
+
+Files are sent in chunks, or by the web server if SENDFILE_BACKEND is
+set:
+
+None: Send the files with Django.
+'xsendfile': Apache with mod_xsendfile, the X-Sendfile header contains
+    the path of the file.
+'nginx': The X-Accel-Redirect header contains SENDFILE_URL followed by
+    the path of the file relative to MEDIA_ROOT. SENDFILE_URL has to be an
+    internal location of nginx pointing to MEDIA_ROOT.
+
+Conditional requests (ETag, Last-Modified) and single byte ranges are
+supported. If the web server sends the file, it handles byte ranges
+itself.
+
+"""
+
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, \
+    HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+
+
+class _FileRange(object):
+    """File like object returning length bytes of file, starting at
+    start."""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _parse_range(header, size):
+    """Returns (start, end) of a single range 'bytes=start-end', None for
+    other or invalid ranges."""
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start == '':
+        # The last bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start > end:
+        return None
+    return start, end
+
+
+def _not_modified(request, etag, mtime):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        # Weak comparison, the browser may have marked the tag as weak
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in [
+            tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and if_modified_since >= mtime
+
+
+def _range_valid(request, etag, mtime):
+    """Whether the Range of the request may be applied, checking If-Range.
+    It contains either an ETag, which has to match strongly, or the date
+    of Last-Modified."""
+    if_range = request.META.get('HTTP_IF_RANGE', '').strip()
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == mtime
+
+
+def _sendfile_response(path, content_type):
+    backend = getattr(settings, 'SENDFILE_BACKEND', None)
+    if not backend:
+        return None
+    response = HttpResponse(content_type=content_type)
+    if backend == 'nginx':
+        response['X-Accel-Redirect'] = settings.SENDFILE_URL + \
+            os.path.relpath(path, settings.MEDIA_ROOT)
+    else:
+        response['X-Sendfile'] = path
+    return response
+
+
+def serve_file(request, path, content_type='application/octet-stream',
+               filename=None, etag=None, max_age=None):
+    """Returns a response sending the file at path.
+
+    filename: Name of the file for downloading, None to show the file in
+        the browser.
+    etag: Identifies this version of the file, defaults to one built from
+        size and modification time. Without quotes.
+    max_age: Seconds the file may be cached privately by the browser.
+
+    Raises Http404 if the file doesn't exist.
+
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise Http404('The file does not exist')
+    mtime = int(stat.st_mtime)
+    etag = '"%s"' % (etag or '%x-%x' % (mtime, stat.st_size))
+
+    if _not_modified(request, etag, mtime):
+        response = HttpResponseNotModified()
+    else:
+        response = _sendfile_response(path, content_type)
+    if response is None:
+        byte_range = None
+        if 'HTTP_RANGE' in request.META and \
+                _range_valid(request, etag, mtime):
+            byte_range = _parse_range(request.META['HTTP_RANGE'], stat.st_size)
+
+        file = open(path, 'rb')
+        if byte_range is None:
+            response = FileResponse(file, content_type=content_type)
+            response['Content-Length'] = stat.st_size
+        else:
+            start, end = byte_range
+            response = FileResponse(
+                _FileRange(file, start, end - start + 1),
+                content_type=content_type, status=206)
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, end, stat.st_size)
+        response['Accept-Ranges'] = 'bytes'
+
+    if filename is not None and response.status_code != 304:
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(mtime)
+    if max_age is not None:
+        patch_cache_control(response, private=True, max_age=max_age)
+    return response
+
+
+def is_complete_download(request, response):
+    """Whether response sends the whole file or its beginning. Requests
+    for the rest of an interrupted download are not complete."""
+    if request.method != 'GET':
+        return False
+    if response.status_code == 206:
+        return response['Content-Range'].startswith('bytes 0-')
+    if response.status_code != 200:
+        return False
+    if response.has_header('X-Sendfile') or \
+            response.has_header('X-Accel-Redirect'):
+        # The web server handles the range of the request
+        byte_range = request.META.get('HTTP_RANGE', '').strip()
+        return not byte_range or byte_range.startswith('bytes=0-')
+    return True
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.db import connections
+from django.utils.deprecation import MiddlewareMixin
+
+
+class QueryCountMiddleware(MiddlewareMixin):
+    """Adds the number of database queries of a request as response header.
+
+    Django records queries only if DEBUG is True, so the header
+    'X-Query-Count' is only set in this case. This helps to check that
+    the costs of a page do not grow with the amount of shown objects.
+
+    """
+
+    def process_response(self, request, response):
+        if settings.DEBUG:
+            response['X-Query-Count'] = sum(
+                len(connection.queries) for connection in connections.all())
+        return response
@@ -134,6 +134,9 @@ MIDDLEWARE = [
     # Foreign middleware
     'dj_pagination.middleware.PaginationMiddleware',
     'mainpage.online_users_middleware.OnlineNowMiddleware',
+
+    # Adds the header 'X-Query-Count' if DEBUG is True
+    'mainpage.query_count_middleware.QueryCountMiddleware',
 ]
 
 TEMPLATES = [
@@ -288,6 +291,12 @@ SMILEYS = [
     (';)', 'face-wink.png'),
 ]
 
+# Rendered markup is cached, see mainpage.templatetags.wl_markdown
+# Number of entries cached per process
+WL_MARKDOWN_CACHE_SIZE = 500
+# Seconds an entry is kept in the Django cache
+WL_MARKDOWN_CACHE_TIMEOUT = 60 * 60 * 24
+
 #################
 # Search Config #
 #################
@@ -315,6 +324,28 @@ THUMBNAIL_SIZE = (160, 160)
 # Maps #
 ########
 MAPS_PER_PAGE = 10
+# Seconds the numbers of maps per filter value are cached. They are
+# cleared if a map gets published or deleted.
+MAPS_FACETS_CACHE_TIMEOUT = 60 * 60 * 24
+# Uploaded maps are processed by the management command
+# process_map_uploads, see wlmaps/uploads.py
+MAPS_WL_MAP_INFO = 'wl_map_info'
+# Number of wl_map_info processes running at the same time
+MAPS_UPLOAD_WORKERS = 2
+# Seconds after which wl_map_info is killed
+MAPS_UPLOAD_TIMEOUT = 60
+# Number of uploads of a user which may wait for processing
+MAPS_MAX_PENDING_UPLOADS = 3
+
+#################################
+# Map files and forum attachments #
+#################################
+# Let the web server send these files: None to send them with Django,
+# 'xsendfile' for Apache with mod_xsendfile (X-Sendfile header) or 'nginx'
+# (X-Accel-Redirect header). For nginx, SENDFILE_URL has to be an internal
+# location pointing to MEDIA_ROOT. See mainpage/protected_files.py
+SENDFILE_BACKEND = None
+SENDFILE_URL = '/protected/'
 
 ##############################################
 ## Recipient(s) who get an email if someone ##
@@ -390,7 +421,7 @@ STAR_RATINGS_RANGE = 10
 # Set a cache #
 ###############
 # See https://docs.djangoproject.com/en/1.11/topics/cache/
-# The cache is used for 'Online users' and the wiki edit lock
+# The cache is used for 'Online users', the wiki edit lock and rendered markup
 
 CACHES = {
     'default': {
@@ -402,10 +433,11 @@ CACHES = {
 #########################
 # Notification settings #
 #########################
-# When set to True, one has to run ./manage.py emit_notices
-# for sending emails
+# Notices are queued and sent by './manage.py emit_notices', which has to
+# run periodically, e.g. every minute by cron. Set this to False to send
+# the emails during the request instead.
 
-NOTIFICATION_QUEUE_ALL = False
+NOTIFICATION_QUEUE_ALL = True
 
 
 try:
@@ -9,8 +9,16 @@
 # Last Modified: $Date$
 #
 
+from collections import OrderedDict
+import hashlib
+import time
+import uuid
+
 from django import template
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import signals
 from django.utils.encoding import smart_bytes, force_text
 from django.utils.safestring import mark_safe
 from django.conf import settings
@@ -56,50 +64,117 @@ except ImportError:
 register = template.Library()
 
 
-def _insert_smileys(text):
-    """This searches for smiley symbols in the current text and replaces them
-    with the correct images.
+# All smileys get replaced in one pass with this regular expression. A
+# smiley has to be a whole word, i.e. surrounded by spaces or at the start
+# or end of the text. Longer smileys are tried first.
+SMILEY_IMAGES = dict(settings.SMILEYS)
+SMILEY_RE = re.compile(r'(?<![^ ])({})(?![^ ])'.format('|'.join(
+    re.escape(sc) for sc in sorted(SMILEY_IMAGES, key=len, reverse=True))))
+
+
+def _insert_smileys(text, soup):
+    """This replaces smiley symbols in the current text with the correct
+    images.
+
+    text: a bs4 string containing at least one smiley
+    soup: the soup of text, used to create the img tags
+    """
+
+    parts = SMILEY_RE.split(text)
+    # Every second part is a smiley
+    for i, part in enumerate(parts):
+        if i % 2:
+            smiley = SMILEY_IMAGES[part]
+            img_tag = soup.new_tag('img')
+            img_tag['src'] = '{}{}'.format(settings.SMILEY_DIR, smiley)
+            img_tag['alt'] = smiley
+            text.insert_before(img_tag)
+        elif part:
+            text.insert_before(NavigableString(part))
+    text.extract()
+
+
+# Names after /wiki/ which are no articles
+WIKI_SPECIAL_PAGES = ['list', 'search', 'history', 'feeds', 'observe', 'edit',
+                      'wanted']
+
+
+def _wiki_article_name(href):
+    """Return the article name of a link to /wiki/PageName[/additional/stuff]
+
+    Using the unchanged href because we need cAsEs here.
+    """
+
+    return urllib.parse.unquote(href[6:].split('/', 1)[0])
+
+
+# Process wide index of already resolved wiki links. Resolved names are
+# kept until the wikilinks version changes, which happens if an Article
+# gets created, renamed or deleted.
+WIKI_LINK_INDEX_SIZE = 10000
+_wiki_link_index = {'version': None, 'links': {}}
+
 
-    Contents get splitted into words and after this the whole contents must be
-    reassembled.
+def _resolve_wiki_links(article_names):
+    """Resolve the given article names with two queries at most.
+
+    Returns a dict which maps each name to one of:
+    ('redirect', actual title), ('exists', None) or ('missing', None)
     """
 
-    tmp_content = []
-    for content in text.parent.contents:
-        try:
-            # If this fails, content is probably '\n' or not a string, e.g.  <br />
-            words = content.split(' ')
-        except:
-            # apply the unsplittable content and continue
-            tmp_content.append(content)
-            continue
-
-        for i, word in enumerate(words):
-            smiley = ''
-            for sc, img in settings.SMILEYS:
-                if word == sc:
-                    smiley = img
-            if smiley:
-                img_tag = BeautifulSoup(features='lxml').new_tag('img')
-                img_tag['src'] = '{}{}'.format(settings.SMILEY_DIR, smiley)
-                img_tag['alt'] = smiley
-                tmp_content.append(img_tag)
-                # apply a space after the smiley
-                tmp_content.append(NavigableString(' '))
+    version = _wikilinks_version()
+    if _wiki_link_index['version'] != version or \
+            len(_wiki_link_index['links']) > WIKI_LINK_INDEX_SIZE:
+        _wiki_link_index['version'] = version
+        _wiki_link_index['links'] = {}
+    links = _wiki_link_index['links']
+
+    unknown = set(article_names) - set(links)
+    if unknown:
+        # Titles are compared case insensitive by our database (MySQL), so
+        # compare them also case insensitive if there is no exact match.
+        def _lookup(mapping, name):
+            try:
+                return mapping[name]
+            except KeyError:
+                return mapping.get(name.lower())
+
+        # Check for redirects. ChangeSets are ordered by descending
+        # revision, so keep only the first found for each old title.
+        redirects = {}
+        for old_title, title in ChangeSet.objects.filter(
+                old_title__in=unknown).values_list('old_title', 'article__title'):
+            redirects.setdefault(old_title, title)
+            redirects.setdefault(old_title.lower(), title)
+
+        titles = {}
+        for title in Article.objects.filter(
+                title__in=unknown).values_list('title', flat=True):
+            titles[title] = title
+            titles.setdefault(title.lower(), title)
+
+        for name in unknown:
+            act_t = _lookup(redirects, name)
+            if act_t is not None:
+                if name != act_t:
+                    links[name] = ('redirect', act_t)
+                else:
+                    links[name] = ('exists', None)
+            elif _lookup(titles, name) is not None:
+                links[name] = ('exists', None)
             else:
-                if i < (len(words) - 1):
-                    # Apply a space after each word, except the last word
-                    word = word + ' '
-                tmp_content.append(NavigableString(word))
+                links[name] = ('missing', None)
 
-    text.parent.contents = tmp_content
+    return {name: links[name] for name in article_names}
 
 
-def _classify_link(tag):
+def _classify_link(tag, wiki_links=None):
     """Applies a classname if this link is in any way special
     (external or missing wikipages)
 
     tag: classify for this tag
+    wiki_links: resolved wiki links as returned by _resolve_wiki_links().
+                Missing links are resolved on demand.
 
     """
 
@@ -137,8 +212,7 @@ def _classify_link(tag):
     if check_for_missing_wikipages and href.startswith('/wiki/'):
 
         # Check for missing wikilink /wiki/PageName[/additionl/stuff]
-        # Using href because we need cAsEs here
-        article_name = urllib.parse.unquote(tag['href'][6:].split('/', 1)[0])
+        article_name = _wiki_article_name(tag['href'])
 
         if not len(article_name):  # Wiki root link is not a page
             tag['class'] = 'wrongLink'
@@ -146,43 +220,36 @@ def _classify_link(tag):
             return
 
         # Wiki special pages are also not counted
-        if article_name in ['list', 'search', 'history', 'feeds', 'observe', 'edit']:
+        if article_name in WIKI_SPECIAL_PAGES:
             tag['class'] = 'specialLink'
             return
 
+        if wiki_links is None or article_name not in wiki_links:
+            wiki_links = _resolve_wiki_links([article_name])
+        state, act_t = wiki_links[article_name]
+
         # Check for a redirect
-        try:
-            # try to get the article id; if this fails an IndexError is raised
-            a_id = ChangeSet.objects.filter(
-                old_title=article_name).values_list('article_id')[0]
-
-            # get actual title of article
-            act_t = Article.objects.get(id=a_id[0]).title
-            if article_name != act_t:
-                tag['title'] = 'This is a redirect and points to \"' + act_t + '\"'
-                return
-            else:
-                return
-        except IndexError:
-            pass
+        if state == 'redirect':
+            tag['title'] = 'This is a redirect and points to \"' + act_t + '\"'
+            return
 
         # article missing (or misspelled)
-        if Article.objects.filter(title=article_name).count() == 0:
+        if state == 'missing':
             tag['class'] = 'missingLink'
             tag['title'] = 'This Link is misspelled or missing. Click to create it anyway.'
             return
     return
 
 
-def _make_clickable_images(tag):
+def _make_clickable_images(tag, soup):
     # is external link?
     if tag['src'].startswith('http'):
         # Do not change if it is already a link
         if tag.parent.name != 'a':
             # add link to image
-            new_link = BeautifulSoup(features='lxml').new_tag('a')
+            new_link = soup.new_tag('a')
             new_link['href'] = tag['src']
-            new_img = BeautifulSoup(features='lxml').new_tag('img')
+            new_img = soup.new_tag('img')
             new_img['src'] = tag['src']
             try:
                 new_img['alt'] = tag['alt']
@@ -197,31 +264,72 @@ def find_smiley_Strings(bs4_string):
     """Find strings that contain a smiley symbol.
 
     Don't find a smiley in code tags.
-    Attention: This returns also True for ':/' in 'http://'. This get
-    fixed in _insert_smileys().
     """
 
     if bs4_string.parent.name.lower() == 'code':
         return False
 
-    for sc in settings.SMILEYS:
-        if sc[0] in bs4_string:
-            return True
+    return SMILEY_RE.search(bs4_string) is not None
+
+
+PLAIN_LINK_RE = re.compile(r'(http[s]?:\/\/[-a-zA-Z0-9@:%._\+~#=/?]+)')
+
+
+def exclude_code_tag(bs4_string):
+    if bs4_string.parent.name == 'code':
+        return False
+    m = PLAIN_LINK_RE.search(bs4_string)
+    if m:
+        return True
     return False
 
 
+def urlize_soup(soup):
+    """Urlize plain text links in the soup.
+
+    Do not urlize content of CODE tags.
+    """
+
+    for found_string in soup.find_all(string=exclude_code_tag):
+        new_content = []
+        strings_or_tags = found_string.parent.contents
+        for string_or_tag in strings_or_tags:
+            try:
+                for string in PLAIN_LINK_RE.split(string_or_tag):
+                    if string.startswith('http'):
+                        # Apply an a-Tag
+                        tag = soup.new_tag('a')
+                        tag['href'] = string
+                        tag.string = string
+                        tag['nofollow'] = 'true'
+                        new_content.append(tag)
+                    else:
+                        # This is just a string, apply a bs4-string
+                        new_content.append(NavigableString(string))
+            except:
+                # Regex failed, so apply what ever it is
+                new_content.append(string_or_tag)
+
+        # Apply the new content
+        found_string.parent.contents = new_content
+
+
 # Predefine the markdown extensions here to have a clean code in
 # do_wl_markdown()
 md_extensions = ['extra', 'toc', SemanticWikiLinkExtension()]
 
-def do_wl_markdown(value, *args, **keyw):
-    """Apply wl specific things, like smileys or colored links."""
 
-    beautify = keyw.pop('beautify', True)
+def _render_wl_markdown(value, bleachit, beautify, urlize=False):
+    """Render markdown and apply smileys, link classes and plain links.
+
+    All steps after rendering the markdown work on the same parsed tree,
+    so the html gets parsed and serialized only once.
+    """
+
     html = markdown(value, extensions=md_extensions)
 
     # Sanitize posts from potencial untrusted users (Forum/Wiki/Maps)
-    if 'bleachit' in args:
+    if bleachit:
         html = mark_safe(bleach.clean(
             html, tags=settings.BLEACH_ALLOWED_TAGS, attributes=settings.BLEACH_ALLOWED_ATTRIBUTES))
 
@@ -238,20 +346,152 @@ def do_wl_markdown(value, *args, **keyw):
         # Insert smileys
         smiley_text = soup.find_all(string=find_smiley_Strings)
         for text in smiley_text:
-            _insert_smileys(text)
-
-        # Classify links
-        for tag in soup.find_all('a'):
-            _classify_link(tag)
+            _insert_smileys(text, soup)
+
+        # Classify links. Links to wiki pages get resolved all at once.
+        links = soup.find_all('a')
+        wiki_links = None
+        if check_for_missing_wikipages:
+            names = set(
+                _wiki_article_name(tag['href']) for tag in links
+                if tag.get('href', '').lower().startswith('/wiki/'))
+            wiki_links = _resolve_wiki_links(
+                [name for name in names if name and name not in WIKI_SPECIAL_PAGES])
+        for tag in links:
+            _classify_link(tag, wiki_links)
 
         # All external images gets clickable
         # This applies only in forum
         for tag in soup.find_all('img'):
-            _make_clickable_images(tag)
+            _make_clickable_images(tag, soup)
+
+    if urlize:
+        # Plain links are not classified, so apply them at last
+        urlize_soup(soup)
 
     return str(soup)
 
 
+# Render cache
+# ============
+# Rendered markup is cached in a small in-process LRU and in Django's cache.
+# The key contains the hash of the source and everything else the result
+# depends on. Wiki links are classified by looking up Articles, so a version
+# stored in Django's cache is part of the key and gets replaced whenever an
+# Article is created, renamed or deleted. Each process reads this version at
+# most every WIKILINKS_VERSION_TTL seconds, so renders found in the LRU
+# don't need the cache backend.
+
+# Increase this if the rendering itself changes
+RENDER_CACHE_VERSION = 2
+RENDER_CACHE_SIZE = getattr(settings, 'WL_MARKDOWN_CACHE_SIZE', 500)
+RENDER_CACHE_TIMEOUT = getattr(settings, 'WL_MARKDOWN_CACHE_TIMEOUT', 60 * 60 * 24)
+WIKILINKS_VERSION_KEY = 'wl_markdown_wikilinks_version'
+WIKILINKS_VERSION_TTL = getattr(settings, 'WL_MARKDOWN_WIKILINKS_VERSION_TTL', 5)
+
+SMILEYS_VERSION = hashlib.sha1(
+    repr((settings.SMILEY_DIR, settings.SMILEYS)).encode('utf-8')).hexdigest()[:8]
+
+_render_cache = OrderedDict()
+# (version, time until it is valid) of this process
+_wikilinks = (None, 0)
+
+
+def _wikilinks_version():
+    global _wikilinks
+    version, expires = _wikilinks
+    now = time.time()
+    if now < expires:
+        return version
+
+    version = cache.get(WIKILINKS_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(WIKILINKS_VERSION_KEY, version, None):
+            # Another process was faster
+            version = cache.get(WIKILINKS_VERSION_KEY, version)
+    _wikilinks = (version, now + WIKILINKS_VERSION_TTL)
+    return version
+
+
+def _new_wikilinks_version():
+    global _wikilinks
+    cache.set(WIKILINKS_VERSION_KEY, uuid.uuid4().hex, None)
+    # This process uses the new version right away
+    _wikilinks = (None, 0)
+
+
+def invalidate_wikilinks(*args, **kwargs):
+    """Invalidate rendered markup which may contain classified wiki links.
+
+    The version is replaced again after the commit, because other requests
+    may have rendered the old state with the new version meanwhile.
+    """
+    _new_wikilinks_version()
+    transaction.on_commit(_new_wikilinks_version)
+
+
+def _render_cache_key(value, bleachit, beautify, urlize):
+    source_hash = hashlib.sha1(value.encode('utf-8')).hexdigest()
+    return 'wl_markdown:{}:{}:{}:{}:{}:{}:{}'.format(
+        RENDER_CACHE_VERSION, source_hash, int(bleachit), int(beautify),
+        int(urlize), SMILEYS_VERSION, _wikilinks_version() if beautify else 0)
+
+
+def do_wl_markdown(value, *args, **keyw):
+    """Apply wl specific things, like smileys or colored links.
+
+    If the keyword 'urlize' is True, plain text links are converted
+    into links too. Set 'use_cache' to False for content which gets
+    rendered only once, e.g. when rendering many posts in bulk.
+    """
+
+    beautify = keyw.pop('beautify', True)
+    urlize = keyw.pop('urlize', False)
+    use_cache = keyw.pop('use_cache', True)
+    bleachit = 'bleachit' in args
+
+    if not use_cache:
+        return _render_wl_markdown(value, bleachit, beautify, urlize)
+
+    key = _render_cache_key(force_text(value), bleachit, beautify, urlize)
+    try:
+        html = _render_cache.pop(key)
+    except KeyError:
+        html = cache.get(key)
+        if html is None:
+            html = _render_wl_markdown(value, bleachit, beautify, urlize)
+            cache.set(key, html, RENDER_CACHE_TIMEOUT)
+
+    # Most recently used entries are kept at the end
+    _render_cache[key] = html
+    while len(_render_cache) > RENDER_CACHE_SIZE:
+        _render_cache.popitem(last=False)
+
+    return html
+
+
+if check_for_missing_wikipages:
+
+    def _changeset_post_save(sender, instance, created, **kwargs):
+        # A new old_title may turn a missing link into a redirect
+        if created and instance.old_title != instance.article.title:
+            invalidate_wikilinks()
+
+    def _article_pre_save(sender, instance, **kwargs):
+        instance._title_changed = instance.pk is None or not Article.objects.filter(
+            pk=instance.pk, title=instance.title).exists()
+
+    def _article_post_save(sender, instance, **kwargs):
+        if getattr(instance, '_title_changed', True):
+            invalidate_wikilinks()
+
+    signals.pre_save.connect(_article_pre_save, sender=Article)
+    signals.post_save.connect(_article_post_save, sender=Article)
+    signals.post_delete.connect(invalidate_wikilinks, sender=Article)
+    signals.post_save.connect(_changeset_post_save, sender=ChangeSet)
+
+
 @register.filter
 def wl_markdown(content, arg=''):
     """A Filter which decides when to 'bleach' the content."""
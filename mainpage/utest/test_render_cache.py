@@ -0,0 +1,87 @@
+from unittest import mock
+
+from django.test import TestCase as DBTestCase
+from django.core.cache import cache
+
+from wiki.models import Article
+from mainpage.templatetags import wl_markdown
+
+
+class TestWlMarkdownRenderCache(DBTestCase):
+
+    def setUp(self):
+        cache.clear()
+        wl_markdown._render_cache.clear()
+        wl_markdown._wikilinks = (None, 0)
+
+    def _render(self, *args, **kwargs):
+        with mock.patch.object(wl_markdown, '_render_wl_markdown',
+                               wraps=wl_markdown._render_wl_markdown) as render:
+            html = wl_markdown.do_wl_markdown(*args, **kwargs)
+        return html, render.call_count
+
+    def test_same_source__rendered_once(self):
+        html, calls = self._render('Hallo *Welt*', 'bleachit')
+        self.assertEqual(1, calls)
+        cached, calls = self._render('Hallo *Welt*', 'bleachit')
+        self.assertEqual(0, calls)
+        self.assertEqual(html, cached)
+
+    def test_django_cache__used_if_not_in_process(self):
+        html, calls = self._render('Hallo *Welt*')
+        wl_markdown._render_cache.clear()
+        cached, calls = self._render('Hallo *Welt*')
+        self.assertEqual(0, calls)
+        self.assertEqual(html, cached)
+
+    def test_flags__are_part_of_key(self):
+        self._render('Hallo :)')
+        html, calls = self._render('Hallo :)', beautify=False)
+        self.assertEqual(1, calls)
+        self.assertNotIn('<img', html)
+
+    def test_new_article__invalidates_wikilinks(self):
+        html, calls = self._render('[Link](/wiki/NewPage)')
+        self.assertIn('missingLink', html)
+        Article.objects.create(title='NewPage', content='')
+        html, calls = self._render('[Link](/wiki/NewPage)')
+        self.assertEqual(1, calls)
+        self.assertNotIn('missingLink', html)
+
+    def test_lru_hit__no_queries(self):
+        self._render('Hallo *Welt*')
+        with self.assertNumQueries(0):
+            html, calls = self._render('Hallo *Welt*')
+        self.assertEqual(0, calls)
+
+    def test_invalidate__new_version_without_timeout(self):
+        version = wl_markdown._wikilinks_version()
+        with mock.patch.object(wl_markdown.cache, 'set',
+                               wraps=wl_markdown.cache.set) as cache_set:
+            wl_markdown.invalidate_wikilinks()
+        self.assertIsNone(cache_set.call_args[0][2])
+        new_version = wl_markdown._wikilinks_version()
+        self.assertNotEqual(version, new_version)
+        wl_markdown.invalidate_wikilinks()
+        self.assertNotIn(wl_markdown._wikilinks_version(),
+                         (version, new_version))
+
+    def test_lru__evicts_oldest(self):
+        with mock.patch.object(wl_markdown, 'RENDER_CACHE_SIZE', 2):
+            for text in ('one', 'two', 'three'):
+                self._render(text)
+        self.assertEqual(2, len(wl_markdown._render_cache))
+
+    def test_urlize__parsed_once(self):
+        with mock.patch.object(wl_markdown, 'BeautifulSoup',
+                               wraps=wl_markdown.BeautifulSoup) as soup:
+            html, calls = self._render('See http://example.org', urlize=True)
+        self.assertEqual(1, soup.call_count)
+        self.assertIn('<a href="http://example.org" nofollow="true">', html)
+
+    def test_urlize__same_result_as_pybb_urlize(self):
+        from pybb.util import urlize
+        text = 'See http://example.org :) and `http://code.org`'
+        html, calls = self._render(text, 'bleachit')
+        merged, calls = self._render(text, 'bleachit', urlize=True)
+        self.assertEqual(urlize(html), merged)
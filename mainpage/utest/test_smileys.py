@@ -0,0 +1,33 @@
+from django.test import SimpleTestCase
+from bs4 import BeautifulSoup
+
+from mainpage.templatetags.wl_markdown import find_smiley_Strings, _insert_smileys
+
+
+class TestWlMarkdownSmileys(SimpleTestCase):
+
+    def _smileys(self, html):
+        soup = BeautifulSoup(html, features='lxml')
+        for text in soup.find_all(string=find_smiley_Strings):
+            _insert_smileys(text, soup)
+        return str(soup.body)[6:-7]
+
+    def test_single_smiley__replaced(self):
+        self.assertEqual(
+            '<p>Hi <img alt="face-smile.png" src="/static/img/smileys/face-smile.png"/> there</p>',
+            self._smileys('<p>Hi :) there</p>'))
+
+    def test_longest_smiley__wins(self):
+        self.assertIn('face-smile-big.png', self._smileys('<p>:-))</p>'))
+
+    def test_several_smileys__all_replaced(self):
+        html = self._smileys('<p>:) ;) :D</p>')
+        self.assertEqual(3, html.count('<img'))
+
+    def test_smiley_inside_word__ignored(self):
+        html = '<p>http://example.org and a:)b</p>'
+        self.assertEqual(html, self._smileys(html))
+
+    def test_smiley_in_code__ignored(self):
+        html = '<p><code>:)</code></p>'
+        self.assertEqual(html, self._smileys(html))
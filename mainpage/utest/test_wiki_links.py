@@ -0,0 +1,65 @@
+from django.test import TestCase as DBTestCase
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from wiki.models import Article
+from mainpage.templatetags import wl_markdown
+
+
+class TestWlMarkdownWikiLinks(DBTestCase):
+
+    def setUp(self):
+        cache.clear()
+        wl_markdown._render_cache.clear()
+        wl_markdown._wikilinks = (None, 0)
+        self.article = Article.objects.create(title='MainPage', content='')
+
+    def _render(self, text):
+        wl_markdown._render_cache.clear()
+        cache.clear()
+        return wl_markdown.do_wl_markdown(text)
+
+    def _count_queries(self, text):
+        wl_markdown._wiki_link_index['links'].clear()
+        wl_markdown._wikilinks_version()
+        with CaptureQueriesContext(connection) as queries:
+            html = wl_markdown._render_wl_markdown(text, False, True)
+        return len(queries), html
+
+    def test_many_links__constant_queries(self):
+        single, html = self._count_queries('[Page](/wiki/Page)')
+        many, html = self._count_queries(' '.join(
+            '[Page{0}](/wiki/Page{0})'.format(i) for i in range(50)))
+        self.assertEqual(single, many)
+        self.assertEqual(50, html.count('missingLink'))
+
+    def test_resolved_links__no_queries(self):
+        text = '[Main](/wiki/MainPage) [Other](/wiki/Other)'
+        self._count_queries(text)
+        with self.assertNumQueries(0):
+            wl_markdown._render_wl_markdown(text, False, True)
+
+    def test_existing_link__no_class(self):
+        html = self._render('[Main](/wiki/MainPage)')
+        self.assertNotIn('missingLink', html)
+
+    def test_redirect__title_applied(self):
+        self.article.new_revision(
+            old_content='', old_title='OldPage', old_markup='',
+            comment='', editor=None)
+        html = self._render('[Old](/wiki/OldPage) [Main](/wiki/MainPage)')
+        self.assertIn('points to "MainPage"', html)
+        self.assertNotIn('missingLink', html)
+
+    def test_special_pages__not_resolved(self):
+        html = self._render('[List](/wiki/list) [Root](/wiki/)')
+        self.assertIn('specialLink', html)
+        self.assertIn('wrongLink', html)
+
+    def test_rename__reclassifies_links(self):
+        self._render('[New](/wiki/NewTitle)')
+        self.article.title = 'NewTitle'
+        self.article.save()
+        html = self._render('[New](/wiki/NewTitle)')
+        self.assertNotIn('missingLink', html)
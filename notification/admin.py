@@ -1,5 +1,6 @@
 from django.contrib import admin
-from notification.models import NoticeType, NoticeSetting, ObservedItem
+from notification.models import NoticeType, NoticeSetting, ObservedItem, \
+    QueuedNotice, NoticeQueueEntry
 from django.utils.translation import ugettext_lazy as _
 
 
@@ -22,6 +23,27 @@ class ObserverdItemAdmin(admin.ModelAdmin):
             (_('Settings'), {'fields': ('added', 'notice_type', 'signal')}),
             )
 
+
+class NoticeQueueEntryInline(admin.TabularInline):
+    model = NoticeQueueEntry
+    raw_id_fields = ('user',)
+    readonly_fields = ('lease_id', 'lease_until')
+    extra = 0
+
+
+class QueuedNoticeAdmin(admin.ModelAdmin):
+    list_display = ('label', 'created', 'on_site')
+    inlines = [NoticeQueueEntryInline]
+
+
+class NoticeQueueEntryAdmin(admin.ModelAdmin):
+    search_fields = ['user__username', 'notice__label']
+    list_display = ('notice', 'user', 'status', 'attempts', 'lease_until')
+    list_filter = ('status',)
+    raw_id_fields = ('user', 'notice')
+
 admin.site.register(NoticeType, NoticeTypeAdmin)
 admin.site.register(NoticeSetting, NoticeSettingAdmin)
 admin.site.register(ObservedItem, ObserverdItemAdmin)
+admin.site.register(QueuedNotice, QueuedNoticeAdmin)
+admin.site.register(NoticeQueueEntry, NoticeQueueEntryAdmin)
@@ -1,67 +1,147 @@
-
 import sys
 import time
 import logging
 import traceback
-import base64
-
-try:
-    import pickle as pickle
-except ImportError:
-    import pickle
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from multiprocessing import Pool
 
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.mail import mail_admins
-from django.contrib.auth.models import User
+from django.db import connections
+from django.db.models import F, Q
 from django.contrib.sites.models import Site
 
-from .lockfile import FileLock, AlreadyLocked, LockTimeout
-
-from notification.models import NoticeQueueBatch
+from notification.models import QueuedNotice, NoticeQueueEntry
 from notification import models as notification
 
-# lock timeout value. how long to wait for the lock to become available.
-# default behavior is to never wait for the lock to be available.
-LOCK_WAIT_TIMEOUT = getattr(settings, 'NOTIFICATION_LOCK_WAIT_TIMEOUT', -1)
+# Number of processes sending notices in parallel
+WORKERS = getattr(settings, 'NOTIFICATION_WORKERS', 1)
+# How long claimed entries are reserved for a worker. Entries of a crashed
+# worker are sent by the next run after this time.
+LEASE_SECONDS = getattr(settings, 'NOTIFICATION_LEASE_SECONDS', 600)
+# Delay before a failed email is tried again
+RETRY_SECONDS = getattr(settings, 'NOTIFICATION_RETRY_SECONDS', 300)
+# Number of tries before an entry is marked as failed
+MAX_ATTEMPTS = getattr(settings, 'NOTIFICATION_MAX_ATTEMPTS', 3)
 
 
-def send_all():
-    lock = FileLock('send_notices')
+def _claimable():
+    return Q(status=NoticeQueueEntry.PENDING) & (
+        Q(lease_until__isnull=True) | Q(lease_until__lt=datetime.now()))
 
-    logging.debug('acquiring lock...')
-    try:
-        lock.acquire(LOCK_WAIT_TIMEOUT)
-    except AlreadyLocked:
-        logging.debug('lock already in place. quitting.')
-        return
-    except LockTimeout:
-        logging.debug('waiting for the lock timed out. quitting.')
-        return
-    logging.debug('acquired.')
-
-    batches, sent = 0, 0
+
+def claim(limit=None):
+    """Reserve up to limit pending entries for this worker.
+
+    The entries are claimed with a single UPDATE which checks again that
+    they are still claimable, so each entry is claimed by only one worker.
+    If another worker was faster, the next entries are tried.
+    Returns the claimed entries.
+
+    """
+    limit = limit or notification.BATCH_SIZE
+    while True:
+        candidates = list(NoticeQueueEntry.objects.filter(
+            _claimable()).order_by('id').values_list('id', flat=True)[:limit])
+        if not candidates:
+            return []
+
+        lease_id = uuid.uuid4().hex
+        claimed = NoticeQueueEntry.objects.filter(
+            _claimable(), id__in=candidates).update(
+            lease_id=lease_id,
+            lease_until=datetime.now() + timedelta(seconds=LEASE_SECONDS),
+            attempts=F('attempts') + 1)
+        if claimed:
+            return list(NoticeQueueEntry.objects.filter(
+                lease_id=lease_id).select_related('notice', 'user'))
+
+
+def _release(entries, **kwargs):
+    NoticeQueueEntry.objects.filter(
+        pk__in=[entry.pk for entry in entries],
+        lease_id__in=set(entry.lease_id for entry in entries)).update(
+        lease_id='', **kwargs)
+
+
+def _failed(entry, error):
+    if entry.attempts >= MAX_ATTEMPTS:
+        _release([entry], status=NoticeQueueEntry.FAILED,
+                 lease_until=None, last_error=error)
+    else:
+        _release([entry], lease_until=datetime.now() + timedelta(
+            seconds=RETRY_SECONDS), last_error=error)
+
+
+def deliver(entries):
+    """Send the notices of the claimed entries.
+
+    Entries are marked as sent right after their notice was sent, so a
+    recipient gets a notice only once. Recipients whose email failed
+    are tried again later.
+
+    """
+    by_notice = OrderedDict()
+    for entry in entries:
+        by_notice.setdefault(entry.notice, []).append(entry)
+
+    stats = notification.DeliveryStats()
+    for notice, notice_entries in by_notice.items():
+        try:
+            extra_context = notification.deserialize_context(notice.context)
+        except ObjectDoesNotExist as e:
+            # The notice is about a deleted object
+            _release(notice_entries, status=NoticeQueueEntry.FAILED,
+                     lease_until=None, last_error=repr(e))
+            continue
+
+        result = notification.send_now(
+            [entry.user for entry in notice_entries], notice.label,
+            extra_context, notice.on_site)
+        _release([entry for entry in notice_entries
+                  if entry.user_id not in result.failed],
+                 status=NoticeQueueEntry.SENT, lease_until=None)
+        for entry in notice_entries:
+            if entry.user_id in result.failed:
+                _failed(entry, result.failed[entry.user_id])
+        stats += result
+    return stats
+
+
+def drain(worker=0):
+    """Send queued notices until no entry can be claimed anymore. This runs
+    in the worker processes."""
+    stats = notification.DeliveryStats()
+    entries = claim()
+    while entries:
+        stats += deliver(entries)
+        entries = claim()
+    return stats
+
+
+def send_all():
+    stats = notification.DeliveryStats()
     start_time = time.time()
 
+    pool = None
+    if WORKERS > 1:
+        # Forked processes must not share the database connections
+        connections.close_all()
+        pool = Pool(WORKERS)
     try:
         # nesting the try statement to be Python 2.4
         try:
-            for queued_batch in NoticeQueueBatch.objects.all():
-                notices = pickle.loads(
-                    base64.b64decode(queued_batch.pickled_data)
-                    )
-                for user, label, extra_context, on_site in notices:
-                    user = User.objects.get(pk=user)
-                    # FrankU: commented, because not all users get e-mailed
-                    # and to supress useless logging
-                    # logging.info('emitting notice to %s' % user)
-
-                    # call this once per user to be atomic and allow for logging to
-                    # accurately show how long each takes.
-                    notification.send_now(
-                        [user], label, extra_context, on_site)
-                    sent += 1
-                queued_batch.delete()
-                batches += 1
+            if pool is None:
+                stats = drain()
+            else:
+                for result in pool.map(drain, range(WORKERS)):
+                    stats += result
+            # Failed entries are kept for inspection
+            QueuedNotice.objects.exclude(entries__status__in=[
+                NoticeQueueEntry.PENDING, NoticeQueueEntry.FAILED]).delete()
         except:
             # get the exception
             exc_class, e, t = sys.exc_info()
@@ -74,10 +154,13 @@ def send_all():
             # log it as critical
             logging.critical('an exception occurred: %r' % e)
     finally:
-        logging.debug('releasing lock...')
-        lock.release()
-        logging.debug('released.')
+        if pool is not None:
+            pool.close()
+            pool.join()
 
+    elapsed = time.time() - start_time
     logging.info('')
-    logging.info('%s batches, %s sent' % (batches, sent,))
-    logging.info('done in %.2f seconds' % (time.time() - start_time))
+    logging.info('%s' % (stats,))
+    logging.info('done in %.2f seconds (%.1f emails/s with %d workers)' % (
+        elapsed, stats.messages / elapsed if elapsed else 0.0, WORKERS))
+    return stats
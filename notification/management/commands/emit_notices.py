@@ -13,4 +13,6 @@ class Command(BaseCommand):
         # Franku: Uncomment for debugging purposes
         # logging.basicConfig(level=logging.DEBUG, format='%(message)s')
         logging.info('-' * 72)
-        send_all()
+        stats = send_all()
+        if stats is not None:
+            self.stdout.write(str(stats))
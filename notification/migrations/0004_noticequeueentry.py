@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+
+import base64
+import datetime
+import json
+import pickle
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def serialize_context(extra_context):
+    """Copy of notification.models.serialize_context() when this migration
+    was written."""
+    data = {}
+    for key, value in extra_context.items():
+        if isinstance(value, models.Model):
+            value = {'__model__': value._meta.label_lower, 'pk': value.pk}
+        data[key] = value
+    return json.dumps(data)
+
+
+def convert_batches(apps, schema_editor):
+    """Move the pickled notices into the new queue.
+
+    Batches which can't be unpickled anymore, e.g. because a referenced
+    object was deleted, are dropped.
+
+    """
+    NoticeQueueBatch = apps.get_model('notification', 'NoticeQueueBatch')
+    QueuedNotice = apps.get_model('notification', 'QueuedNotice')
+    NoticeQueueEntry = apps.get_model('notification', 'NoticeQueueEntry')
+
+    for batch in NoticeQueueBatch.objects.all():
+        try:
+            notices = pickle.loads(base64.b64decode(batch.pickled_data))
+        except Exception:
+            continue
+        # All notices of a batch were created by one call of queue()
+        users = []
+        for user, label, extra_context, on_site in notices:
+            if user not in users:
+                users.append(user)
+        try:
+            context = serialize_context(extra_context or {})
+        except TypeError:
+            continue
+        notice = QueuedNotice.objects.create(
+            label=label, context=context, on_site=on_site)
+        NoticeQueueEntry.objects.bulk_create(
+            NoticeQueueEntry(notice=notice, user_id=user) for user in users)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('notification', '0003_auto_20190409_0924'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedNotice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('label', models.CharField(max_length=40, verbose_name='label')),
+                ('context', models.TextField(verbose_name='context')),
+                ('on_site', models.BooleanField(default=True, verbose_name='on site')),
+                ('created', models.DateTimeField(default=datetime.datetime.now, verbose_name='created')),
+            ],
+            options={
+                'ordering': ['id'],
+                'verbose_name': 'queued notice',
+                'verbose_name_plural': 'queued notices',
+            },
+        ),
+        migrations.CreateModel(
+            name='NoticeQueueEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('sent', 'sent'), ('failed', 'failed')], default='pending', max_length=10, verbose_name='status')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('lease_id', models.CharField(blank=True, max_length=32, verbose_name='lease')),
+                ('lease_until', models.DateTimeField(blank=True, null=True, verbose_name='lease until')),
+                ('last_error', models.TextField(blank=True, verbose_name='last error')),
+                ('notice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='notification.QueuedNotice', verbose_name='notice')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'notice queue entry',
+                'verbose_name_plural': 'notice queue entries',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='noticequeueentry',
+            unique_together=set([('notice', 'user')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='noticequeueentry',
+            index_together=set([('status', 'lease_until')]),
+        ),
+        migrations.RunPython(convert_batches, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='NoticeQueueBatch',
+        ),
+    ]
@@ -1,12 +1,13 @@
 import datetime
-import base64
-
-try:
-    import pickle as pickle
-except ImportError:
-    import pickle
-
-from django.db import models
+import json
+import time
+from collections import OrderedDict
+
+from django.apps import apps
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
 from django.db.models.query import QuerySet
 from django.conf import settings
 from django.urls import reverse
@@ -30,7 +31,16 @@ if 'mailer' in settings.INSTALLED_APPS:
 else:
     from django.core.mail import send_mail
 
-QUEUE_ALL = getattr(settings, 'NOTIFICATION_QUEUE_ALL', False)
+# Queue all notices sent by send(), so the request doesn't wait for the
+# emails. They are sent by './manage.py emit_notices'.
+QUEUE_ALL = getattr(settings, 'NOTIFICATION_QUEUE_ALL', True)
+# Number of recipients whose settings are fetched and whose emails are sent
+# at once
+BATCH_SIZE = getattr(settings, 'NOTIFICATION_BATCH_SIZE', 100)
+# How long the settings of all users for a notice type are cached. The cache
+# is invalidated whenever a NoticeSetting changes.
+SETTINGS_TIMEOUT = getattr(settings, 'NOTIFICATION_SETTINGS_TIMEOUT', 60 * 60 * 24)
+SETTINGS_KEY = 'notification-settings-%d-%s'
 
 
 class LanguageStoreNotAvailable(Exception):
@@ -104,29 +114,121 @@ def get_notification_setting(user, notice_type, medium):
         return setting
 
 
+def get_settings_matrix(notice_type, medium):
+    """Returns a dictionary of user ids and the value of NoticeSetting.send
+    for all users having a NoticeSetting of notice_type and medium.
+
+    The dictionary is fetched in one query and cached.
+    """
+    key = SETTINGS_KEY % (notice_type.pk, medium)
+    matrix = cache.get(key)
+    if matrix is None:
+        matrix = dict(NoticeSetting.objects.filter(
+            notice_type=notice_type, medium=medium).values_list(
+            'user_id', 'send'))
+        cache.set(key, matrix, SETTINGS_TIMEOUT)
+    return matrix
+
+
+def invalidate_settings_matrix(sender, instance, **kwargs):
+    cache.delete(SETTINGS_KEY % (instance.notice_type_id, instance.medium))
+
+post_save.connect(invalidate_settings_matrix, sender=NoticeSetting)
+post_delete.connect(invalidate_settings_matrix, sender=NoticeSetting)
+
+
 def should_send(user, notice_type, medium):
-    return get_notification_setting(user, notice_type, medium).send
+    matrix = get_settings_matrix(notice_type, medium)
+    if user.pk in matrix:
+        return matrix[user.pk]
+    return NOTICE_MEDIA_DEFAULTS[medium] <= notice_type.default
+
 
+def get_observers_for(notice_type, excl_user=None, medium='1'):
+    """Returns the users who get a message (email) for this type of notice.
 
-def get_observers_for(notice_type, excl_user=None):
-    """Returns the list of users which wants to get a message (email) for this
-    type of notice."""
-    query = NoticeSetting.objects.filter(
-            notice_type__label=notice_type, send=True)
+    Like get_recipients(), users without a NoticeSetting get the default of
+    the notice type, and users without an email address are left out. The
+    settings are taken from the cached settings matrix.
+    """
+    try:
+        notice_type = NoticeType.objects.get(label=notice_type)
+    except NoticeType.DoesNotExist:
+        return User.objects.none()
+
+    matrix = get_settings_matrix(notice_type, medium)
+    if NOTICE_MEDIA_DEFAULTS[medium] <= notice_type.default:
+        query = User.objects.exclude(
+            pk__in=[pk for pk, send in matrix.items() if not send])
+    else:
+        query = User.objects.filter(
+            pk__in=[pk for pk, send in matrix.items() if send])
+    query = query.exclude(email='')
 
     if excl_user:
-        query = query.exclude(user=excl_user)
+        query = query.exclude(pk=excl_user.pk)
 
-    return [notice_setting.user for notice_setting in query]
+    return query
 
 
-class NoticeQueueBatch(models.Model):
-    """A queued notice.
+class QueuedNotice(models.Model):
+    """A notice queued by queue(), to be sent to the users of its entries.
 
-    Denormalized data for a notice.
+    The extra_context is stored as JSON, see serialize_context().
 
     """
-    pickled_data = models.TextField()
+    label = models.CharField(_('label'), max_length=40)
+    context = models.TextField(_('context'))
+    on_site = models.BooleanField(_('on site'), default=True)
+    created = models.DateTimeField(_('created'), default=datetime.datetime.now)
+
+    class Meta:
+        ordering = ['id']
+        verbose_name = _('queued notice')
+        verbose_name_plural = _('queued notices')
+
+    def __str__(self):
+        return self.label
+
+
+class NoticeQueueEntry(models.Model):
+    """One recipient of a QueuedNotice.
+
+    Entries are claimed by the workers of notification.engine for a
+    limited time (lease), so several workers can process the queue in
+    parallel. An entry whose worker crashed is claimed again after its
+    lease expired.
+
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, _('pending')),
+        (SENT, _('sent')),
+        (FAILED, _('failed')),
+    )
+
+    notice = models.ForeignKey(
+        QueuedNotice, related_name='entries', verbose_name=_('notice'),
+        on_delete=models.CASCADE)
+    user = models.ForeignKey(
+        User, verbose_name=_('user'), on_delete=models.CASCADE)
+    status = models.CharField(_('status'), max_length=10,
+                              choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    lease_id = models.CharField(_('lease'), max_length=32, blank=True)
+    lease_until = models.DateTimeField(_('lease until'), null=True, blank=True)
+    last_error = models.TextField(_('last error'), blank=True)
+
+    class Meta:
+        unique_together = ('notice', 'user')
+        index_together = ('status', 'lease_until')
+        verbose_name = _('notice queue entry')
+        verbose_name_plural = _('notice queue entries')
+
+    def __str__(self):
+        return '%s: %s (%s)' % (self.notice, self.user, self.status)
 
 
 def create_notice_type(label, display, description, default=2, verbosity=1):
@@ -197,6 +299,78 @@ def get_formatted_messages(formats, label, context):
     return format_templates
 
 
+class DeliveryStats(object):
+    """Throughput metrics of delivered notices.
+
+    Stats of several deliveries can be added up, e.g. the results of
+    the worker processes in notification.engine.
+    """
+
+    def __init__(self, recipients=0, messages=0, renders=0, seconds=0.0,
+                 failed=None):
+        self.recipients = recipients  # Users the notice was meant for
+        self.messages = messages      # Sent emails
+        self.renders = renders        # Rendered sets of templates
+        self.seconds = seconds
+        self.failed = failed or {}    # User ids and errors of failed emails
+
+    def __add__(self, other):
+        failed = dict(self.failed)
+        failed.update(other.failed)
+        return DeliveryStats(self.recipients + other.recipients,
+                             self.messages + other.messages,
+                             self.renders + other.renders,
+                             self.seconds + other.seconds,
+                             failed)
+
+    @property
+    def rate(self):
+        """Sent emails per second."""
+        return self.messages / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return '%d recipients, %d emails, %d failed, %d renders in %.2f seconds (%.1f emails/s)' % (
+            self.recipients, self.messages, len(self.failed), self.renders,
+            self.seconds, self.rate)
+
+
+def get_notification_settings(users, notice_type, medium):
+    """Like should_send() for a list of users.
+
+    Returns a dictionary of user ids and whether to send the notice. Users
+    without a NoticeSetting get the default of notice_type, nothing is
+    written to the database.
+    """
+    matrix = get_settings_matrix(notice_type, medium)
+    default = (NOTICE_MEDIA_DEFAULTS[medium] <= notice_type.default)
+    return dict((user.pk, matrix.get(user.pk, default)) for user in users)
+
+
+def get_recipients(users, notice_type, medium):
+    """Returns the users of the list which get the notice by email."""
+    send_map = get_notification_settings(users, notice_type, medium)
+    return [user for user in users if send_map[user.pk] and user.email]
+
+
+def get_notification_languages(users):
+    """Returns a dictionary of user ids and their notification language.
+
+    Users without a language are missing, the dictionary is empty if this
+    site does not use translated notifications.
+    """
+    module = getattr(settings, 'NOTIFICATION_LANGUAGE_MODULE', False)
+    if not module:
+        return {}
+    language_model = apps.get_model(*module.split('.'))
+    return dict(language_model._default_manager.filter(
+        user__in=[user.pk for user in users]).values_list('user_id', 'language'))
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 def send_now(users, label, extra_context=None, on_site=True):
     """Creates a new notice.
 
@@ -210,10 +384,19 @@ def send_now(users, label, extra_context=None, on_site=True):
     You can pass in on_site=False to prevent the notice emitted from being
     displayed on the site.
 
+    The recipients are processed in chunks of NOTIFICATION_BATCH_SIZE.
+    The templates are rendered once per language, so they can't refer to
+    the recipient. All emails are sent over one connection to the mail
+    server. Failed emails don't stop the delivery, they are listed in the
+    returned DeliveryStats object.
+
     """
     if extra_context is None:
         extra_context = {}
 
+    start_time = time.time()
+    stats = DeliveryStats()
+
     # FrankU: This try statement is added to pass notice types
     # which are deleted but used by third party apps to create a notice
     # e.g. django-messages installed some notice-types which are superfluous
@@ -221,67 +404,91 @@ def send_now(users, label, extra_context=None, on_site=True):
     # used for sending email, like: 'message deleted' or 'message recovered'
     try:
         notice_type = NoticeType.objects.get(label=label)
+    except NoticeType.DoesNotExist:
+        return stats
+
+    current_site = Site.objects.get_current()
+    notices_url = "https://%s%s" % (
+        str(current_site),
+        reverse('notification_notices'),
+    )
+
+    current_language = get_language()
+
+    formats = (
+        'short.txt', # used for subject
+        'full.txt',  # used for email body
+    )  # TODO make formats configurable
+
+    # Subject and body per language
+    rendered = {}
 
-        current_site = Site.objects.get_current()
-        notices_url = "https://%s%s" % (
-            str(current_site),
-            reverse('notification_notices'),
-        )
-
-        current_language = get_language()
-
-        formats = (
-            'short.txt', # used for subject
-            'full.txt',  # used for email body
-        )  # TODO make formats configurable
-
-        for user in users:
-            recipients = []
-            # get user language for user from language store defined in
-            # NOTIFICATION_LANGUAGE_MODULE setting
-            try:
-                language = get_notification_language(user)
-            except LanguageStoreNotAvailable:
-                language = None
-
-            if language is not None:
-                # activate the user's language
-                activate(language)
-
-            # update context with user specific translations
-            context = {
-                'user': user,
-                'current_site': current_site,
-                'subject': notice_type.display
-            }
-            context.update(extra_context)
-
-            # get prerendered format messages and subjects
-            messages = get_formatted_messages(formats, label, context)
-
-            # Create the subject
-            # Use 'email_subject.txt' to add Strings in every emails subject
-            subject = render_to_string('notification/email_subject.txt',
-                                       {'message': messages['short.txt'],}).replace('\n', '')
-
-            # Strip leading newlines. Make writing the email templates easier:
-            # Each linebreak in the templates results in a linebreak in the emails
-            # If the first line in a template contains only template tags the
-            # email will contain an empty line at the top.
-            body = render_to_string('notification/email_body.txt', {
-                'message': messages['full.txt'],
-                'notices_url': notices_url,
-            }).lstrip()
-
-            if should_send(user, notice_type, '1') and user.email:  # Email
-                recipients.append(user.email)
-
-            send_mail(subject, body, settings.DEFAULT_FROM_EMAIL, recipients, fail_silently=True)
+    def render(language):
+        if language is not None:
+            # activate the user's language
+            activate(language)
 
+        context = {
+            'current_site': current_site,
+            'subject': notice_type.display
+        }
+        context.update(extra_context)
+
+        # get prerendered format messages and subjects
+        messages = get_formatted_messages(formats, label, context)
+
+        # Create the subject
+        # Use 'email_subject.txt' to add Strings in every emails subject
+        subject = render_to_string('notification/email_subject.txt',
+                                   {'message': messages['short.txt'],}).replace('\n', '')
+
+        # Strip leading newlines. Make writing the email templates easier:
+        # Each linebreak in the templates results in a linebreak in the emails
+        # If the first line in a template contains only template tags the
+        # email will contain an empty line at the top.
+        body = render_to_string('notification/email_body.txt', {
+            'message': messages['full.txt'],
+            'notices_url': notices_url,
+        }).lstrip()
+
+        stats.renders += 1
+        return subject, body
+
+    connection = get_connection()
+    try:
+        for chunk in _chunks(list(users), BATCH_SIZE):
+            stats.recipients += len(chunk)
+            recipients = get_recipients(chunk, notice_type, '1')  # Email
+            languages = get_notification_languages(recipients)
+
+            for user in recipients:
+                language = languages.get(user.pk)
+                if language not in rendered:
+                    rendered[language] = render(language)
+                subject, body = rendered[language]
+
+                if 'mailer' in settings.INSTALLED_APPS:
+                    send_mail(subject, body, settings.DEFAULT_FROM_EMAIL,
+                              [user.email])
+                    stats.messages += 1
+                    continue
+                try:
+                    # Opens the connection only once
+                    connection.open()
+                    stats.messages += connection.send_messages([EmailMessage(
+                        subject, body, settings.DEFAULT_FROM_EMAIL,
+                        [user.email], connection=connection)]) or 0
+                except Exception as e:
+                    # Reconnect for the next email
+                    stats.failed[user.pk] = repr(e)
+                    connection.close()
+    finally:
+        connection.close()
         # reset environment to original language
         activate(current_language)
-    except NoticeType.DoesNotExist:
-        pass
+
+    stats.seconds = time.time() - start_time
+    return stats
 
 def send(*args, **kwargs):
     """A basic interface around both queue and send_now.
@@ -307,8 +514,37 @@ def send(*args, **kwargs):
             return send_now(*args, **kwargs)
 
 
+def serialize_context(extra_context):
+    """Returns extra_context as JSON.
+
+    Model instances are stored as a reference and fetched again by
+    deserialize_context(). All other values must be JSON serializable.
+
+    """
+    data = {}
+    for key, value in extra_context.items():
+        if isinstance(value, models.Model):
+            value = {'__model__': value._meta.label_lower, 'pk': value.pk}
+        data[key] = value
+    return json.dumps(data)
+
+
+def deserialize_context(context):
+    """Returns the extra_context stored by serialize_context().
+
+    Raises ObjectDoesNotExist if a referenced object got deleted.
+
+    """
+    extra_context = json.loads(context)
+    for key, value in extra_context.items():
+        if isinstance(value, dict) and '__model__' in value:
+            model = apps.get_model(value['__model__'])
+            extra_context[key] = model._default_manager.get(pk=value['pk'])
+    return extra_context
+
+
 def queue(users, label, extra_context=None, on_site=True):
-    """Queue the notification in NoticeQueueBatch.
+    """Queue the notification with one NoticeQueueEntry per user.
 
     This allows for large amounts of user notifications to be deferred
     to a seperate process running outside the webserver.
@@ -320,12 +556,16 @@ def queue(users, label, extra_context=None, on_site=True):
         users = [row['pk'] for row in users.values('pk')]
     else:
         users = [user.pk for user in users]
-    notices = []
-    for user in users:
-        notices.append((user, label, extra_context, on_site))
-
-    NoticeQueueBatch(pickled_data=base64.b64encode(
-    	pickle.dumps(notices))).save()
+    # Users may be listed twice, e.g. by a union of querysets
+    users = list(OrderedDict.fromkeys(users))
+
+    with transaction.atomic():
+        notice = QueuedNotice.objects.create(
+            label=label, context=serialize_context(extra_context),
+            on_site=on_site)
+        NoticeQueueEntry.objects.bulk_create(
+            NoticeQueueEntry(notice=notice, user_id=user) for user in users)
+    return notice
 
 
 class ObservedItemManager(models.Manager):
@@ -0,0 +1,221 @@
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
+
+from django.test import TestCase as DjangoTest
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from django.contrib.auth.models import User
+
+from notification import models as notification
+from notification import engine
+from notification.models import NoticeType, NoticeSetting, QueuedNotice, \
+    NoticeQueueEntry
+
+
+class _NotificationBase(DjangoTest):
+
+    def setUp(self):
+        self.notice_type = NoticeType.objects.create(
+            label='test_notice', display='Test', description='Test', default=2)
+        self.users = [
+            User.objects.create(username='user{}'.format(i),
+                                email='user{}@example.com'.format(i))
+            for i in range(5)]
+
+
+class TestNotification_SendNow(_NotificationBase):
+
+    def test_SendNow_ExceptOneEmailPerRecipient(self):
+        stats = notification.send_now(
+            self.users, 'test_notice', {'notice': 'Hello'})
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual([[user.email] for user in self.users],
+                         [email.to for email in mail.outbox])
+        self.assertIn('Hello', mail.outbox[0].body)
+        self.assertEqual((5, 5, 1), (
+            stats.recipients, stats.messages, stats.renders))
+
+    def test_SendNow_ExceptSettingsRespected(self):
+        NoticeSetting.objects.create(user=self.users[0],
+                                     notice_type=self.notice_type,
+                                     medium='1', send=False)
+        self.users[1].email = ''
+        notification.send_now(self.users, 'test_notice')
+        self.assertEqual(3, len(mail.outbox))
+        # The default is used for missing settings
+        self.assertEqual(1, NoticeSetting.objects.count())
+
+    def test_SendNow_ExceptQueriesIndependentOfRecipients(self):
+        counts = []
+        for users in (self.users[:2], self.users):
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                notification.send_now(users, 'test_notice')
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_SettingsMatrix_ExceptCachedAndInvalidated(self):
+        notification.send_now(self.users, 'test_notice')
+        with CaptureQueriesContext(connection) as queries:
+            notification.send_now(self.users, 'test_notice')
+        self.assertFalse(any('notification_noticesetting' in q['sql']
+                             for q in queries.captured_queries))
+
+        setting = NoticeSetting.objects.create(
+            user=self.users[0], notice_type=self.notice_type, medium='1',
+            send=False)
+        self.assertFalse(notification.should_send(
+            self.users[0], self.notice_type, '1'))
+        setting.delete()
+        self.assertTrue(notification.should_send(
+            self.users[0], self.notice_type, '1'))
+
+    def test_Observers_ExceptEnabledSettingsOnly(self):
+        self.notice_type.default = 1
+        self.notice_type.save()
+        for user, send in zip(self.users[:3], (True, True, False)):
+            NoticeSetting.objects.create(user=user, notice_type=self.notice_type,
+                                         medium='1', send=send)
+        self.assertEqual(
+            [self.users[1]],
+            list(notification.get_observers_for('test_notice',
+                                                excl_user=self.users[0])))
+
+    def test_Observers_ExceptDefaultForMissingSettings(self):
+        NoticeSetting.objects.create(user=self.users[0],
+                                     notice_type=self.notice_type,
+                                     medium='1', send=False)
+        self.users[1].email = ''
+        self.users[1].save()
+        self.assertEqual(
+            self.users[3:],
+            list(notification.get_observers_for(
+                'test_notice', excl_user=self.users[2]).order_by('pk')))
+
+    def test_Observers_ExceptSettingsFromCache(self):
+        notification.get_observers_for('test_notice')
+        with CaptureQueriesContext(connection) as queries:
+            list(notification.get_observers_for('test_notice'))
+        self.assertFalse(any('notification_noticesetting' in q['sql']
+                             for q in queries.captured_queries))
+
+    def test_UnknownLabel_ExceptNothingSent(self):
+        stats = notification.send_now(self.users, 'unknown')
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual(0, stats.recipients)
+
+
+class TestNotification_EmitNotices(_NotificationBase):
+
+    def test_Send_ExceptQueuedByDefault(self):
+        notification.send(self.users, 'test_notice')
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual(5, NoticeQueueEntry.objects.count())
+        with mock.patch.object(notification, 'QUEUE_ALL', False):
+            notification.send(self.users[:1], 'test_notice')
+        self.assertEqual(1, len(mail.outbox))
+
+    def test_EmitNotices_ExceptQueueSent(self):
+        notification.queue(self.users, 'test_notice', {'notice': 'Queued'})
+        notification.queue(self.users[:2], 'test_notice', {'notice': 'More'})
+        out = StringIO()
+        call_command('emit_notices', stdout=out)
+        self.assertEqual(7, len(mail.outbox))
+        self.assertFalse(QueuedNotice.objects.exists())
+        self.assertIn('7 emails', out.getvalue())
+
+    def test_Queue_ExceptContextAsReference(self):
+        notification.queue(self.users[:1], 'test_notice',
+                           {'user': self.users[1], 'notice': 'Hello'})
+        context = notification.deserialize_context(
+            QueuedNotice.objects.get().context)
+        self.assertEqual({'user': self.users[1], 'notice': 'Hello'}, context)
+
+    def test_DeletedContextObject_ExceptEntriesFailed(self):
+        notification.queue(self.users[:2], 'test_notice',
+                           {'user': self.users[4]})
+        self.users[4].delete()
+        engine.send_all()
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual(2, NoticeQueueEntry.objects.filter(
+            status=NoticeQueueEntry.FAILED).count())
+
+
+class TestNotification_Queue(_NotificationBase):
+
+    def setUp(self):
+        super(TestNotification_Queue, self).setUp()
+        self.notice = notification.queue(self.users, 'test_notice')
+
+    def _entry(self, user):
+        return NoticeQueueEntry.objects.get(user=user)
+
+    def test_Claim_ExceptEntriesClaimedOnce(self):
+        first = engine.claim(3)
+        second = engine.claim(3)
+        self.assertEqual(self.users[:3], [entry.user for entry in first])
+        self.assertEqual(self.users[3:], [entry.user for entry in second])
+        self.assertEqual([], engine.claim())
+        self.assertEqual(1, self._entry(self.users[0]).attempts)
+
+    def test_ExpiredLease_ExceptEntryClaimedAgain(self):
+        engine.claim(1)
+        NoticeQueueEntry.objects.filter(user=self.users[0]).update(
+            lease_until=datetime.now() - timedelta(seconds=1))
+        claimed = engine.claim(1)
+        self.assertEqual(self.users[0], claimed[0].user)
+        self.assertEqual(2, claimed[0].attempts)
+
+    def test_Drain_ExceptLeasedEntriesSkipped(self):
+        engine.claim(2)
+        engine.send_all()
+        self.assertEqual(3, len(mail.outbox))
+        # The notice is kept until the leased entries are sent
+        self.assertTrue(QueuedNotice.objects.exists())
+
+    def test_SentEntries_ExceptNotSentAgain(self):
+        # Interrupted before the notice was deleted
+        engine.drain()
+        NoticeQueueEntry.objects.update(lease_until=None)
+        engine.drain()
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual(5, NoticeQueueEntry.objects.filter(
+            status=NoticeQueueEntry.SENT).count())
+
+    def test_SendError_ExceptRetriedForFailedRecipientOnly(self):
+        def send_messages(messages):
+            if messages[0].to == [self.users[1].email]:
+                raise OSError('Refused')
+            mail.outbox.extend(messages)
+            return len(messages)
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.'
+                        'send_messages', side_effect=send_messages):
+            stats = engine.send_all()
+        self.assertEqual(4, len(mail.outbox))
+        self.assertEqual([self.users[1].pk], list(stats.failed))
+        entry = self._entry(self.users[1])
+        self.assertEqual(NoticeQueueEntry.PENDING, entry.status)
+        self.assertIn('Refused', entry.last_error)
+
+        # Retried after the delay
+        self.assertEqual([], engine.claim())
+        NoticeQueueEntry.objects.update(lease_until=None)
+        engine.send_all()
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual(mail.outbox[-1].to, [self.users[1].email])
+        self.assertFalse(QueuedNotice.objects.exists())
+
+    def test_SendError_ExceptFailedAfterMaxAttempts(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.'
+                        'send_messages', side_effect=OSError('Refused')):
+            for i in range(engine.MAX_ATTEMPTS):
+                NoticeQueueEntry.objects.update(lease_until=None)
+                engine.send_all()
+        self.assertEqual(5, NoticeQueueEntry.objects.filter(
+            status=NoticeQueueEntry.FAILED).count())
+        self.assertEqual([], engine.claim())
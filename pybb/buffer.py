@@ -0,0 +1,176 @@
+"""Buffers read markers of topics in the cache.
+
+Marking a topic as read would otherwise cause up to two writes to the
+database for every page view of a topic. If PYBB_BUFFER_WRITES is set, the
+markers are collected in the cache instead and written in batches by the
+management command 'pybb_flush_buffers', which should be run periodically,
+e.g. by cron.
+
+Only enable this with a cache shared by all processes whose incr() is
+atomic, like memcached or redis. With the DatabaseCache incr() is a get and
+a set, and every buffered write costs more queries than writing to the
+database directly.
+
+Nothing in the cache is read, changed and written back, which would lose
+the changes of concurrent requests. Markers are appended to lists instead:
+A list is a counter key, and incr() of the counter reserves the slot for
+the next value. There is a list of (topic id, time) for each user and one
+of the users having markers.
+
+The lists belong to a generation. Flushing starts a new generation, then
+stores the markers of the last two generations and deletes the older one.
+Storing is idempotent, so a marker which is added to the old generation
+while the flush is running gets stored by the next flush.
+
+View counts are not buffered. They are written with an UPDATE using F(),
+which is atomic and costs a single query, while buffering them in the
+configured DatabaseCache would lose counts.
+
+"""
+
+from datetime import datetime
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, When, Value, F
+
+from pybb.models import Topic, Read
+from pybb import settings as pybb_settings
+
+GENERATION_KEY = 'pybb-reads-generation'
+USERS_KEY = 'pybb-reads-%d-users'
+READS_KEY = 'pybb-reads-%d-user-%d'
+
+
+def _generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, 1, None)
+        generation = cache.get(GENERATION_KEY, 1)
+    return generation
+
+
+def _append(key, value):
+    """Append value to the list at key. Returns its position, starting
+    with 1."""
+    while True:
+        try:
+            position = cache.incr(key)
+            break
+        except ValueError:
+            # The list doesn't exist yet
+            cache.add(key, 0, pybb_settings.BUFFER_TIMEOUT)
+    cache.set('%s-%d' % (key, position), value, pybb_settings.BUFFER_TIMEOUT)
+    return position
+
+
+def _item_keys(key):
+    return ['%s-%d' % (key, position)
+            for position in range(1, (cache.get(key) or 0) + 1)]
+
+
+def _values(key):
+    """Returns the values of the list at key. Values whose slot is
+    reserved but not yet written are missing."""
+    item_keys = _item_keys(key)
+    values = cache.get_many(item_keys)
+    return [values[item_key] for item_key in item_keys if item_key in values]
+
+
+def count_view(topic):
+    """Count a view of topic."""
+    Topic.objects.filter(pk=topic.pk).update(views=F('views') + 1)
+
+
+def mark_read(topic, user):
+    """Mark topic as read by user."""
+
+    if not pybb_settings.BUFFER_WRITES:
+        topic.update_read(user)
+        return
+
+    generation = _generation()
+    if _append(READS_KEY % (generation, user.pk),
+               (topic.pk, datetime.now())) == 1:
+        # The first marker of user in this generation
+        _append(USERS_KEY % generation, user.pk)
+
+
+def _reads(generations, user_id):
+    """Returns a dict of topic ids and the newest time of the markers of
+    user in the generations."""
+    reads = {}
+    for generation in generations:
+        for topic_id, time in _values(READS_KEY % (generation, user_id)):
+            if topic_id not in reads or reads[topic_id] < time:
+                reads[topic_id] = time
+    return reads
+
+
+def pending_reads(user):
+    """Returns a dict of topic ids and times of not yet stored read
+    markers of user."""
+
+    if not pybb_settings.BUFFER_WRITES or not user.is_authenticated:
+        return {}
+    generation = _generation()
+    return _reads((generation - 1, generation), user.pk)
+
+
+def _store_reads(user_id, reads):
+    """Store the read markers of user and return the number of changed or
+    created Read objects."""
+    existing = Read.objects.filter(
+        user_id=user_id, topic_id__in=reads.keys())
+    outdated = [read for read in existing if read.time < reads[read.topic_id]]
+    if outdated:
+        Read.objects.filter(pk__in=[read.pk for read in outdated]).update(
+            time=Case(*[When(pk=read.pk, then=Value(reads[read.topic_id]))
+                        for read in outdated]))
+
+    known = set(read.topic_id for read in existing)
+    created = Read.objects.bulk_create(
+        Read(user_id=user_id, topic_id=topic_id, time=time)
+        for topic_id, time in reads.items() if topic_id not in known)
+    return len(outdated) + len(created)
+
+
+def flush_reads():
+    """Store the buffered read markers.
+
+    Per user at most four queries are needed: One to skip deleted topics,
+    one to fetch the existing Read objects, one to update them and one to
+    create the missing ones.
+    Returns the number of stored markers.
+
+    """
+
+    generation = _generation()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.add(GENERATION_KEY, generation + 1, None)
+    generations = (generation - 1, generation)
+
+    total = 0
+    user_ids = set()
+    for users_generation in generations:
+        user_ids.update(_values(USERS_KEY % users_generation))
+    for user_id in user_ids:
+        buffered = _reads(generations, user_id)
+        # Skip topics which got deleted in the meantime
+        topic_ids = set(Topic.objects.filter(
+            pk__in=buffered.keys()).values_list('pk', flat=True))
+        reads = dict((topic_id, time) for topic_id, time in buffered.items()
+                     if topic_id in topic_ids)
+        with transaction.atomic():
+            total += _store_reads(user_id, reads)
+
+    # The older generation is stored twice now
+    old_users = USERS_KEY % (generation - 1)
+    old_keys = [old_users] + _item_keys(old_users)
+    for user_id in _values(old_users):
+        old_reads = READS_KEY % (generation - 1, user_id)
+        old_keys += [old_reads] + _item_keys(old_reads)
+    cache.delete_many(old_keys)
+    return total
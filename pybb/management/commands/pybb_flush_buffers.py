@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from pybb import buffer
+
+
+class Command(BaseCommand):
+    help = '''Write the read markers of topics collected in the cache to the
+    database. Run this periodically, e.g. every few minutes by cron, if
+    PYBB_BUFFER_WRITES is set.'''
+
+    def handle(self, *args, **kwargs):
+        reads = buffer.flush_reads()
+        self.stdout.write('Stored {} read markers'.format(reads))
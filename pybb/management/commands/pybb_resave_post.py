@@ -1,18 +1,122 @@
+import os
+from multiprocessing import Pool
 
 from django.core.management.base import BaseCommand, CommandError
-from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.db.models import Case, When, Value, TextField
 
 from pybb.models import Post
 from pybb import settings as app_settings
 
 
+def render_post(values):
+    """Render one post given as (pk, markup, body).
+
+    This runs in the worker processes of the pool.
+    """
+
+    pk, markup, body = values
+    post = Post(pk=pk, markup=markup, body=body)
+    post.render(use_cache=False)
+    return pk, post.body_html, post.body_text
+
+
 class Command(BaseCommand):
     help = 'Resave all posts.'
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--render-only', action='store_true',
+            help='Only render body_html and body_text of all posts without '
+            'calling Post.save(). Signals are not sent.')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of processes rendering posts (--render-only)')
+        parser.add_argument(
+            '--chunk-size', type=int, default=200,
+            help='Number of posts fetched and written at once (--render-only)')
+        parser.add_argument(
+            '--checkpoint', default='pybb_resave_post.checkpoint',
+            help='File storing the last rendered post id. If it exists, '
+            'rendering resumes after this id (--render-only)')
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Ignore an existing checkpoint file (--render-only)')
+
+    def handle(self, *args, **options):
         app_settings.DISABLE_NOTIFICATION = True
 
+        if options['render_only']:
+            self.render_all(options)
+            return
+
         for count, post in enumerate(Post.objects.all()):
             if count and not count % 1000:
                 print(count)
             post.save()
+
+    def render_all(self, options):
+        checkpoint = options['checkpoint']
+        last_pk = 0
+        if os.path.exists(checkpoint) and not options['restart']:
+            with open(checkpoint) as f:
+                try:
+                    last_pk = int(f.read().strip() or 0)
+                except ValueError:
+                    raise CommandError(
+                        'Invalid checkpoint file: {}'.format(checkpoint))
+            self.stdout.write('Resuming after post {}'.format(last_pk))
+
+        pool = None
+        if options['workers'] > 1:
+            # Forked processes must not share the database connection
+            connections.close_all()
+            pool = Pool(options['workers'])
+
+        count = 0
+        try:
+            while True:
+                # Keyset pagination: this stays fast for the last chunks
+                rows = list(Post.objects.filter(pk__gt=last_pk).order_by(
+                    'pk').values_list('pk', 'markup', 'body')[:options['chunk_size']])
+                if not rows:
+                    break
+
+                if pool:
+                    rendered = pool.map(render_post, rows)
+                else:
+                    rendered = [render_post(row) for row in rows]
+
+                self.write_rendered(rendered)
+
+                last_pk = rows[-1][0]
+                with open(checkpoint, 'w') as f:
+                    f.write(str(last_pk))
+                count += len(rows)
+                self.stdout.write('{} posts rendered, last id {}'.format(
+                    count, last_pk))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        # Finished, a new run starts from the beginning
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write('Done, {} posts rendered'.format(count))
+
+    def write_rendered(self, rendered):
+        """Write body_html and body_text of many posts with one UPDATE.
+
+        This uses a CASE expression, because QuerySet.bulk_update()
+        is not available in our Django version.
+        """
+
+        def _case(index):
+            return Case(*[When(pk=values[0], then=Value(values[index]))
+                          for values in rendered],
+                        output_field=TextField())
+
+        with transaction.atomic():
+            Post.objects.filter(pk__in=[values[0] for values in rendered]).update(
+                body_html=_case(1), body_text=_case(2))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from pybb.models import Forum, Topic
+
+
+class Command(BaseCommand):
+    help = '''Rebuild the denormalized post and topic counters and the last
+    post of all forums and topics.'''
+
+    def handle(self, *args, **kwargs):
+        nr_topics = nr_forums = 0
+        with transaction.atomic():
+            for topic in Topic.objects.iterator():
+                topic.update_counters()
+                nr_topics += 1
+            for forum in Forum.objects.iterator():
+                forum.update_counters()
+                nr_forums += 1
+
+        self.stdout.write('Updated counters of {} forums and {} topics'.format(
+            nr_forums, nr_topics))
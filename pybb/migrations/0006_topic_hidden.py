@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def set_hidden_topics(apps, schema_editor):
+    """A topic is hidden if its first post is hidden."""
+
+    Topic = apps.get_model('pybb', 'Topic')
+    Post = apps.get_model('pybb', 'Post')
+    head_hidden = Post.objects.filter(
+        topic=OuterRef('pk')).order_by('created').values('hidden')[:1]
+    hidden_ids = list(Topic.objects.annotate(
+        head_hidden=Subquery(head_hidden, output_field=models.BooleanField())
+    ).filter(head_hidden=True).values_list('id', flat=True))
+    Topic.objects.filter(id__in=hidden_ids).update(hidden=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pybb', '0005_auto_20181221_1047'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topic',
+            name='hidden',
+            field=models.BooleanField(
+                db_index=True, default=False, editable=False, verbose_name='Hidden'),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='created',
+            field=models.DateTimeField(
+                blank=True, db_index=True, verbose_name='Created'),
+        ),
+        migrations.RunPython(set_hidden_topics, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def _count(queryset, field):
+    return Coalesce(Subquery(
+        queryset.order_by().values(field).annotate(
+            count=Count('pk')).values('count'),
+        output_field=IntegerField()), 0)
+
+
+def set_counters(apps, schema_editor):
+    """Same as './manage.py pybb_update_counters'."""
+
+    Forum = apps.get_model('pybb', 'Forum')
+    Topic = apps.get_model('pybb', 'Topic')
+    Post = apps.get_model('pybb', 'Post')
+
+    posts = Post.objects.filter(topic=OuterRef('pk'), hidden=False)
+    Topic.objects.update(
+        nr_posts=_count(posts, 'topic'),
+        last_post=Subquery(posts.order_by('-created').values('pk')[:1]))
+
+    topics = Topic.objects.filter(forum=OuterRef('pk'), hidden=False)
+    posts = Post.objects.filter(
+        topic__forum=OuterRef('pk'), hidden=False, topic__hidden=False)
+    Forum.objects.update(
+        nr_topics=_count(topics, 'forum'),
+        nr_posts=_count(posts, 'topic__forum'),
+        last_post=Subquery(posts.order_by('-created').values('pk')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pybb', '0006_topic_hidden'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='forum',
+            name='nr_topics',
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name='Number of topics'),
+        ),
+        migrations.AddField(
+            model_name='forum',
+            name='nr_posts',
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name='Number of posts'),
+        ),
+        migrations.AddField(
+            model_name='forum',
+            name='last_post',
+            field=models.ForeignKey(
+                blank=True, editable=False, null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name='+', to='pybb.Post', verbose_name='Last post'),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='nr_posts',
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name='Number of posts'),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='last_post',
+            field=models.ForeignKey(
+                blank=True, editable=False, null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name='+', to='pybb.Post', verbose_name='Last post'),
+        ),
+        migrations.RunPython(set_counters, migrations.RunPython.noop),
+    ]
@@ -3,7 +3,8 @@ from mainpage.templatetags.wl_markdown import do_wl_markdown
 import os.path
 import hashlib
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Q
 from django.contrib.auth.models import User
 from django.contrib.auth.models import Group
 from django.urls import reverse
@@ -79,7 +80,48 @@ class Category(models.Model):
         return Post.objects.filter(topic__forum__category=self).select_related()
 
 
-class Forum(models.Model):
+class CountersMixin(object):
+    """Changes the denormalized counters and the last post of forums and
+    topics when single posts are added, hidden, unhidden or deleted.
+
+    The counters are changed with F() expressions instead of recounting,
+    and the last post is only searched again if it was removed. Rebuild
+    all counters with './manage.py pybb_update_counters'.
+
+    Models using this provide counted_posts(), returning a QuerySet of
+    the posts which are counted, and update_counters() for recounting.
+    """
+
+    def change_counters(self, **deltas):
+        deltas = dict((name, delta) for name, delta in deltas.items() if delta)
+        if not deltas:
+            return
+        type(self).objects.filter(pk=self.pk).update(**dict(
+            (name, F(name) + delta) for name, delta in deltas.items()))
+        for name, delta in deltas.items():
+            setattr(self, name, getattr(self, name) + delta)
+
+    def post_shown(self, post):
+        """Make post the last post if it is newer than the current one."""
+        if type(self).objects.filter(pk=self.pk).filter(
+                Q(last_post__isnull=True) |
+                Q(last_post__created__lt=post.created)).update(last_post=post):
+            self.last_post = post
+
+    def update_last_post(self, post_id=None, topic_id=None):
+        """Search the last post again if it got deleted, or if it is the
+        post post_id or a post of the topic topic_id which are not counted
+        anymore."""
+        last_post_id, last_topic_id = type(self).objects.filter(
+            pk=self.pk).values_list('last_post', 'last_post__topic').get()
+        if last_post_id is not None and last_post_id != post_id and \
+                (topic_id is None or last_topic_id != topic_id):
+            return
+        self.last_post = self.counted_posts().order_by('-created').first()
+        type(self).objects.filter(pk=self.pk).update(last_post=self.last_post)
+
+
+class Forum(CountersMixin, models.Model):
     category = models.ForeignKey(
         Category, related_name='forums', verbose_name=_('Category'))
     name = models.CharField(_('Name'), max_length=80)
@@ -94,6 +136,15 @@ class Forum(models.Model):
         default=None,
         help_text='Users in this Group will have administrative permissions in this Forum.',
     )
+    # Denormalized statistics of public topics and posts, maintained by
+    # update_counters(). Rebuild with './manage.py pybb_update_counters'
+    nr_topics = models.PositiveIntegerField(
+        _('Number of topics'), default=0, editable=False)
+    nr_posts = models.PositiveIntegerField(
+        _('Number of posts'), default=0, editable=False)
+    last_post = models.ForeignKey(
+        'Post', related_name='+', verbose_name=_('Last post'), null=True,
+        blank=True, editable=False, on_delete=models.SET_NULL)
 
     class Meta:
         ordering = ['position']
@@ -104,7 +155,7 @@ class Forum(models.Model):
         return self.name
 
     def topic_count(self):
-        return self.topics.all().count()
+        return self.nr_topics
 
     def get_absolute_url(self):
         return reverse('pybb_forum', args=[self.id])
@@ -115,28 +166,26 @@ class Forum(models.Model):
 
     @property
     def post_count(self):
-        return Post.objects.filter(topic__forum=self).exclude(hidden=True).count()
+        return self.nr_posts
 
-    @property
-    def last_post(self):
-        # This has better performance than using the posts manager hidden_topics
-        # We search only for the last 10 topics
-        topics = self.topics.order_by('-updated')[:10]
-        posts = []
-        for topic in topics:
-            if topic.is_hidden:
-                continue
-            posts = topic.posts.exclude(hidden=True).order_by(
-            '-created').select_related()
-            break
+    def counted_posts(self):
+        return Post.objects.filter(
+            topic__forum=self, hidden=False, topic__hidden=False)
 
-        try:
-            return posts[0]
-        except IndexError:
-            return None
+    def update_counters(self):
+        """Recount the public topics and posts of this forum and store the
+        results together with the last public post."""
 
+        posts = self.counted_posts()
+        self.nr_topics = self.topics.filter(hidden=False).count()
+        self.nr_posts = posts.count()
+        self.last_post = posts.order_by('-created').first()
+        Forum.objects.filter(pk=self.pk).update(
+            nr_topics=self.nr_topics, nr_posts=self.nr_posts,
+            last_post=self.last_post)
 
-class Topic(models.Model):
+
+class Topic(CountersMixin, models.Model):
     forum = models.ForeignKey(
         Forum, related_name='topics', verbose_name=_('Forum'))
     name = models.CharField(_('Subject'), max_length=255)
@@ -148,6 +197,17 @@ class Topic(models.Model):
     closed = models.BooleanField(_('Closed'), blank=True, default=False)
     subscribers = models.ManyToManyField(
         User, related_name='subscriptions', verbose_name=_('Subscribers'), blank=True)
+    # A topic is hidden if its first post is hidden. This flag is maintained
+    # in Post.save() to make filtering hidden topics cheap.
+    hidden = models.BooleanField(
+        _('Hidden'), default=False, editable=False, db_index=True)
+    # Denormalized statistics of visible posts, maintained by
+    # update_counters(). Rebuild with './manage.py pybb_update_counters'
+    nr_posts = models.PositiveIntegerField(
+        _('Number of posts'), default=0, editable=False)
+    last_post = models.ForeignKey(
+        'Post', related_name='+', verbose_name=_('Last post'), null=True,
+        blank=True, editable=False, on_delete=models.SET_NULL)
 
     class Meta:
         ordering = ['-updated']
@@ -164,30 +224,59 @@ class Topic(models.Model):
         except:
             return None
 
-    @property
-    def last_post(self):
-        return self.posts.exclude(hidden=True).order_by('-created').select_related()[0]
-
     @property
     def is_hidden(self):
         # If the first post of this topic is hidden, the topic is hidden
-        try:
-            return self.posts.first().hidden
-        except:
-            return False
+        return self.hidden
 
     @property
     def post_count(self):
-        return Post.objects.filter(topic=self).exclude(hidden=True).count()
+        return self.nr_posts
 
     def get_absolute_url(self):
         return reverse('pybb_topic', args=[self.id])
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Topic, cls).from_db(db, field_names, values)
+        # Remember the forum to update both forums if the topic gets moved
+        instance._loaded_forum_id = instance.__dict__.get('forum_id')
+        return instance
+
     def save(self, *args, **kwargs):
         new = self.id is None
         if new:
             self.created = datetime.now()
-        super(Topic, self).save(*args, **kwargs)
+        with transaction.atomic():
+            super(Topic, self).save(*args, **kwargs)
+            old_forum_id = getattr(self, '_loaded_forum_id', self.forum_id)
+            if old_forum_id != self.forum_id:
+                self.forum.update_counters()
+                Forum.objects.get(pk=old_forum_id).update_counters()
+                self._loaded_forum_id = self.forum_id
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            # The stored values, the instance may be outdated
+            hidden, nr_posts = Topic.objects.filter(pk=self.pk).values_list(
+                'hidden', 'nr_posts').get()
+            super(Topic, self).delete(*args, **kwargs)
+            if not hidden:
+                self.forum.change_counters(nr_topics=-1, nr_posts=-nr_posts)
+            self.forum.update_last_post()
+
+    def counted_posts(self):
+        return self.posts.filter(hidden=False)
+
+    def update_counters(self):
+        """Recount the visible posts of this topic and store the result
+        together with the last visible post."""
+
+        posts = self.counted_posts()
+        self.nr_posts = posts.count()
+        self.last_post = posts.order_by('-created').first()
+        Topic.objects.filter(pk=self.pk).update(
+            nr_posts=self.nr_posts, last_post=self.last_post)
 
     def update_read(self, user):
         read, new = Read.objects.get_or_create(user=user, topic=self)
@@ -211,49 +300,38 @@ class RenderableItem(models.Model):
     class Meta:
         abstract = True
 
-    def render(self):
+    def render(self, use_cache=True):
         if self.markup == 'bbcode':
-            self.body_html = mypostmarkup.markup(self.body, auto_urls=False)
+            self.body_html = urlize(
+                mypostmarkup.markup(self.body, auto_urls=False))
         elif self.markup == 'markdown':
             self.body_html = str(do_wl_markdown(
-                self.body, 'bleachit'))
+                self.body, 'bleachit', urlize=True, use_cache=use_cache))
         else:
             raise Exception('Invalid markup property: %s' % self.markup)
 
-        # Remove tags which was generated with the markup processor
+        # Remove tags which was generated with the markup processor.
+        # Urlizing adds only tags around links, the text stays the same.
         text = strip_tags(self.body_html)
 
         # Unescape entities which was generated with the markup processor
         self.body_text = unescape(text)
 
-        self.body_html = urlize(self.body_html)
-
 
 class HiddenTopicsManager(models.Manager):
     """Find all hidden topics by posts.
 
-    A whole topic is hidden, if the first post is hidden.
-    This manager returns the hidden topics and can be used to filter them out
-    like so:
+    A whole topic is hidden, if the first post is hidden. This is stored
+    in Topic.hidden, so this manager just returns a QuerySet of the hidden
+    topics. It can be used to filter them out like so:
 
     Post.objects.exclude(topic__in=Post.hidden_topics.all()).filter(...)
 
-    Use this with caution, because it affects performance, see:
-    https://docs.djangoproject.com/en/dev/ref/models/querysets/#in
+    Filtering by 'topic__hidden=False' does the same without a subquery.
     """
 
     def get_queryset(self, *args, **kwargs):
-        qs = super(HiddenTopicsManager,
-                   self).get_queryset().filter(hidden=True)
-
-        hidden_topics = []
-        try:
-            for post in qs:
-                if post.topic.is_hidden:
-                    hidden_topics.append(post.topic)
-            return hidden_topics
-        except:
-            return []
+        return Topic.objects.filter(hidden=True)
 
 class PublicPostsManager(models.Manager):
 
@@ -269,9 +347,8 @@ class PublicPostsManager(models.Manager):
         """
 
         qs = self.get_queryset().filter(
-            topic__forum__category__internal=False, hidden=False).exclude(
-            topic__in=Post.hidden_topics.all()).order_by(
-            '-created')
+            topic__forum__category__internal=False, hidden=False,
+            topic__hidden=False).order_by('-created')
         
         if date_from:
             qs = qs.filter(created__gte=date_from)
@@ -286,7 +363,7 @@ class Post(RenderableItem):
         Topic, related_name='posts', verbose_name=_('Topic'))
     user = models.ForeignKey(
         User, related_name='posts', verbose_name=_('User'))
-    created = models.DateTimeField(_('Created'), blank=True)
+    created = models.DateTimeField(_('Created'), blank=True, db_index=True)
     updated = models.DateTimeField(_('Updated'), blank=True, null=True)
     markup = models.CharField(_('Markup'), max_length=15,
                               default=pybb_settings.DEFAULT_MARKUP, choices=MARKUP_CHOICES)
@@ -319,12 +396,96 @@ class Post(RenderableItem):
         new = self.id is None
 
         if new:
+            # Save only the changed field to not overwrite the counters
             self.topic.updated = datetime.now()
-            self.topic.save()
+            self.topic.save(update_fields=['updated'])
             self.topic.forum.updated = self.topic.updated
-            self.topic.forum.save()
+            self.topic.forum.save(update_fields=['updated'])
 
-        super(Post, self).save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if new:
+            was_hidden = None
+        elif update_fields is not None and 'hidden' not in update_fields:
+            was_hidden = self.hidden
+        elif hasattr(self, '_loaded_hidden'):
+            was_hidden = self._loaded_hidden
+        else:
+            was_hidden = Post.objects.filter(pk=self.pk).values_list(
+                'hidden', flat=True).first()
+
+        # Read by signal handlers, e.g. to update the post counts of users
+        self._hidden_changed = not new and was_hidden != self.hidden
+        self._topic_hidden_changed = False
+        with transaction.atomic():
+            is_head = False
+            if new or self._hidden_changed:
+                topic_was_hidden = self.topic.hidden
+                is_head = self.update_topic_hidden()
+                self._topic_hidden_changed = \
+                    not new and topic_was_hidden != self.topic.hidden
+
+            super(Post, self).save(*args, **kwargs)
+            self._loaded_hidden = self.hidden
+
+            if new and not self.hidden:
+                self._update_counters(1, is_head, new=True)
+            elif self._hidden_changed:
+                self._update_counters(-1 if self.hidden else 1, is_head)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Post, cls).from_db(db, field_names, values)
+        # Remember the stored state to notice when the post gets hidden
+        instance._loaded_hidden = instance.__dict__.get('hidden')
+        return instance
+
+    def _update_counters(self, delta, is_head, new=False):
+        """The post was added or became visible (delta 1) or got hidden
+        (delta -1)."""
+        topic = self.topic
+        forum = topic.forum
+        topic.change_counters(nr_posts=delta)
+        if delta > 0:
+            topic.post_shown(self)
+        else:
+            topic.update_last_post(post_id=self.pk)
+
+        if is_head and new:
+            # The first post of a new topic
+            forum.change_counters(nr_topics=1, nr_posts=1)
+            forum.post_shown(self)
+        elif is_head:
+            # The whole topic got hidden or visible
+            topic.refresh_from_db(fields=['nr_posts', 'last_post'])
+            nr_posts = topic.nr_posts if delta > 0 else topic.nr_posts + 1
+            forum.change_counters(nr_topics=delta, nr_posts=delta * nr_posts)
+            if delta > 0 and topic.last_post is not None:
+                forum.post_shown(topic.last_post)
+            elif delta < 0:
+                forum.update_last_post(topic_id=topic.pk)
+        elif not topic.hidden:
+            forum.change_counters(nr_posts=delta)
+            if delta > 0:
+                forum.post_shown(self)
+            else:
+                forum.update_last_post(post_id=self.pk)
+
+    def update_topic_hidden(self):
+        """Apply the hidden state of the first post to the topic. Returns
+        whether this is the first post.
+
+        This is called before the post is saved, so signal handlers
+        already see the new state of the topic.
+        """
+
+        head_id = self.topic.posts.order_by(
+            'created').values_list('id', flat=True).first()
+        if head_id != self.id:
+            return False
+        if self.topic.hidden != self.hidden:
+            self.topic.hidden = self.hidden
+            Topic.objects.filter(pk=self.topic_id).update(hidden=self.hidden)
+        return True
 
     def get_absolute_url(self):
         return reverse('pybb_post', args=[self.id])
@@ -350,15 +511,24 @@ class Post(RenderableItem):
             for attach in self.attachments.all():
                 attach.delete()
 
-        super(Post, self).delete(*args, **kwargs)
-
-        self.topic.save()
-        self.topic.forum.save()
+        with transaction.atomic():
+            super(Post, self).delete(*args, **kwargs)
 
-        if self_id == head_post_id:
-            self.topic.delete()
+            if self_id == head_post_id:
+                # This updates the counters of the forum
+                self.topic.delete()
+            elif not self.hidden:
+                topic = self.topic
+                topic.change_counters(nr_posts=-1)
+                topic.update_last_post()
+                if not topic.hidden:
+                    topic.forum.change_counters(nr_posts=-1)
+                    topic.forum.update_last_post()
 
     def is_spam(self):
+        # Views showing many posts annotate this
+        if hasattr(self, 'suspicious'):
+            return self.suspicious
         try:
             SuspiciousInput.objects.get(object_id = self.pk)
             return True
@@ -20,6 +20,12 @@ PYBB_ATTACHMENT_ENABLE = get('PYBB_ATTACHMENT_ENABLE', False)
 ATTACHMENT_ENABLE = get('PYBB_ATTACHMENT_ENABLE', True)
 INTERNAL_PERM =  get('INTERNAL_PERM', 'pybb.can_access_internal')
 LAST_POSTS_DAYS = get('LAST_POSTS_DAYS', 30)
+LAST_POSTS_PAGE_SIZE = get('PYBB_LAST_POSTS_PAGE_SIZE', 20)
+# Collect read markers of topics in the cache, they are written to the
+# database by running 'manage.py pybb_flush_buffers' periodically. Only
+# useful with memcached or redis, see pybb/buffer.py
+BUFFER_WRITES = get('PYBB_BUFFER_WRITES', False)
+BUFFER_TIMEOUT = get('PYBB_BUFFER_TIMEOUT', 3600 * 24)
 
 # That is used internally
 DISABLE_NOTIFICATION = False
@@ -1,7 +1,14 @@
-from django.db.models.signals import post_save
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
 
-from pybb.models import Post
+from pybb.models import Post, Topic
+
+# Cache keys of the latest posts shown by the tag pybb_last_posts, for
+# users allowed to see internal forums and for all other users
+LAST_POSTS_KEYS = {True: 'pybb-last-posts-internal',
+                   False: 'pybb-last-posts-public'}
 
 
 def post_saved(instance, **kwargs):
@@ -9,5 +16,19 @@ def post_saved(instance, **kwargs):
     # notify_topic_subscribers(instance)
 
 
+def invalidate_last_posts(**kwargs):
+    """Posts got added, hidden or deleted, or a topic changed.
+
+    The cache is cleared again after the commit, because other requests
+    may have cached the old state meanwhile.
+    """
+    keys = list(LAST_POSTS_KEYS.values())
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
 def setup_signals():
     post_save.connect(post_saved, sender=Post)
+    for sender in (Post, Topic):
+        post_save.connect(invalidate_last_posts, sender=sender)
+        post_delete.connect(invalidate_last_posts, sender=sender)
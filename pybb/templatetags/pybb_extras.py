@@ -5,39 +5,62 @@ import re
 from pprint import pprint
 
 from django import template
+from django.core.cache import cache
 from django.utils.safestring import mark_safe
 from django.template.defaultfilters import stringfilter
 from django.utils.encoding import smart_text
 from django.utils.html import escape
 
 from pybb.models import Post, Forum, Topic, Read
-from pybb.unread import cache_unreads
+from pybb.unread import cache_unreads, unread_forums
+from pybb.buffer import pending_reads
 from pybb import settings as pybb_settings
+from pybb.signals import LAST_POSTS_KEYS
+from wlprofile.templatetags.wlprofile_extras import user_link
 import pybb.views
 
 register = template.Library()
 
+# The latest posts are invalidated on changes, the timeout just limits the
+# age of other shown data, e.g. user names
+LAST_POSTS_TIMEOUT = 60 * 60
+
 
 @register.inclusion_tag('pybb/last_posts.html', takes_context=True)
 def pybb_last_posts(context, number=8):
+    """The latest posts of the number most recently active topics.
 
-    BASE_COUNT = 100
+    The result depends only on whether the user may see internal forums,
+    so it is cached for both cases. Only plain values are cached, and the
+    longest list requested so far, which is sliced for shorter ones. The
+    cache is invalidated by the signal handlers in pybb/signals.py.
+    """
 
-    # Create permission dependent Querysets
-    if pybb.views.allowed_for(context.request.user):
-        last_posts = Post.objects.filter(
-            hidden=False).order_by('-created')[:BASE_COUNT]
-    else:
-        last_posts = Post.objects.public(limit=BASE_COUNT)
-
-    check = []
-    answer = []
-    for post in last_posts:
-        if (post.topic_id not in check) and len(check) < number:
-            check = check + [post.topic_id]
-            answer = answer + [post]
+    allowed = pybb.views.allowed_for(context.request.user)
+    key = LAST_POSTS_KEYS[allowed]
+    cached = cache.get(key)
+    if cached is not None and cached[0] >= number:
+        return {'posts': cached[1][:number]}
+
+    # Topic.last_post is the latest visible post of each topic
+    topics = Topic.objects.filter(last_post__isnull=False)
+    if not allowed:
+        topics = topics.filter(
+            forum__category__internal=False, hidden=False)
+    topics = topics.select_related(
+        'forum', 'last_post__user__wlprofile').order_by(
+        '-last_post__created')[:number]
+
+    posts = [{
+        'url': topic.last_post.get_absolute_url(),
+        'topic_name': topic.name,
+        'forum_name': topic.forum.name,
+        'user_link': user_link(topic.last_post.user),
+        'created': topic.last_post.created,
+    } for topic in topics]
+    cache.set(key, (number, posts), LAST_POSTS_TIMEOUT)
     return {
-        'posts': answer,
+        'posts': posts,
         }
 
 
@@ -71,24 +94,25 @@ def pybb_has_unreads(topic, user):
                 except Read.DoesNotExist:
                     read = None
 
-            if read is None:
+            read_time = read and read.time
+            if topic.id in pending and (read_time is None or
+                                        read_time < pending[topic.id]):
+                read_time = pending[topic.id]
+
+            if read_time is None:
                 return False
             else:
-                return topic.updated <= read.time
+                return topic.updated <= read_time
 
     if not user.is_authenticated:
         return False
     else:
         if isinstance(topic, Topic):
+            pending = pending_reads(user)
             return not _is_topic_read(topic, user)
         if isinstance(topic, Forum):
             forum = topic
-            for t in forum.topics.exclude(posts__hidden=True):
-                rv = _is_topic_read(t, user)
-
-                if rv == False:
-                    return True
-            return False
+            return forum.id in unread_forums(user, [forum])
         else:
             raise Exception('Object should be a topic')
 
@@ -172,7 +196,7 @@ def forum_navigation(context):
 
     """
 
-    forums = Forum.objects.all()
+    forums = Forum.objects.select_related('category')
 
     if pybb.views.allowed_for(context.request.user):
         pass
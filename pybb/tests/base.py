@@ -0,0 +1,41 @@
+from django.test import TestCase as DjangoTest
+from django.contrib.auth.models import User
+
+from pybb.models import Category, Forum, Topic, Post
+
+
+class ForumTestCase(DjangoTest):
+    """Base of tests which need forums, topics and posts.
+
+    self.user posts in self.forum unless another user or forum is given.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username='poster')
+        self.category = Category.objects.create(name='Category')
+        self.forum = Forum.objects.create(
+            category=self.category, name='Forum')
+
+    def _login(self):
+        self.client.force_login(self.user)
+
+    def _add_forum(self, name='Forum', category=None):
+        return Forum.objects.create(
+            category=category or self.category, name=name)
+
+    def _add_topic(self, name='Topic', hidden=False, forum=None, user=None,
+                   posts=1):
+        """Add a topic with posts, the first one hidden if hidden is set.
+        Returns the topic with the updated counters."""
+        user = user or self.user
+        topic = Topic.objects.create(
+            forum=forum or self.forum, name=name, user=user)
+        Post.objects.create(
+            topic=topic, user=user, body=name, hidden=hidden)
+        for i in range(posts - 1):
+            self._add_post(topic, user=user)
+        return Topic.objects.get(pk=topic.pk)
+
+    def _add_post(self, topic, hidden=False, user=None):
+        return Post.objects.create(
+            topic=topic, user=user or self.user, body='Answer', hidden=hidden)
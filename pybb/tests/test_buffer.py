@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.urls import reverse
+from django.template import Template, Context
+
+from pybb.models import Topic, Read
+from pybb.tests.base import ForumTestCase
+from pybb import buffer
+from pybb import settings as pybb_settings
+
+
+class TestPybbBuffer(ForumTestCase):
+
+    def setUp(self):
+        super(TestPybbBuffer, self).setUp()
+        self.topic = self._add_topic()
+        self._login()
+        patcher = mock.patch.object(pybb_settings, 'BUFFER_WRITES', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _view_topic(self):
+        self.client.get(reverse('pybb_topic', args=[self.topic.pk]))
+
+    def _has_unreads(self):
+        template = Template(
+            '{% load pybb_extras %}{{ topic|pybb_has_unreads:user }}')
+        return template.render(Context(
+            {'topic': self.topic, 'user': self.user})) == 'True'
+
+    def _flush(self):
+        call_command('pybb_flush_buffers', stdout=StringIO())
+
+    def test_ViewTopic_ExceptViewCountedAndNoReadBeforeFlush(self):
+        self._view_topic()
+        self._view_topic()
+        # Views are counted directly
+        self.assertEqual(2, Topic.objects.get(pk=self.topic.pk).views)
+        self.assertFalse(Read.objects.exists())
+
+    def test_BufferDisabled_ExceptReadStoredDirectly(self):
+        with mock.patch.object(pybb_settings, 'BUFFER_WRITES', False):
+            self._view_topic()
+        self.assertTrue(Read.objects.filter(
+            user=self.user, topic=self.topic).exists())
+        self.assertEqual({}, buffer.pending_reads(self.user))
+
+    def test_Flush_ExceptReadStored(self):
+        self._view_topic()
+        self._flush()
+        read = Read.objects.get(user=self.user, topic=self.topic)
+        # Stored markers are removed from the cache by the next flush
+        self._flush()
+        self.assertEqual({}, buffer.pending_reads(self.user))
+
+        # An existing marker is updated
+        yesterday = datetime.now() - timedelta(days=1)
+        Read.objects.filter(pk=read.pk).update(time=yesterday)
+        self._view_topic()
+        self._flush()
+        self.assertEqual(1, Read.objects.count())
+        self.assertGreater(Read.objects.get(pk=read.pk).time, yesterday)
+
+    def test_ConcurrentMarkers_ExceptAllStored(self):
+        other = User.objects.create(username='other')
+        topic = self._add_topic('Other')
+        buffer.mark_read(self.topic, self.user)
+        buffer.mark_read(topic, self.user)
+        buffer.mark_read(topic, other)
+        self.assertEqual({self.topic.pk, topic.pk},
+                         set(buffer.pending_reads(self.user)))
+        self._flush()
+        self.assertEqual(3, Read.objects.count())
+
+    def test_MarkerAddedDuringFlush_ExceptStoredByNextFlush(self):
+        generation = buffer._generation()
+        self._flush()
+        # A request which read the generation before the flush started
+        with mock.patch.object(buffer, '_generation',
+                               return_value=generation):
+            buffer.mark_read(self.topic, self.user)
+        self.assertIn(self.topic.pk, buffer.pending_reads(self.user))
+        self._flush()
+        self.assertTrue(Read.objects.filter(
+            user=self.user, topic=self.topic).exists())
+
+    def test_PendingRead_ExceptTopicRead(self):
+        self.assertTrue(self._has_unreads())
+        self._view_topic()
+        self.assertTrue(buffer.pending_reads(self.user))
+        self.assertFalse(self._has_unreads())
+
+    def test_FlushDeletedTopic_ExceptNoError(self):
+        self._view_topic()
+        self.topic.delete()
+        self._flush()
+        self.assertFalse(Read.objects.exists())
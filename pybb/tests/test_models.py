@@ -0,0 +1,189 @@
+import os
+import tempfile
+from io import StringIO
+
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.core.management import call_command
+
+from pybb.models import Forum, Topic, Post
+from pybb.tests.base import ForumTestCase
+
+
+class TestPybbModels_HiddenTopics(ForumTestCase):
+
+    def test_HideFirstPost_ExceptTopicHidden(self):
+        topic = self._add_topic()
+        self.assertFalse(topic.is_hidden)
+        head = topic.head
+        head.hidden = True
+        head.save(update_fields=['hidden'])
+        self.assertTrue(Topic.objects.get(pk=topic.pk).is_hidden)
+
+    def test_HideAnswer_ExceptTopicVisible(self):
+        topic = self._add_topic()
+        self._add_post(topic, hidden=True)
+        self.assertFalse(Topic.objects.get(pk=topic.pk).is_hidden)
+
+    def test_HiddenTopicsManager_ExceptOnlyHiddenTopics(self):
+        self._add_topic('Visible')
+        hidden = self._add_topic('Spam', hidden=True)
+        self.assertEqual([hidden], list(Post.hidden_topics.all()))
+
+    def test_Public_ExceptNoPostsOfHiddenTopics(self):
+        visible = self._add_topic('Visible')
+        self._add_post(visible)
+        self._add_post(visible, hidden=True)
+        hidden = self._add_topic('Spam', hidden=True)
+        self._add_post(hidden)
+        self.assertEqual(
+            2, Post.objects.public().count())
+        self.assertEqual(
+            visible.posts.filter(hidden=False).last(),
+            Forum.objects.get(pk=self.forum.pk).last_post)
+
+    def test_Public_ExceptNoInternalPosts(self):
+        self.category.internal = True
+        self.category.save()
+        self._add_topic()
+        self.assertEqual(0, Post.objects.public().count())
+
+
+class TestPybbModels_Counters(ForumTestCase):
+
+    def _reload(self, topic):
+        return (Topic.objects.get(pk=topic.pk),
+                Forum.objects.get(pk=self.forum.pk))
+
+    def test_AddPosts_ExceptCounted(self):
+        topic = self._add_topic()
+        post = self._add_post(topic)
+        topic, forum = self._reload(topic)
+        self.assertEqual(2, topic.post_count)
+        self.assertEqual(post, topic.last_post)
+        self.assertEqual(1, forum.topic_count())
+        self.assertEqual(2, forum.post_count)
+        self.assertEqual(post, forum.last_post)
+
+    def test_HidePost_ExceptNotCounted(self):
+        topic = self._add_topic()
+        first = self._add_post(topic)
+        second = self._add_post(topic)
+        second.hidden = True
+        second.save(update_fields=['hidden'])
+        topic, forum = self._reload(topic)
+        self.assertEqual(2, topic.post_count)
+        self.assertEqual(first, topic.last_post)
+        self.assertEqual(first, forum.last_post)
+
+    def test_HideTopic_ExceptForumCountersReduced(self):
+        visible = self._add_topic('Visible')
+        hidden = self._add_topic('Spam')
+        head = hidden.head
+        head.hidden = True
+        head.save(update_fields=['hidden'])
+        visible, forum = self._reload(visible)
+        self.assertEqual(1, forum.topic_count())
+        self.assertEqual(1, forum.post_count)
+        self.assertEqual(visible.head, forum.last_post)
+
+    def test_DeletePost_ExceptCountersUpdated(self):
+        topic = self._add_topic()
+        first = self._add_post(topic)
+        self._add_post(topic).delete()
+        topic, forum = self._reload(topic)
+        self.assertEqual(2, topic.post_count)
+        self.assertEqual(first, topic.last_post)
+        self.assertEqual(2, forum.post_count)
+
+    def test_DeleteHeadPost_ExceptTopicRemovedFromForum(self):
+        topic = self._add_topic()
+        self._add_post(topic)
+        topic.head.delete()
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual(0, forum.topic_count())
+        self.assertEqual(0, forum.post_count)
+        self.assertIsNone(forum.last_post)
+
+    def test_MoveTopic_ExceptBothForumsUpdated(self):
+        topic = self._add_topic()
+        other = self._add_forum('Other')
+        topic.forum = other
+        topic.save()
+        self.assertEqual(0, Forum.objects.get(pk=self.forum.pk).post_count)
+        self.assertEqual(1, Forum.objects.get(pk=other.pk).post_count)
+
+    def test_EditPost_ExceptNoRecount(self):
+        topic = self._add_topic()
+        post = self._add_post(topic)
+        post = Post.objects.get(pk=post.pk)
+        post.body = 'Edited'
+        with CaptureQueriesContext(connection) as queries:
+            post.save()
+        self.assertFalse(any(q['sql'].startswith(('UPDATE "pybb_forum"',
+                                                  'UPDATE "pybb_topic"'))
+                             for q in queries.captured_queries))
+        topic, forum = self._reload(topic)
+        self.assertEqual((2, 2), (topic.post_count, forum.post_count))
+
+    def test_HideAndUnhideTopic_ExceptCountersRestored(self):
+        visible = self._add_topic('Visible')
+        topic = self._add_topic('Topic')
+        answer = self._add_post(topic)
+        head = Post.objects.get(pk=topic.head.pk)
+        head.hidden = True
+        head.save()
+        forum = Forum.objects.get(pk=self.forum.pk)
+        self.assertEqual((1, 1, visible.head), (
+            forum.topic_count(), forum.post_count, forum.last_post))
+
+        head.hidden = False
+        head.save()
+        topic, forum = self._reload(topic)
+        self.assertEqual((2, answer), (topic.post_count, topic.last_post))
+        self.assertEqual((2, 3, answer), (
+            forum.topic_count(), forum.post_count, forum.last_post))
+
+    def test_UpdateCountersCommand_ExceptRebuilt(self):
+        topic = self._add_topic()
+        post = self._add_post(topic)
+        Topic.objects.update(nr_posts=0, last_post=None)
+        Forum.objects.update(nr_topics=0, nr_posts=0, last_post=None)
+        call_command('pybb_update_counters', stdout=StringIO())
+        topic, forum = self._reload(topic)
+        self.assertEqual((2, post), (topic.post_count, topic.last_post))
+        self.assertEqual((1, 2, post), (
+            forum.topic_count(), forum.post_count, forum.last_post))
+
+
+class TestPybbCommands_ResavePost(ForumTestCase):
+
+    def setUp(self):
+        super(TestPybbCommands_ResavePost, self).setUp()
+        topic = self._add_topic()
+        for i in range(5):
+            self._add_post(topic)
+        Post.objects.update(body_html='', body_text='')
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+
+    def _resave(self):
+        call_command('pybb_resave_post', render_only=True, workers=1,
+                     chunk_size=2, checkpoint=self.checkpoint,
+                     stdout=StringIO())
+
+    def test_RenderOnly_ExceptAllRendered(self):
+        self._resave()
+        self.assertFalse(Post.objects.filter(body_html='').exists())
+        self.assertEqual(
+            ['Answer'] * 5, list(Post.objects.order_by('pk').values_list(
+                'body_text', flat=True))[1:])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_Checkpoint_ExceptResumed(self):
+        pks = list(Post.objects.order_by('pk').values_list('pk', flat=True))
+        with open(self.checkpoint, 'w') as f:
+            f.write(str(pks[2]))
+        self._resave()
+        self.assertEqual(
+            pks[:3], list(Post.objects.filter(body_html='').order_by(
+                'pk').values_list('pk', flat=True)))
@@ -0,0 +1,256 @@
+import os
+import shutil
+import tempfile
+
+from django.test import RequestFactory, override_settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.template import RequestContext, Template
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from pybb.models import Category, Topic, Attachment
+from pybb.signals import LAST_POSTS_KEYS
+from pybb.tests.base import ForumTestCase
+
+
+class TestPybbViews_ShowTopic(ForumTestCase):
+
+    def setUp(self):
+        super(TestPybbViews_ShowTopic, self).setUp()
+        self._login()
+
+    def _topic_with_posts(self, count):
+        author = User.objects.create(username='author{}'.format(count))
+        topic = self._add_topic(user=author)
+        for i in range(count - 1):
+            poster = User.objects.create(
+                username='poster{}_{}'.format(count, i))
+            self._add_post(topic, user=poster)
+        return topic
+
+    def _count_queries(self, topic):
+        url = reverse('pybb_topic', args=[topic.pk])
+        # Warm up caches, e.g. content types and the online users
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        return len(queries)
+
+    def test_QueryCount_ExceptIndependentOfPageSize(self):
+        # Create both topics up front, the sidebar lists the latest topics
+        small_topic = self._topic_with_posts(2)
+        large_topic = self._topic_with_posts(10)
+        self.assertEqual(self._count_queries(small_topic),
+                         self._count_queries(large_topic))
+
+
+class TestPybbViews_Unreads(ForumTestCase):
+
+    def setUp(self):
+        super(TestPybbViews_Unreads, self).setUp()
+        self.author = User.objects.create(username='author')
+        self.forums = [self.forum, self._add_forum('Other')]
+        self._login()
+
+    def _add_author_topic(self, forum):
+        return self._add_topic(forum=forum, user=self.author)
+
+    def _get(self, name, *args):
+        url = reverse(name, args=args)
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        return response, len(queries)
+
+    def test_Index_ExceptUnreadForumsOnly(self):
+        read_topic = self._add_author_topic(self.forums[0])
+        self._add_author_topic(self.forums[1])
+        self.client.get(reverse('pybb_topic', args=[read_topic.pk]))
+        response, _ = self._get('pybb_index')
+        self.assertEqual({self.forums[1].pk}, response.context['unread_forums'])
+
+    def test_Index_ExceptQueryCountIndependentOfTopics(self):
+        # Fill the latest posts box of the sidebar, which shows 8 topics
+        for i in range(8):
+            self._add_author_topic(self.forums[0])
+        _, few = self._get('pybb_index')
+        for i in range(5):
+            self._add_author_topic(self.forums[0])
+        _, many = self._get('pybb_index')
+        self.assertEqual(few, many)
+
+    def test_Forum_ExceptUnreadTopicsOnly(self):
+        topics = [self._add_author_topic(self.forums[0]) for i in range(3)]
+        self.client.get(reverse('pybb_topic', args=[topics[0].pk]))
+        response, _ = self._get('pybb_forum', self.forums[0].pk)
+        self.assertEqual({topics[1].pk, topics[2].pk},
+                         response.context['unread_topics'])
+
+    def test_Index_ExceptQueryCountIndependentOfForums(self):
+        for i in range(8):
+            self._add_author_topic(self.forums[0])
+        _, few = self._get('pybb_index')
+        category = self.forums[0].category
+        for i in range(3):
+            forum = self._add_forum('More', category)
+            self._add_author_topic(forum)
+        _, many = self._get('pybb_index')
+        self.assertEqual(few, many)
+
+
+class TestPybbViews_AllLatestPosts(ForumTestCase):
+
+    def setUp(self):
+        super(TestPybbViews_AllLatestPosts, self).setUp()
+        self.forums = [self.forum, self._add_forum('Other')]
+
+    def _add_topics(self, forum, count, posts=2):
+        for i in range(count):
+            self._add_topic(forum=forum, posts=posts)
+
+    def _get(self, sort_by, page=1):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('all_latest_posts'), {
+                'days': 30, 'sort_by': sort_by, 'page': page})
+        self.assertEqual(200, response.status_code)
+        return response, len(queries)
+
+    def test_Topics_ExceptPaginated(self):
+        self._add_topics(self.forums[0], 25)
+        response, _ = self._get('topic', page=2)
+        self.assertEqual(50, response.context['posts_count'])
+        topics = response.context['topics']
+        self.assertEqual(5, len(topics))
+        self.assertEqual([2] * 5, [len(t.latest_posts) for t in topics])
+        # Oldest topics are on the last page
+        self.assertEqual(list(Topic.objects.order_by('pk')[:5]),
+                         sorted(topics, key=lambda t: t.pk))
+
+    def test_Forums_ExceptGroupedByLatestPost(self):
+        self._add_topics(self.forums[0], 2)
+        self._add_topics(self.forums[1], 1)
+        self._add_topics(self.forums[0], 1)
+        response, _ = self._get('forum')
+        self.assertEqual(
+            [self.forums[0]] * 3 + [self.forums[1]],
+            [t.forum for t in response.context['topics']])
+
+    def test_QueryCount_ExceptIndependentOfPosts(self):
+        # Fill the latest posts box of the sidebar, which shows 8 topics
+        self._add_topics(self.forums[0], 8)
+        _, few = self._get('forum')
+        self._add_topics(self.forums[1], 10, posts=3)
+        _, many = self._get('forum')
+        self.assertEqual(few, many)
+
+
+class TestPybbViews_LastPosts(ForumTestCase):
+
+    def _add_last_post(self, forum=None, posts=1):
+        return self._add_topic(forum=forum, posts=posts).last_post
+
+    def _last_posts(self):
+        response = self.client.get(reverse('pybb_index'))
+        return [post['url'] for post in response.context['posts']]
+
+    def _urls(self, *posts):
+        return [post.get_absolute_url() for post in posts]
+
+    def _render_tag(self, number):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        return Template(
+            '{% load pybb_extras %}{% pybb_last_posts ' + str(number) + ' %}'
+        ).render(RequestContext(request))
+
+    def test_LastPosts_ExceptLatestPostOfDistinctTopics(self):
+        first = self._add_last_post(posts=3)
+        second = self._add_last_post(posts=2)
+        self.assertEqual(self._urls(second, first), self._last_posts())
+
+    def test_LastPosts_ExceptNoInternalOrHiddenTopics(self):
+        internal = Category.objects.create(name='Internal', internal=True)
+        self._add_last_post(self._add_forum('Intern', internal))
+        visible = self._add_last_post()
+        hidden = self._add_last_post()
+        hidden.hidden = True
+        hidden.save()
+        self.assertEqual(self._urls(visible), self._last_posts())
+
+    def test_LastPosts_ExceptCachedAndInvalidated(self):
+        post = self._add_last_post()
+        self.assertEqual(self._urls(post), self._last_posts())
+        with CaptureQueriesContext(connection) as queries:
+            self._last_posts()
+        self.assertFalse(any('"last_post_id" IS NOT NULL' in q['sql']
+                             for q in queries.captured_queries))
+
+        answer = self._add_post(post.topic)
+        self.assertEqual(self._urls(answer), self._last_posts())
+        answer.delete()
+        self.assertEqual(self._urls(post), self._last_posts())
+
+    def test_LastPostsDifferentNumbers_ExceptLongestListCached(self):
+        posts = [self._add_last_post() for i in range(3)]
+        self._render_tag(1)
+        self.assertEqual(1, cache.get(LAST_POSTS_KEYS[False])[0])
+        self.assertEqual(3, self._render_tag(3).count(' ago'))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(2, self._render_tag(2).count(' ago'))
+            self._render_tag(3)
+        self.assertFalse(any('"last_post_id" IS NOT NULL' in q['sql']
+                             for q in queries.captured_queries))
+
+        # Plain values are cached
+        number, cached = cache.get(LAST_POSTS_KEYS[False])
+        self.assertEqual(3, number)
+        self.assertEqual(posts[2].get_absolute_url(), cached[0]['url'])
+        self.assertIsInstance(cached[0], dict)
+
+
+class TestPybbViews_ShowAttachment(ForumTestCase):
+
+    def setUp(self):
+        super(TestPybbViews_ShowAttachment, self).setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        post = self._add_topic().last_post
+        self.attachment = Attachment(
+            post=post, size=4, content_type='image/png', path='1.png',
+            name='image.png')
+        self.attachment.save()
+        os.makedirs(os.path.dirname(self.attachment.get_absolute_path()))
+        with open(self.attachment.get_absolute_path(), 'wb') as f:
+            f.write(b'\x89PNG')
+        self.url = self.attachment.get_absolute_url()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_Attachment_ExceptStreamedWithHashAsETag(self):
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b'\x89PNG', b''.join(response.streaming_content))
+        self.assertEqual('image/png', response['Content-Type'])
+        self.assertEqual('"%s"' % self.attachment.hash, response['ETag'])
+        self.assertIn('private', response['Cache-Control'])
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+
+    def test_Sendfile_ExceptHeaderOnly(self):
+        with self.settings(SENDFILE_BACKEND='nginx', SENDFILE_URL='/protected/'):
+            response = self.client.get(self.url)
+        self.assertEqual('/protected/pybb/attachments/1.png',
+                         response['X-Accel-Redirect'])
+        self.assertEqual(b'', response.content)
+
+    def test_MissingFile_Except404(self):
+        os.remove(self.attachment.get_absolute_path())
+        self.assertEqual(404, self.client.get(self.url).status_code)
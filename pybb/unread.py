@@ -1,4 +1,18 @@
+from datetime import datetime, timedelta
+
+from django.db.models import Exists, OuterRef
+
 from pybb.models import Topic, Post, Read
+from pybb.buffer import pending_reads
+from pybb import settings as pybb_settings
+
+
+def _add_pending(read_map, user):
+    """Use the read markers which are not yet stored if they are newer."""
+    for topic_id, time in pending_reads(user).items():
+        if topic_id not in read_map or read_map[topic_id].time < time:
+            read_map[topic_id] = Read(user=user, topic_id=topic_id, time=time)
+    return read_map
 
 
 def cache_unreads(qs, user):
@@ -7,7 +21,7 @@ def cache_unreads(qs, user):
     if isinstance(qs[0], Topic):
         reads = Read.objects.filter(topic__pk__in=set(x.id for x in qs),
                                     user=user).select_related()
-        read_map = dict((x.topic.id, x) for x in reads)
+        read_map = _add_pending(dict((x.topic.id, x) for x in reads), user)
 
         for topic in qs:
             topic._read = read_map.get(topic.id, None)
@@ -16,7 +30,7 @@ def cache_unreads(qs, user):
         ids = set(x.topic.id for x in qs)
         reads = Read.objects.filter(
             topic__pk__in=ids, user=user).select_related()
-        read_map = dict((x.topic.id, x) for x in reads)
+        read_map = _add_pending(dict((x.topic.id, x) for x in reads), user)
 
         for post in qs:
             post.topic._read = read_map.get(post.topic.id, None)
@@ -24,3 +38,38 @@ def cache_unreads(qs, user):
     else:
         raise Exception(
             'cache_unreads could process only Post or Topic querysets')
+
+
+def _unread_topic_values(user, topics, *fields):
+    """Returns the given fields of all topics in queryset topics which have
+    posts user didn't read.
+
+    Topics not updated within READ_TIMEOUT count as read. All other
+    topics are checked against the Read objects of user in one query.
+
+    """
+    if not user.is_authenticated:
+        return []
+
+    since = datetime.now() - timedelta(seconds=pybb_settings.READ_TIMEOUT)
+    is_read = Read.objects.filter(
+        user=user, topic=OuterRef('pk'), time__gte=OuterRef('updated'))
+    rows = topics.filter(hidden=False, updated__gt=since).annotate(
+        is_read=Exists(is_read)).filter(is_read=False).order_by().values_list(
+        'pk', 'updated', *fields)
+
+    pending = pending_reads(user)
+    return [row[2:] for row in rows
+            if row[0] not in pending or pending[row[0]] < row[1]]
+
+
+def unread_topics(user, topics):
+    """Returns the set of ids of topics user has not read."""
+    return set(row[0] for row in _unread_topic_values(user, topics, 'pk'))
+
+
+def unread_forums(user, forums):
+    """Returns the set of ids of forums containing topics user has not
+    read."""
+    topics = Topic.objects.filter(forum__in=forums)
+    return set(row[0] for row in _unread_topic_values(user, topics, 'forum'))
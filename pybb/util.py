@@ -2,10 +2,9 @@ import os.path
 import random
 import traceback
 import json
-import re
 import subprocess
 
-from bs4 import BeautifulSoup, NavigableString
+from bs4 import BeautifulSoup
 from datetime import datetime
 from django.shortcuts import render
 from django.http import HttpResponse
@@ -17,6 +16,7 @@ from django.core.paginator import Paginator, EmptyPage, InvalidPage
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from pybb import settings as pybb_settings
+from mainpage.templatetags.wl_markdown import urlize_soup
 import magic
 import zipfile
 import configparser
@@ -110,47 +110,16 @@ def build_form(Form, _request, GET=False, *args, **kwargs):
     return form
 
 
-PLAIN_LINK_RE = re.compile(r'(http[s]?:\/\/[-a-zA-Z0-9@:%._\+~#=/?]+)')
-def exclude_code_tag(bs4_string):
-    if bs4_string.parent.name == 'code':
-        return False
-    m = PLAIN_LINK_RE.search(bs4_string)
-    if m:
-        return True
-    return False
-
-
 def urlize(data):
     """Urlize plain text links in the HTML contents.
 
-    Do not urlize content of A and CODE tags.
+    Do not urlize content of CODE tags. Markdown gets urlized by
+    do_wl_markdown(value, urlize=True) without parsing the HTML twice.
 
     """
 
     soup = BeautifulSoup(data, 'lxml')
-    for found_string in soup.find_all(string=exclude_code_tag):
-        new_content = []
-        strings_or_tags = found_string.parent.contents
-        for string_or_tag in strings_or_tags:
-            try:
-                for string in PLAIN_LINK_RE.split(string_or_tag):
-                    if string.startswith('http'):
-                        # Apply an a-Tag
-                        tag = soup.new_tag('a')
-                        tag['href'] = string
-                        tag.string = string
-                        tag['nofollow'] = 'true'
-                        new_content.append(tag)
-                    else:
-                        # This is just a string, apply a bs4-string
-                        new_content.append(NavigableString(string))
-            except:
-                # Regex failed, so apply what ever it is
-                new_content.append(string_or_tag)
-
-        # Apply the new content
-        found_string.parent.contents = new_content
-
+    urlize_soup(soup)
     return str(soup)
 
 
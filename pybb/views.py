@@ -1,15 +1,17 @@
 import math
-from collections import OrderedDict
+import os
 from mainpage.templatetags.wl_markdown import do_wl_markdown
 from pybb.markups import mypostmarkup
 
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponseRedirect, HttpResponse, Http404
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse
 from django.shortcuts import redirect
-from django.db.models import Q
+from django.db.models import Q, Exists, OuterRef, Prefetch, Max, Case, When, \
+    Value, IntegerField
 from django.http import Http404
 from django.conf import settings
 
@@ -18,10 +20,12 @@ from pybb.models import Category, Forum, Topic, Post, Attachment,\
     MARKUP_CHOICES
 from pybb.forms import AddPostForm, EditPostForm, LastPostsDayForm
 from pybb import settings as pybb_settings
-from pybb.orm import load_related
+from pybb import buffer
+from pybb.unread import unread_forums, unread_topics
 from pybb.templatetags.pybb_extras import pybb_moderated_by
 
 from check_input.models import SuspiciousInput
+from mainpage.protected_files import serve_file
 from datetime import date, timedelta
 
 
@@ -37,24 +41,38 @@ def allowed_for(user):
     return user.is_superuser or user.has_perm(pybb_settings.INTERNAL_PERM)
 
 
+def _forums_with_last_post():
+    return Forum.objects.select_related(
+        'last_post__topic', 'last_post__user__wlprofile')
+
+
 def index_ctx(request):
     if allowed_for(request.user):
-        cats = Category.objects.all().select_related()
+        cats = Category.objects.all()
     else:
-        cats = Category.exclude_internal.all().select_related()
+        cats = Category.exclude_internal.all()
+    cats = cats.prefetch_related(
+        Prefetch('forums', queryset=_forums_with_last_post()))
 
-    return {'cats': cats }
+    return {'cats': cats,
+            'unread_forums': unread_forums(
+                request.user, Forum.objects.filter(category__in=cats)),
+            }
 index = render_to('pybb/index.html')(index_ctx)
 
 
 def show_category_ctx(request, category_id):
     
-    category = get_object_or_404(Category, pk=category_id)
+    category = get_object_or_404(Category.objects.prefetch_related(
+        Prefetch('forums', queryset=_forums_with_last_post())), pk=category_id)
     
     if category.internal and not allowed_for(request.user):
         raise Http404
 
-    return {'category': category }
+    return {'category': category,
+            'unread_forums': unread_forums(
+                request.user, category.forums.all()),
+            }
 show_category = render_to('pybb/category.html')(show_category_ctx)
 
 
@@ -66,11 +84,12 @@ def show_forum_ctx(request, forum_id):
 
     user_is_mod = pybb_moderated_by(forum, request.user)
 
-    topics = forum.topics.order_by(
-        '-sticky', '-updated').select_related()
+    topics = forum.topics.order_by('-sticky', '-updated').select_related(
+        'user__wlprofile', 'last_post__user__wlprofile')
 
     return {'forum': forum,
             'topics': topics,
+            'unread_topics': unread_topics(request.user, forum.topics.all()),
             'page_size': pybb_settings.FORUM_PAGE_SIZE,
             'user_is_mod': user_is_mod,
             }
@@ -90,11 +109,9 @@ def show_topic_ctx(request, topic_id):
     if topic.forum.category.internal and not allowed_for(request.user):
         raise Http404
 
-    topic.views += 1
-    topic.save()
-
+    buffer.count_view(topic)
     if request.user.is_authenticated:
-        topic.update_read(request.user)
+        buffer.mark_read(topic, request.user)
 
     last_post = topic.posts.order_by('-created')[0]
     context.update({'last_post': last_post})
@@ -113,8 +130,7 @@ def show_topic_ctx(request, topic_id):
         user_is_mod = pybb_moderated_by(topic, request.user)
         context.update({'user_is_mod': user_is_mod})
         
-        subscribed = (request.user.is_authenticated and
-                      request.user in topic.subscribers.all())
+        subscribed = topic.subscribers.filter(pk=request.user.pk).exists()
         context.update({'subscribed': subscribed})
     
         is_spam = False
@@ -123,21 +139,21 @@ def show_topic_ctx(request, topic_id):
         context.update({'is_spam': is_spam})
 
     if user_is_mod:
-        posts = topic.posts.select_related()
+        posts = topic.posts.all()
     else:
-        posts = topic.posts.exclude(hidden=True).select_related()
-    context.update({'posts': posts})
+        posts = topic.posts.exclude(hidden=True)
 
-    # TODO: fetch profiles
-    # profiles = Profile.objects.filter(user__pk__in=
-    #     set(x.user.id for x in page.object_list))
-    # profiles = dict((x.user_id, x) for x in profiles)
-
-    # for post in page.object_list:
-    #     post.user.pybb_profile = profiles[post.user.id]
+    # Fetch everything shown for a post together with the paginated posts,
+    # so the number of queries doesn't depend on the page size
+    posts = posts.select_related('user__wlprofile').annotate(
+        suspicious=Exists(SuspiciousInput.objects.filter(
+            content_type=ContentType.objects.get_for_model(Post),
+            object_id=OuterRef('pk'))))
 
     if pybb_settings.PYBB_ATTACHMENT_ENABLE:
-        load_related(posts, Attachment.objects.all(), 'post')
+        posts = posts.prefetch_related(
+            Prefetch('attachments', to_attr='attachment_cache'))
+    context.update({'posts': posts})
 
     context.update({
         'page_size': pybb_settings.TOPIC_PAGE_SIZE,
@@ -373,10 +389,13 @@ def add_subscription(request, topic_id):
 
 def show_attachment(request, hash):
     attachment = get_object_or_404(Attachment, hash=hash)
-    
-    with open(attachment.get_absolute_path(), 'rb') as file_obj:
-        return HttpResponse(file_obj, content_type=attachment.content_type)
-    return HTTP404
+    path = attachment.get_absolute_path()
+    if not os.path.isfile(path):
+        raise Http404('Attachment file is missing')
+
+    # The hash identifies the content, so browsers may keep the file
+    return serve_file(request, path, attachment.content_type,
+                      etag=attachment.hash, max_age=60 * 60 * 24 * 7)
 
 @login_required
 @ajax
@@ -391,11 +410,10 @@ def post_ajax_preview(request):
         return {'content': ''}
 
     if markup == 'bbcode':
-        html = mypostmarkup.markup(content, auto_urls=False)
+        html = urlize(mypostmarkup.markup(content, auto_urls=False))
     elif markup == 'markdown':
-        html = str(do_wl_markdown(content, 'bleachit'))
+        html = str(do_wl_markdown(content, 'bleachit', urlize=True))
 
-    html = urlize(html)
     return {'content': html}
 
 
@@ -411,6 +429,53 @@ def toggle_hidden_topic(request, topic_id):
     return redirect(topic)
 
 
+class LatestTopics(object):
+    """The topics of the given posts, ordered by their latest post.
+
+    This behaves like a list to be used with {% autopaginate %}: The
+    topics are counted in the database and only the topics of the
+    requested slice are fetched, each with its posts as attribute
+    'latest_posts'. If by_forum is True, the topics are grouped by their
+    forums, the forum with the latest post first.
+    """
+
+    def __init__(self, posts, by_forum=False):
+        self.posts = posts
+        rows = posts.order_by().values('topic').annotate(
+            latest=Max('created'))
+        ordering = ['-latest']
+        if by_forum:
+            forum_ids = posts.order_by().values('topic__forum').annotate(
+                latest=Max('created')).order_by('-latest').values_list(
+                'topic__forum', flat=True)
+            whens = [When(topic__forum=forum_id, then=Value(rank))
+                     for rank, forum_id in enumerate(forum_ids)]
+            if whens:
+                rows = rows.annotate(forum_rank=Case(
+                    *whens, output_field=IntegerField()))
+                ordering.insert(0, 'forum_rank')
+        self.rows = rows.order_by(*ordering)
+
+    def count(self):
+        return self.rows.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+
+        topic_ids = [row['topic'] for row in self.rows[index]]
+        topics = Topic.objects.select_related('forum').in_bulk(topic_ids)
+        for topic_id in topic_ids:
+            topics[topic_id].latest_posts = []
+        for post in self.posts.filter(topic__in=topic_ids).select_related(
+                'user__wlprofile'):
+            topics[post.topic_id].latest_posts.append(post)
+        return [topics[topic_id] for topic_id in topic_ids]
+
+
 def all_latest_posts(request):
     """Provide a view to show more latest posts."""
 
@@ -461,33 +526,8 @@ def all_latest_posts(request):
         # Create a QuerySet with only public posts
         last_posts = Post.objects.public(date_from=search_date)
 
-        posts_count = len(last_posts)
-
-        if sort_by == 'topic':
-            # The use of an OrderedDict makes sure the ordering of
-            # last_posts get not arbitrary
-            topics = OrderedDict()
-            for post in last_posts:
-                if post.topic not in topics:
-                    # Create a new key with a list as value
-                    topics[post.topic] = [post]
-                else:
-                    # key exists, just add the post
-                    topics[post.topic].append(post)
-
-            object_list = topics
-
-        elif sort_by == 'forum':
-            forums = OrderedDict()
-            for post in last_posts:
-                if post.topic.forum.name not in forums:
-                    forums[post.topic.forum.name] = OrderedDict({post.topic: [post]})
-                elif post.topic not in forums[post.topic.forum.name]:
-                    forums[post.topic.forum.name].update({post.topic: [post]})
-                else:
-                    forums[post.topic.forum.name][post.topic].append(post)
-
-            object_list = forums
+        posts_count = last_posts.count()
+        object_list = LatestTopics(last_posts, by_forum=sort_by == 'forum')
 
     except UnboundLocalError:
         # Needed variables
@@ -498,6 +538,7 @@ def all_latest_posts(request):
     return {
         'object_list': object_list,
         'posts_count': posts_count,
+        'page_size': pybb_settings.LAST_POSTS_PAGE_SIZE,
         'form': form,
         'sort_by': sort_by
     }
@@ -0,0 +1,182 @@
+"""Diffs of wiki articles shown in the history and in the edit preview.
+
+The diff is computed by the backend configured in WIKI_DIFF_BACKEND:
+
+LineDiff (default): Diff the lines first, then the words inside changed
+    blocks of lines and the characters inside changed blocks up to
+    WIKI_DIFF_MAX_HUNK_SIZE characters. Fast for big articles.
+CharacterDiff: Diff the characters of the whole texts, like before.
+
+Computing a diff stops after WIKI_DIFF_TIMEOUT seconds, returning a
+coarser but valid diff. Rendered diffs of the history are cached.
+
+"""
+
+import hashlib
+import re
+import sys
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from .diff_match_patch import diff_match_patch
+
+BACKEND = getattr(settings, 'WIKI_DIFF_BACKEND', 'wiki.diff.LineDiff')
+# Seconds, 0 for no limit
+TIMEOUT = getattr(settings, 'WIKI_DIFF_TIMEOUT', 1.0)
+MAX_HUNK_SIZE = getattr(settings, 'WIKI_DIFF_MAX_HUNK_SIZE', 200)
+CACHE_TIMEOUT = getattr(settings, 'WIKI_DIFF_CACHE_TIMEOUT', 60 * 60 * 24)
+
+dmp = diff_match_patch()
+
+
+class CharacterDiff(object):
+    """Character based diff of the whole texts."""
+
+    def diff(self, text1, text2, deadline, semantic=False):
+        diffs = dmp.diff_main(text1, text2, True, deadline)
+        if semantic:
+            dmp.diff_cleanupSemantic(diffs)
+        return diffs
+
+
+def _tokens_to_chars(tokens1, tokens2):
+    """Encode each distinct token as one character, like
+    diff_match_patch.diff_linesToChars() does for lines."""
+    token_array = []
+    token_hash = {}
+
+    def munge(tokens):
+        chars = []
+        for token in tokens:
+            if token not in token_hash:
+                token_hash[token] = len(token_array)
+                token_array.append(token)
+            chars.append(chr(token_hash[token]))
+        return ''.join(chars)
+
+    return munge(tokens1), munge(tokens2), token_array
+
+
+class LineDiff(object):
+    """Line based diff, refined to words and characters inside of changed
+    lines.
+
+    Changed blocks of lines up to MAX_HUNK_SIZE characters are diffed by
+    characters. Bigger blocks are diffed by words, line by line if the
+    number of lines didn't change. Changed words are diffed by characters
+    again.
+    """
+
+    word_re = re.compile(r'\w+|\s+|[^\w\s]+')
+
+    def diff(self, text1, text2, deadline, semantic=False):
+        chars1, chars2, lines = dmp.diff_linesToChars(text1, text2)
+        diffs = dmp.diff_main(chars1, chars2, False, deadline)
+        dmp.diff_charsToLines(diffs, lines)
+
+        def diff_block(deleted, inserted, deadline):
+            block = self._diff_block(deleted, inserted, deadline)
+            if semantic:
+                # Cleaning up the blocks is much faster than cleaning up
+                # the whole diff
+                dmp.diff_cleanupSemantic(block)
+            return block
+
+        diffs = self._refine(diffs, diff_block, deadline)
+        dmp.diff_cleanupMerge(diffs)
+        return diffs
+
+    def _refine(self, diffs, diff_block, deadline):
+        """Replace each block of deletions and insertions by the result of
+        diff_block."""
+        refined = []
+        deleted = inserted = ''
+        # A dummy entry at the end handles the last changed block
+        for op, text in diffs + [(dmp.DIFF_EQUAL, '')]:
+            if op == dmp.DIFF_DELETE:
+                deleted += text
+            elif op == dmp.DIFF_INSERT:
+                inserted += text
+            else:
+                if deleted and inserted and time.time() < deadline:
+                    refined.extend(diff_block(deleted, inserted, deadline))
+                else:
+                    if deleted:
+                        refined.append((dmp.DIFF_DELETE, deleted))
+                    if inserted:
+                        refined.append((dmp.DIFF_INSERT, inserted))
+                deleted = inserted = ''
+                if text:
+                    refined.append((op, text))
+        return refined
+
+    def _diff_chars(self, deleted, inserted, deadline):
+        if len(deleted) + len(inserted) > MAX_HUNK_SIZE or \
+                time.time() >= deadline:
+            return [(op, text) for op, text in ((dmp.DIFF_DELETE, deleted),
+                                                (dmp.DIFF_INSERT, inserted))
+                    if text]
+        return dmp.diff_main(deleted, inserted, False, deadline)
+
+    def _diff_words(self, deleted, inserted, deadline):
+        chars1, chars2, words = _tokens_to_chars(
+            self.word_re.findall(deleted), self.word_re.findall(inserted))
+        diffs = dmp.diff_main(chars1, chars2, False, deadline)
+        dmp.diff_charsToLines(diffs, words)
+        return self._refine(diffs, self._diff_chars, deadline)
+
+    def _diff_block(self, deleted, inserted, deadline):
+        if len(deleted) + len(inserted) <= MAX_HUNK_SIZE:
+            return dmp.diff_main(deleted, inserted, False, deadline)
+
+        old_lines = deleted.splitlines(True)
+        new_lines = inserted.splitlines(True)
+        if len(old_lines) != len(new_lines):
+            # Reflowed text
+            return self._diff_words(deleted, inserted, deadline)
+
+        # Edited lines, e.g. of a table: diff them one by one
+        diffs = []
+        for old_line, new_line in zip(old_lines, new_lines):
+            diffs.extend(self._diff_words(old_line, new_line, deadline))
+        dmp.diff_cleanupMerge(diffs)
+        return diffs
+
+
+_backends = {}
+
+
+def get_backend(path=None):
+    path = path or BACKEND
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+def get_diffs(text1, text2, semantic=False, backend=None):
+    """Returns the diff of both texts as a list of diff_match_patch
+    tuples."""
+    deadline = time.time() + TIMEOUT if TIMEOUT > 0 else sys.maxsize
+    return get_backend(backend).diff(text1, text2, deadline, semantic)
+
+
+def diff_html(text1, text2, semantic=False, use_cache=True):
+    """Returns the diff of both texts as html.
+
+    semantic: Make the diff human readable instead of minimal.
+    use_cache: Cache the diff. Diffs which are unlikely to be requested
+        again, like the ones of the edit preview, shouldn't fill the cache.
+    """
+    if not use_cache:
+        return dmp.diff_prettyHtml(get_diffs(text1, text2, semantic))
+
+    key = 'wiki-diff-%s' % hashlib.sha1('\0'.join(
+        (BACKEND, str(semantic), text1, text2)).encode('utf-8')).hexdigest()
+    html = cache.get(key)
+    if html is None:
+        html = dmp.diff_prettyHtml(get_diffs(text1, text2, semantic))
+        cache.set(key, html, CACHE_TIMEOUT)
+    return html
@@ -2,6 +2,7 @@
 import re
 
 from django import forms
+from django.db import transaction
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 
@@ -93,23 +94,26 @@ class ArticleForm(forms.ModelForm):
         # 0 - Extra data
         comment = self.cleaned_data['comment']
 
-        # 2 - Save the Article
-        article = super(ArticleForm, self).save(*args, **kwargs)
-
-        # 3 - Set creator and group
-        editor = getattr(self, 'editor', None)
-        group = getattr(self, 'group', None)
-        if self.is_new:
-            if editor is not None:
-                article.creator = editor
-                article.group = group
-            article.save(*args, **kwargs)
-            if notification:
-                notification.observe(article, editor, 'wiki_observed_article_changed')
-
-        # 4 - Create new revision
-        changeset = article.new_revision(
-            self.old_content, self.old_title, self.old_markup,
-            comment, editor)
+        # The content is committed together with its revision, otherwise
+        # the revisions could be rebuilt from a content without its patch
+        with transaction.atomic():
+            # 2 - Save the Article
+            article = super(ArticleForm, self).save(*args, **kwargs)
+
+            # 3 - Set creator and group
+            editor = getattr(self, 'editor', None)
+            group = getattr(self, 'group', None)
+            if self.is_new:
+                if editor is not None:
+                    article.creator = editor
+                    article.group = group
+                article.save(*args, **kwargs)
+                if notification:
+                    notification.observe(article, editor, 'wiki_observed_article_changed')
+
+            # 4 - Create new revision
+            changeset = article.new_revision(
+                self.old_content, self.old_title, self.old_markup,
+                comment, editor)
 
         return article, changeset
@@ -0,0 +1,83 @@
+import random
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from wiki import diff
+from wiki.models import Article
+
+
+class Command(BaseCommand):
+    help = 'Measure the time needed to diff a big wiki page with the diff ' \
+           'backends'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=100000,
+                            help='Size of the page in characters')
+        parser.add_argument('--changes', type=int, default=20,
+                            help='Number of changed lines')
+        parser.add_argument('--rewrite', type=int, default=0,
+                            help='Size of a rewritten block of lines in '
+                                 'characters')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Take the best of this many runs')
+
+    def _page(self, size):
+        """Concatenate the longest articles, or generated text if there are
+        not enough."""
+        lines = []
+        length = 0
+        for content in Article.objects.order_by('-id').values_list(
+                'content', flat=True).iterator():
+            for line in content.splitlines():
+                lines.append(line)
+                length += len(line) + 1
+                if length >= size:
+                    return lines
+        rand = random.Random(1)
+        words = ['widelands', 'economy', 'soldiers', 'ware', 'building',
+                 'the', 'a', 'of', 'and', 'map', 'tribe', 'worker']
+        while length < size:
+            line = ' '.join(rand.choice(words) for i in range(rand.randint(0, 15)))
+            lines.append(line)
+            length += len(line) + 1
+        return lines
+
+    def handle(self, *args, **options):
+        lines = self._page(options['size'])
+        old = '\n'.join(lines)
+
+        rand = random.Random(2)
+        for i in range(options['changes']):
+            pos = rand.randrange(len(lines))
+            action = rand.choice(('change', 'insert', 'delete'))
+            if action == 'change':
+                lines[pos] = lines[pos].replace('a', 'o', 2) + ' edited'
+            elif action == 'insert':
+                lines.insert(pos, 'A new line number {}'.format(i))
+            else:
+                del lines[pos]
+        # Rewrite a section, e.g. a reformatted table
+        pos = rand.randrange(len(lines))
+        length = 0
+        while length < options['rewrite'] and pos < len(lines):
+            length += len(lines[pos])
+            lines[pos] = ' '.join(reversed(lines[pos].split()))
+            pos += 1
+        new = '\n'.join(lines)
+
+        self.stdout.write('Page of {} characters with {} changed lines and '
+                          '{} rewritten characters, timeout {} s'.format(
+                              len(old), options['changes'], options['rewrite'],
+                              diff.TIMEOUT))
+        for backend in ('wiki.diff.CharacterDiff', 'wiki.diff.LineDiff'):
+            def run():
+                return diff.get_diffs(old, new, semantic=True, backend=backend)
+
+            diffs = run()
+            seconds = min(timeit.repeat(run, number=1,
+                                        repeat=options['repeat']))
+            changed = sum(len(text) for op, text in diffs
+                          if op != diff.dmp.DIFF_EQUAL)
+            self.stdout.write('{:<25} {:9.1f} ms, {} changed characters'.format(
+                backend.rsplit('.', 1)[1], seconds * 1000, changed))
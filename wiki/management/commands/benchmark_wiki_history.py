@@ -0,0 +1,57 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from wiki import revision_cache
+from wiki.models import Article, ChangeSet, dmp
+
+
+class Command(BaseCommand):
+    help = 'Measure the time needed to rebuild the oldest revisions of the ' \
+           'wiki articles with the longest history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--articles', type=int, default=5,
+                            help='Number of articles with the most revisions')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Take the best of this many runs')
+
+    def handle(self, *args, **options):
+        articles = Article.objects.annotate(
+            nr_revisions=Count('changeset')).filter(
+            nr_revisions__gt=0).order_by('-nr_revisions')[:options['articles']]
+        if not articles:
+            self.stdout.write('No articles found')
+            return
+
+        self.stdout.write('{:<30} {:>9} {:>9} {:>14} {:>14} {:>14}'.format(
+            'Article', 'Revisions', 'Snapshots', 'All patches', 'Snapshots',
+            'Cached'))
+        for article in articles:
+            oldest = article.changeset_set.order_by('revision').first()
+
+            def all_patches():
+                # Like ChangeSet.get_content() without snapshots
+                content = article.content
+                for content_diff in ChangeSet.objects.filter(
+                        article=article, revision__gt=oldest.revision).order_by(
+                        '-revision').values_list('content_diff', flat=True):
+                    content = dmp.patch_apply(
+                        dmp.patch_fromText(content_diff), content)[0]
+                return content
+
+            def snapshots():
+                revision_cache.clear()
+                return oldest.get_content()
+
+            if all_patches() != snapshots():
+                self.stderr.write('Snapshots of {} differ, recreate them with '
+                                  'wiki_create_snapshots --clear'.format(article))
+
+            times = [min(timeit.repeat(func, number=1, repeat=options['repeat']))
+                     for func in (all_patches, snapshots, oldest.get_content)]
+            self.stdout.write(
+                '{:<30} {:>9} {:>9} {:>11.1f} ms {:>11.1f} ms {:>11.1f} ms'.format(
+                    article.title[:30], article.nr_revisions,
+                    article.snapshots.count(), *[t * 1000 for t in times]))
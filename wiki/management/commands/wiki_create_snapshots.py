@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from wiki.models import Article, ContentSnapshot, dmp, needs_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Create the missing content snapshots of wiki articles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--article', dest='title',
+                            help='Only handle the article with this title')
+        parser.add_argument('--clear', action='store_true',
+                            help='Recreate existing snapshots')
+
+    def handle(self, *args, **options):
+        articles = Article.objects.all()
+        if options['title']:
+            articles = articles.filter(title=options['title'])
+
+        created = 0
+        for article in articles.iterator():
+            with transaction.atomic():
+                if options['clear']:
+                    article.snapshots.all().delete()
+                created += self._create_snapshots(article)
+        self.stdout.write('Created {} snapshots'.format(created))
+
+    def _create_snapshots(self, article):
+        changesets = list(article.changeset_set.order_by(
+            'revision').values_list('revision', 'content_diff'))
+        existing = set(article.snapshots.values_list('revision', flat=True))
+
+        # Same rule as in Article.new_revision()
+        missing = set()
+        revisions = patch_size = 0
+        for revision, content_diff in changesets:
+            revisions += 1
+            patch_size += len(content_diff)
+            if revision in existing or needs_snapshot(revisions, patch_size):
+                if revision not in existing:
+                    missing.add(revision)
+                revisions = patch_size = 0
+        if not missing:
+            return 0
+
+        # Rebuild all revisions in one pass, starting with the newest
+        snapshots = []
+        content = article.content
+        for revision, content_diff in reversed(changesets):
+            if revision in missing:
+                snapshots.append(ContentSnapshot(
+                    article=article, revision=revision, content=content))
+            content = dmp.patch_apply(dmp.patch_fromText(content_diff),
+                                      content)[0]
+        ContentSnapshot.objects.bulk_create(snapshots)
+        return len(snapshots)
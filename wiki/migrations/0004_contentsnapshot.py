@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wiki', '0003_auto_20180918_0836'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContentSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('revision', models.IntegerField(verbose_name='Revision Number')),
+                ('content', models.TextField(verbose_name='Content')),
+                ('article', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='wiki.Article', verbose_name='Article')),
+            ],
+            options={
+                'verbose_name': 'Content snapshot',
+                'verbose_name_plural': 'Content snapshots',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='contentsnapshot',
+            unique_together=set([('article', 'revision')]),
+        ),
+    ]
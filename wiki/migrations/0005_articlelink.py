@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def extract_article_links(apps, schema_editor):
+    """Same as Article.update_links() for all articles."""
+    from wiki.utils import extract_links
+
+    Article = apps.get_model('wiki', 'Article')
+    ArticleLink = apps.get_model('wiki', 'ArticleLink')
+    for article in Article.objects.iterator():
+        ArticleLink.objects.bulk_create(
+            ArticleLink(source=article, target=target)
+            for target in extract_links(article.content) if len(target) <= 100)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wiki', '0004_contentsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArticleLink',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('target', models.CharField(db_index=True, max_length=100, verbose_name='Linked title')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outgoing_links', to='wiki.Article', verbose_name='Article')),
+            ],
+            options={
+                'verbose_name': 'Article link',
+                'verbose_name_plural': 'Article links',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='articlelink',
+            unique_together=set([('source', 'target')]),
+        ),
+        migrations.RunPython(extract_article_links, migrations.RunPython.noop),
+    ]
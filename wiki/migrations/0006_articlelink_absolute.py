@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations
+
+
+def extract_article_links(apps, schema_editor):
+    """Like 0005_articlelink, which missed absolute links to
+    widelands.org."""
+    from wiki.utils import extract_links
+
+    Article = apps.get_model('wiki', 'Article')
+    ArticleLink = apps.get_model('wiki', 'ArticleLink')
+    ArticleLink.objects.all().delete()
+    for article in Article.objects.iterator():
+        ArticleLink.objects.bulk_create(
+            ArticleLink(source=article, target=target)
+            for target in extract_links(article.content) if len(target) <= 100)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wiki', '0005_articlelink'),
+    ]
+
+    operations = [
+        migrations.RunPython(extract_article_links, migrations.RunPython.noop),
+    ]
@@ -4,8 +4,12 @@ from django.urls import reverse
 # Google Diff Match Patch library
 # http://code.google.com/p/google-diff-match-patch
 from .diff_match_patch import diff_match_patch
+from wiki import revision_cache
+from wiki.diff import diff_html
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Length
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
@@ -15,6 +19,7 @@ from django.contrib.contenttypes.fields import GenericRelation, GenericForeignKe
 from tagging.fields import TagField
 from tagging.models import Tag
 from wlimages.models import Image
+from wiki.utils import extract_links
 
 try:
     from notification import models as notification
@@ -31,6 +36,18 @@ def diff(txt1, txt2):
     patch = dmp.patch_make(txt1, txt2)
     return dmp.patch_toText(patch)
 
+# A full copy of the content is stored after this many revisions or if the
+# patches since the last copy got bigger than this number of characters. Old
+# revisions are rebuilt starting from the nearest copy.
+SNAPSHOT_INTERVAL = getattr(settings, 'WIKI_SNAPSHOT_INTERVAL', 50)
+SNAPSHOT_PATCH_SIZE = getattr(settings, 'WIKI_SNAPSHOT_PATCH_SIZE', 100000)
+
+
+def needs_snapshot(revisions, patch_size):
+    """Whether a snapshot should be stored after that many revisions with
+    patches of patch_size characters since the last snapshot."""
+    return revisions >= SNAPSHOT_INTERVAL or patch_size >= SNAPSHOT_PATCH_SIZE
+
 try:
     markup_choices = settings.WIKI_MARKUP_CHOICES
 except AttributeError:
@@ -79,6 +96,19 @@ class Article(models.Model):
     def save(self, *args, **kwargs):
         self.last_update = datetime.now()
         super(Article, self).save(*args, **kwargs)
+        self.update_links()
+
+    def update_links(self):
+        """Store the names of the articles this article links to."""
+        max_length = ArticleLink._meta.get_field('target').max_length
+        targets = set(name for name in extract_links(self.content)
+                      if len(name) <= max_length)
+        existing = set(self.outgoing_links.values_list('target', flat=True))
+        if existing - targets:
+            self.outgoing_links.filter(target__in=existing - targets).delete()
+        ArticleLink.objects.bulk_create(
+            ArticleLink(source=self, target=target)
+            for target in targets - existing)
 
     def latest_changeset(self):
         try:
@@ -104,6 +134,14 @@ class Article(models.Model):
             old_markup=old_markup,
             content_diff=content_diff)
 
+        last_snapshot = self.snapshots.order_by('-revision').values_list(
+            'revision', flat=True).first() or 0
+        since = self.changeset_set.filter(revision__gt=last_snapshot).aggregate(
+            revisions=Count('id'), patch_size=Sum(Length('content_diff')))
+        if needs_snapshot(since['revisions'], since['patch_size'] or 0):
+            ContentSnapshot.objects.create(
+                article=self, revision=cs.revision, content=self.content)
+
         return cs
 
     def revert_to(self, revision, editor=None):
@@ -191,33 +229,32 @@ class ChangeSet(models.Model):
 
         article = self.article
 
-        content = None
-        for changeset in next_changes:
-            if content is None:
-                content = article.content
-            patch = dmp.patch_fromText(changeset.content_diff)
-            content = dmp.patch_apply(patch, content)[0]
+        content = self.get_content()
+        # The old title and markup are stored in the following revision
+        changeset = next_changes.last()
 
-            changeset.reverted = True
-            changeset.save()
+        # Like in ArticleForm.save(), the content is committed together
+        # with its revision
+        with transaction.atomic():
+            next_changes.update(reverted=True)
 
-        old_content = article.content
-        old_title = article.title
-        old_markup = article.markup
+            old_content = article.content
+            old_title = article.title
+            old_markup = article.markup
 
-        article.content = content
-        article.title = changeset.old_title
-        article.markup = changeset.old_markup
-        article.save()
+            article.content = content
+            article.title = changeset.old_title
+            article.markup = changeset.old_markup
+            article.save()
 
-        article.new_revision(
-            old_content=old_content, old_title=old_title,
-            old_markup=old_markup,
-            comment='Reverted to revision #%s' % self.revision,
-            editor=editor
-            )
+            article.new_revision(
+                old_content=old_content, old_title=old_title,
+                old_markup=old_markup,
+                comment='Reverted to revision #%s' % self.revision,
+                editor=editor
+                )
 
-        self.save()
+            self.save()
 
         if None not in (notification, self.editor):
             notification.send([self.editor], 'wiki_revision_reverted',
@@ -235,13 +272,61 @@ class ChangeSet(models.Model):
         super(ChangeSet, self).save(*args, **kwargs)
 
     def get_content(self):
-        """Returns the content of this revision."""
-        content = self.article.content
+        """Returns the content of this revision.
+
+        The patches of the newer revisions are applied to the nearest
+        newer cached revision or snapshot, or to the current content if
+        there is none. All revisions passed on the way are cached.
+        """
+        content = revision_cache.get(self.article_id, self.revision)
+        if content is not None:
+            return content
+
         newer_changesets = ChangeSet.objects.filter(
-            article=self.article, revision__gt=self.revision).order_by('-revision')
-        for changeset in newer_changesets:
-            patches = dmp.patch_fromText(changeset.content_diff)
-            content = dmp.patch_apply(patches, content)[0]
+            article_id=self.article_id, revision__gt=self.revision)
+        snapshot = ContentSnapshot.objects.filter(
+            article_id=self.article_id, revision__gte=self.revision).order_by(
+            'revision').first()
+        # The result gets cached, so the current content has to match the
+        # patches even if the article was changed in the meantime. Edits
+        # commit the content together with its revision, but without
+        # snapshot isolation the content may still be newer than the
+        # newest revision read here. The result isn't cached then.
+        cacheable = True
+        with transaction.atomic():
+            if snapshot is None:
+                content, last_update = Article.objects.filter(
+                    pk=self.article_id).values_list(
+                    'content', 'last_update').get()
+                modified = ChangeSet.objects.filter(
+                    article_id=self.article_id).order_by(
+                    '-revision').values_list('modified', flat=True).first()
+                cacheable = None in (last_update, modified) or \
+                    last_update <= modified
+            else:
+                content = snapshot.content
+                newer_changesets = newer_changesets.filter(
+                    revision__lte=snapshot.revision)
+
+            # Newest first, content is the content after the revision of
+            # the first patch
+            patches = list(newer_changesets.order_by('-revision').values_list(
+                'revision', 'content_diff'))
+        for i in range(len(patches) - 1, -1, -1):
+            cached = revision_cache.get(self.article_id, patches[i][0])
+            if cached is not None:
+                content = cached
+                patches = patches[i:]
+                cacheable = True
+                break
+
+        for revision, content_diff in patches:
+            if cacheable:
+                revision_cache.set(self.article_id, revision, content)
+            patch = dmp.patch_fromText(content_diff)
+            content = dmp.patch_apply(patch, content)[0]
+        if cacheable:
+            revision_cache.set(self.article_id, self.revision, content)
         return content
 
     def compare_to(self, revision_from):
@@ -249,6 +334,49 @@ class ChangeSet(models.Model):
         if int(revision_from) > 0:
             other_content = ChangeSet.objects.filter(
                 article=self.article, revision__lte=revision_from).order_by('-revision')[0].get_content()
-        diffs = dmp.diff_main(other_content, self.get_content())
-        #dmp.diff_cleanupSemantic(diffs)
-        return dmp.diff_prettyHtml(diffs)
+        return diff_html(other_content, self.get_content())
+
+
+class ContentSnapshot(models.Model):
+    """The full content of an Article after a revision.
+
+    Stored every SNAPSHOT_INTERVAL revisions, so get_content() of a
+    ChangeSet has to apply only a few patches. Missing snapshots of
+    existing articles are created by './manage.py wiki_create_snapshots'.
+    """
+
+    article = models.ForeignKey(Article, related_name='snapshots',
+                                verbose_name=_('Article'))
+    revision = models.IntegerField(_('Revision Number'))
+    content = models.TextField(_('Content'))
+
+    class Meta:
+        verbose_name = _('Content snapshot')
+        verbose_name_plural = _('Content snapshots')
+        unique_together = ('article', 'revision')
+        app_label = 'wiki'
+
+    def __str__(self):
+        return '%s #%s' % (self.article, self.revision)
+
+
+class ArticleLink(models.Model):
+    """A link of an Article to another article, which may not exist.
+
+    Updated whenever an Article is saved. Used for the backlinks and the
+    wanted pages.
+    """
+
+    source = models.ForeignKey(Article, related_name='outgoing_links',
+                               verbose_name=_('Article'))
+    target = models.CharField(_('Linked title'), max_length=100,
+                              db_index=True)
+
+    class Meta:
+        verbose_name = _('Article link')
+        verbose_name_plural = _('Article links')
+        unique_together = ('source', 'target')
+        app_label = 'wiki'
+
+    def __str__(self):
+        return '%s -> %s' % (self.source, self.target)
@@ -0,0 +1,60 @@
+"""Cache of the content of old revisions of wiki articles.
+
+Rebuilding an old revision means applying patches, which is done on every
+request of the history, diff and revert views. The content of a revision
+never changes, so it is kept in memory of the process, keyed by article id
+and revision. When the cache gets bigger than WIKI_REVISION_CACHE_SIZE
+bytes, the least recently used revisions are dropped.
+
+"""
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+MAX_SIZE = getattr(settings, 'WIKI_REVISION_CACHE_SIZE', 32 * 1024 * 1024)
+
+_lock = threading.Lock()
+# (article id, revision): (content, size in bytes)
+_contents = OrderedDict()
+_size = 0
+
+
+def get(article_id, revision):
+    """Returns the cached content or None."""
+    key = (article_id, revision)
+    with _lock:
+        if key not in _contents:
+            return None
+        _contents.move_to_end(key)
+        return _contents[key][0]
+
+
+def set(article_id, revision, content):
+    global _size
+
+    size = len(content.encode('utf-8'))
+    if size > MAX_SIZE:
+        return
+    key = (article_id, revision)
+    with _lock:
+        if key in _contents:
+            _size -= _contents.pop(key)[1]
+        _contents[key] = (content, size)
+        _size += size
+        while _size > MAX_SIZE:
+            _size -= _contents.popitem(last=False)[1][1]
+
+
+def clear():
+    global _size
+
+    with _lock:
+        _contents.clear()
+        _size = 0
+
+
+def size():
+    """Returns the size of the cached contents in bytes."""
+    return _size
@@ -0,0 +1,225 @@
+from io import StringIO
+from unittest import mock
+
+from django.test import TestCase as DjangoTest
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from wiki import diff, models as wiki_models, revision_cache
+from wiki.models import Article, ArticleLink, ChangeSet, ContentSnapshot
+
+
+class TestWiki_Snapshots(DjangoTest):
+
+    def setUp(self):
+        self._interval = wiki_models.SNAPSHOT_INTERVAL
+        wiki_models.SNAPSHOT_INTERVAL = 5
+        revision_cache.clear()
+        self.article = Article.objects.create(title='Article', content='')
+        self.contents = []
+        for i in range(23):
+            self._edit('\n'.join('Line {} of revision {}'.format(j, i)
+                                 for j in range(i % 7 + 1)))
+
+    def tearDown(self):
+        wiki_models.SNAPSHOT_INTERVAL = self._interval
+        revision_cache.clear()
+
+    def _edit(self, content):
+        old_content = self.article.content
+        self.article.content = content
+        self.article.save()
+        self.article.new_revision(old_content, self.article.title, None,
+                                  'Edit', None)
+        self.contents.append(content)
+
+    def _assert_contents(self):
+        for changeset in ChangeSet.objects.filter(article=self.article):
+            self.assertEqual(self.contents[changeset.revision - 1],
+                             changeset.get_content())
+
+    def test_NewRevision_ExceptSnapshotEveryInterval(self):
+        self.assertEqual([5, 10, 15, 20], list(
+            self.article.snapshots.order_by('revision').values_list(
+                'revision', flat=True)))
+        self._assert_contents()
+
+    def test_GetContent_ExceptPatchesUpToNearestSnapshot(self):
+        revision_cache.clear()
+        changeset = ChangeSet.objects.get(article=self.article, revision=1)
+        with CaptureQueriesContext(connection) as queries:
+            changeset.get_content()
+        patches = [q['sql'] for q in queries.captured_queries
+                   if 'content_diff' in q['sql']]
+        self.assertEqual(1, len(patches))
+        self.assertIn('"wiki_changeset"."revision" <= 5', patches[0])
+
+    def test_GetContent_ExceptNewerRevisionsCached(self):
+        revision_cache.clear()
+        ChangeSet.objects.get(article=self.article, revision=7).get_content()
+        with CaptureQueriesContext(connection) as queries:
+            for revision in range(7, 11):
+                self.assertEqual(self.contents[revision - 1], ChangeSet(
+                    article_id=self.article.pk, revision=revision).get_content())
+        self.assertEqual(0, len(queries))
+
+        # Rebuilding revision 6 starts at the cached revision 7
+        with mock.patch.object(wiki_models.dmp, 'patch_apply',
+                               wraps=wiki_models.dmp.patch_apply) as patch_apply:
+            self.assertEqual(self.contents[5], ChangeSet.objects.get(
+                article=self.article, revision=6).get_content())
+        self.assertEqual(1, patch_apply.call_count)
+        self.assertIsNone(revision_cache.get(self.article.pk, 11))
+
+    def test_GetContent_ContentNewerThanRevision_ExceptNotCached(self):
+        revision_cache.clear()
+        # Like an edit whose revision isn't visible yet
+        self.article.content = 'Content of the next revision'
+        self.article.save()
+        changeset = ChangeSet.objects.get(article=self.article, revision=22)
+        changeset.get_content()
+        self.assertIsNone(revision_cache.get(self.article.pk, 22))
+        self.assertIsNone(revision_cache.get(self.article.pk, 23))
+
+        self.article.new_revision(self.contents[-1], self.article.title, None,
+                                  'Edit', None)
+        self.contents.append(self.article.content)
+        changeset.get_content()
+        self.assertEqual(self.contents[21],
+                         revision_cache.get(self.article.pk, 22))
+
+    def test_RevisionCache_ExceptLeastRecentlyUsedEvicted(self):
+        revision_cache.clear()
+        max_size = revision_cache.MAX_SIZE
+        revision_cache.MAX_SIZE = 10
+        try:
+            revision_cache.set(1, 1, 'aaaa')
+            revision_cache.set(1, 2, 'bbbb')
+            revision_cache.get(1, 1)
+            revision_cache.set(1, 3, 'cccc')
+            self.assertEqual('aaaa', revision_cache.get(1, 1))
+            self.assertIsNone(revision_cache.get(1, 2))
+            self.assertEqual(8, revision_cache.size())
+            # Too big to be cached at all
+            revision_cache.set(1, 4, 'd' * 11)
+            self.assertIsNone(revision_cache.get(1, 4))
+        finally:
+            revision_cache.MAX_SIZE = max_size
+
+    def test_CreateSnapshots_ExceptSameSnapshots(self):
+        expected = list(ContentSnapshot.objects.order_by('revision').values_list(
+            'revision', 'content'))
+        ContentSnapshot.objects.all().delete()
+        call_command('wiki_create_snapshots', stdout=StringIO())
+        self.assertEqual(expected, list(ContentSnapshot.objects.order_by('revision').values_list(
+            'revision', 'content')))
+        self._assert_contents()
+
+    def test_Revert_ExceptOldContent(self):
+        ChangeSet.objects.get(article=self.article, revision=3).reapply(None)
+        self.assertEqual(self.contents[2],
+                         Article.objects.get(pk=self.article.pk).content)
+        self.assertEqual(20, ChangeSet.objects.filter(
+            article=self.article, reverted=True).count())
+
+
+class TestWiki_Links(DjangoTest):
+
+    def _article(self, title, content):
+        return Article.objects.create(title=title, content=content)
+
+    def test_Save_ExceptLinksUpdated(self):
+        article = self._article(
+            'Source', '[[ Target ]] [Link](/wiki/Other%20Page#top) '
+                      '[[ http://example.com ]] [List](/wiki/list/)')
+        self.assertEqual({'Target', 'Other Page'}, set(
+            article.outgoing_links.values_list('target', flat=True)))
+
+        article.content = '[[ Target | Text ]] [[ New ]]'
+        article.save()
+        self.assertEqual({'Target', 'New'}, set(
+            article.outgoing_links.values_list('target', flat=True)))
+
+    def test_AbsoluteLinks_ExceptWidelandsOrgOnly(self):
+        article = self._article(
+            'Source', '[One](https://www.widelands.org/wiki/First%20Page) '
+                      '<a href="http://widelands.org/wiki/Second/">Two</a> '
+                      '[Other](https://example.com/wiki/Third)')
+        self.assertEqual({'First Page', 'Second'}, set(
+            article.outgoing_links.values_list('target', flat=True)))
+
+    def test_Backlinks_ExceptLinkingArticlesOnly(self):
+        target = self._article('Target', 'Text')
+        target.title = 'Renamed'
+        target.save()
+        target.new_revision('Text', 'Target', None, 'Rename', None)
+        self._article('Current', '[[ Renamed ]]')
+        self._article('Old', '[Link](/wiki/Target)')
+        self._article('Unrelated', 'Renamed Target')
+
+        url = reverse('backlinks', args=['Renamed'])
+        response = self.client.get(url)
+        self.assertEqual([{'title': 'Current'}], response.context['found_links'])
+        self.assertEqual([{'old_title': 'Target', 'title': 'Old'}],
+                         response.context['found_old_links'])
+
+        # Other articles are not loaded
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(url)
+        for i in range(5):
+            self._article('More{}'.format(i), '[[ Renamed ]]')
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(url)
+        self.assertEqual(len(few), len(many))
+
+    def test_WantedPages_ExceptMissingTargetsOnly(self):
+        self._article('Existing', '[[ Missing ]]')
+        self._article('Other', '[[ Existing ]] [[ Missing ]] [[ Gone ]]')
+        response = self.client.get(reverse('wiki_wanted'))
+        self.assertEqual([('Missing', ['Existing', 'Other']),
+                          ('Gone', ['Other'])], response.context['wanted'])
+
+
+class TestWiki_Diff(DjangoTest):
+
+    def setUp(self):
+        lines = ['Line {} of a long article about the economy'.format(i)
+                 for i in range(2000)]
+        self.old = '\n'.join(lines)
+        lines[10] = 'Line 10 of a short article about the economy'
+        lines[500:520] = [' '.join(reversed(line.split()))
+                          for line in lines[500:520]]
+        del lines[1000:1010]
+        lines.insert(1500, 'A new line')
+        self.new = '\n'.join(lines)
+
+    def _assert_valid(self, diffs):
+        self.assertEqual(self.old, diff.dmp.diff_text1(diffs))
+        self.assertEqual(self.new, diff.dmp.diff_text2(diffs))
+
+    def test_Backends_ExceptSameTexts(self):
+        for backend in ('wiki.diff.CharacterDiff', 'wiki.diff.LineDiff'):
+            self._assert_valid(diff.get_diffs(
+                self.old, self.new, semantic=True, backend=backend))
+
+    def test_LineDiff_ExceptChangedCharactersOnly(self):
+        diffs = diff.get_diffs(self.old, self.new, semantic=True)
+        self.assertIn((diff.dmp.DIFF_DELETE, 'long'), diffs)
+        self.assertIn((diff.dmp.DIFF_INSERT, 'short'), diffs)
+
+    def test_Timeout_ExceptValidDiff(self):
+        with mock.patch.object(diff, 'TIMEOUT', 0.0001):
+            self._assert_valid(diff.get_diffs(self.old, self.new))
+
+    def test_DiffHtml_ExceptCached(self):
+        html = diff.diff_html(self.old, self.new)
+        with mock.patch.object(diff, 'get_diffs') as get_diffs:
+            self.assertEqual(html, diff.diff_html(self.old, self.new))
+        self.assertFalse(get_diffs.called)
+
+    def test_DiffHtmlWithoutCache_ExceptNothingCached(self):
+        with mock.patch.object(diff.cache, 'set') as cache_set:
+            diff.diff_html(self.old, self.new, use_cache=False)
+        self.assertFalse(cache_set.called)
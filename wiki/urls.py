@@ -22,6 +22,8 @@ urlpatterns = [
 
     url(r'^history/$', views.history, name='wiki_history'),
 
+    url(r'^wanted/$', views.wanted_pages, name='wiki_wanted'),
+
     # Feeds
     url(r'^feeds/rss/$', RssHistoryFeed(), name='wiki_history_feed_rss'),
     url(r'^feeds/atom/$', AtomHistoryFeed(), name='wiki_history_feed_atom'),
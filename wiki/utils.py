@@ -1,10 +1,51 @@
 # -*- coding: utf-8 -*-
 """Some util functions."""
+import re
+import urllib.parse
+
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 
+from markdownextensions.semanticwikilinks.mdx_semanticwikilinks import WIKILINK_RE
+
 
 def get_ct(obj):
     """Return the ContentType of the object's model."""
     return ContentType.objects.get(app_label=obj._meta.app_label,
                                    model=obj._meta.module_name)
+
+
+# Names after /wiki/ which are no articles
+SPECIAL_PAGES = ['list', 'search', 'history', 'feeds', 'observe', 'edit',
+                 'preview', 'diff', 'backlinks', 'wanted']
+
+# Links in markdown syntax like [Foo](/wiki/FooBar) or [Foo]: /wiki/FooBar
+# and in html, also absolute ones like https://www.widelands.org/wiki/FooBar
+_markdown_link_re = re.compile(
+    r"""(?:\]\(\s*|^\s*\[[^\]]+\]:\s*|href=["'])"""
+    r"""(?:https?://(?:www\.)?widelands\.org)?/wiki/([^\s)"'#?]+)""",
+    re.MULTILINE)
+_wikilink_re = re.compile(WIKILINK_RE, re.X)
+
+
+def _article_name(target):
+    """Return the article name of a link target PageName[/additional/stuff]"""
+    name = target.split('#', 1)[0].split('?', 1)[0].split('/', 1)[0]
+    return urllib.parse.unquote(name).strip()
+
+
+def extract_links(content):
+    """Return the set of article names the content links to.
+
+    Handles semantic wiki links like [[ Page Name | Text ]] and links to
+    /wiki/PageName in markdown or html.
+    """
+    names = set()
+    for match in _wikilink_re.finditer(content):
+        target = match.group('target')
+        if '://' not in target:
+            names.add(_article_name(target))
+    for match in _markdown_link_re.finditer(content):
+        names.add(_article_name(match.group(1)))
+    names.discard('')
+    return set(name for name in names if name not in SPECIAL_PAGES)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
 from datetime import datetime
 
 from django.conf import settings
@@ -13,7 +14,8 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib import messages
 
 from wiki.forms import ArticleForm
-from wiki.models import Article, ChangeSet, dmp
+from wiki.models import Article, ArticleLink, ChangeSet
+from wiki.diff import diff_html
 
 from wiki.utils import get_ct
 from django.contrib.auth.decorators import login_required
@@ -23,8 +25,6 @@ from markdownextensions.semanticwikilinks.mdx_semanticwikilinks import WIKILINK_
 from mainpage.wl_utils import get_real_ip
 from mainpage.wl_utils import get_valid_cache_key
 
-import re
-import urllib.request, urllib.parse, urllib.error
 
 # Settings
 #  lock duration in minutes
@@ -627,10 +627,10 @@ def article_diff(request):
         Article, pk=int(request.POST['article']))
     content = request.POST['body']
 
-    diffs = dmp.diff_main(current_article.content, content)
-    dmp.diff_cleanupSemantic(diffs)
-
-    return HttpResponse(dmp.diff_prettyHtml(diffs), content_type='text/html')
+    # Each preview has a different content, so it isn't cached
+    return HttpResponse(diff_html(current_article.content, content,
+                                  semantic=True, use_cache=False),
+                        content_type='text/html')
 
 
 def backlinks(request, title):
@@ -640,36 +640,22 @@ def backlinks(request, title):
 
     # Find old title(s) of this article
     this_article = get_object_or_404(Article, title=title)
-    changesets = this_article.changeset_set.all()
-    old_titles = []
-    for cs in changesets:
-        if cs.old_title and cs.old_title != title and cs.old_title not in old_titles:
-            old_titles.append(cs.old_title)
-
-    # Search for semantic wiki links. The regexpr was copied from there
-    # and slightly modified
-    search_title = [re.compile(r"\[\[\s*(%s)/?\s*(\|\s*.+?\s*)?\]\]" % title)]
+    old_titles = set(this_article.changeset_set.exclude(
+        old_title__in=['', title]).values_list('old_title', flat=True))
 
-    # Search for links in MarkDown syntax, like [Foo](wiki/FooBar)
-    # The regexpr matches the title between '/' and ')'
-    search_title.append(re.compile(r"\/%s\)" % title))
+    links = ArticleLink.objects.filter(
+        target__in=old_titles | {title}).exclude(
+        source=this_article).order_by('source__title').values_list(
+        'target', 'source__title')
 
-    # Search for current and previous titles
-    found_old_links = []
     found_links = []
-    articles_all = Article.objects.all().exclude(title=title)
-    for article in articles_all:
-        for regexp in search_title:
-            # Need to unqoute the content to match
-            # e.g. [[ Back | Title%20of%20Page ]]
-            match = regexp.search(urllib.parse.unquote(article.content))
-            if match:
-                found_links.append({'title': article.title})
-
-        for old_title in old_titles:
-            if old_title in article.content:
-                found_old_links.append(
-                    {'old_title': old_title, 'title': article.title })
+    found_old_links = []
+    for target, source_title in links:
+        if target == title:
+            found_links.append({'title': source_title})
+        else:
+            found_old_links.append(
+                {'old_title': target, 'title': source_title})
 
     context = {'found_links': found_links,
                'found_old_links': found_old_links,
@@ -678,3 +664,20 @@ def backlinks(request, title):
                }
     return render(request, 'wiki/backlinks.html',
                               context,)
+
+
+def wanted_pages(request):
+    """List links to articles which don't exist."""
+
+    links = ArticleLink.objects.exclude(
+        target__in=Article.objects.values('title')).exclude(
+        target__in=ChangeSet.objects.values('old_title')).order_by(
+        'target', 'source__title').values_list('target', 'source__title')
+
+    wanted = OrderedDict()
+    for target, source_title in links:
+        wanted.setdefault(target, []).append(source_title)
+
+    return render(request, 'wiki/wanted_pages.html',
+                  {'wanted': sorted(wanted.items(),
+                                    key=lambda item: -len(item[1]))})
@@ -2,7 +2,7 @@
 # encoding: utf-8
 #
 
-from .models import Map
+from .models import Map, MapInfo, MapUpload
 from django.contrib import admin
 
 def delete_selected(modeladmin, request, queryset):
@@ -23,7 +23,7 @@ class MapAdmin(admin.ModelAdmin):
     prepopulated_fields = {'slug': ('name',)}
     search_fields = ['name', 'author']
     list_filter = ['pub_date']
-    readonly_fields = ('uploader', 'nr_players', 'w', 'h', 'minimap', 'file', 'world_name')
+    readonly_fields = ('uploader', 'nr_players', 'w', 'h', 'minimap', 'file', 'world_name', 'sha256')
     fieldsets = (
         (None, {
             'fields': (('name', 'author'), 'uploader', 'uploader_comment', 'wl_version_after')
@@ -36,7 +36,22 @@ class MapAdmin(admin.ModelAdmin):
         }),
         ('Upload information', {
             'classes': ('collapse',),
-            'fields': ('minimap', 'file', 'pub_date', 'nr_downloads', 'slug')
+            'fields': ('minimap', 'file', 'sha256', 'pub_date', 'nr_downloads', 'slug')
         }),
     )
 admin.site.register(Map, MapAdmin)
+
+
+class MapUploadAdmin(admin.ModelAdmin):
+    list_display = ['file', 'uploader', 'created', 'status', 'map']
+    list_filter = ['status']
+    readonly_fields = ('file', 'sha256', 'uploader', 'created', 'started',
+                       'map')
+admin.site.register(MapUpload, MapUploadAdmin)
+
+
+class MapInfoAdmin(admin.ModelAdmin):
+    list_display = ['sha256', 'created']
+    search_fields = ['sha256']
+    readonly_fields = ('sha256', 'data', 'minimap', 'created')
+admin.site.register(MapInfo, MapInfoAdmin)
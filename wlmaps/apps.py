@@ -11,3 +11,8 @@ class WlMapsConfig(AppConfig):
         from wlmaps.management import create_notice_types
         signals.post_migrate.connect(create_notice_types, sender=self)
 
+        from wlmaps.catalogue import invalidate_facets
+        Map = self.get_model('Map')
+        signals.post_save.connect(invalidate_facets, sender=Map)
+        signals.post_delete.connect(invalidate_facets, sender=Map)
+
@@ -0,0 +1,174 @@
+"""Browsing the maps by filters.
+
+The maps can be filtered by the number of players, the size, the world,
+the Widelands version they need and the uploader. The results are sorted
+by date and paginated by keyset: the cursor of the next page is the date
+and id of the last map on the page, so no page needs an OFFSET.
+
+For each filter the facets tell how many maps match each value, given the
+other filters. They are cached until a map is published, changed or
+deleted.
+
+"""
+
+import hashlib
+import re
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, Count, IntegerField, Q, Sum, When
+
+from wlmaps.models import Map
+
+# Length of the longer side of a map: (more than, up to)
+SIZES = OrderedDict([
+    ('small', (0, 96)),
+    ('medium', (96, 160)),
+    ('large', (160, 256)),
+    ('huge', (256, None)),
+])
+
+FACETS = OrderedDict([
+    ('nr_players', 'Players'),
+    ('size', 'Size'),
+    ('world_name', 'World'),
+    ('wl_version_after', 'Needs version after'),
+    ('uploader', 'Uploader'),
+])
+
+# Value of the world filter for maps of the One World
+ONE_WORLD = 'one_world'
+# Number of uploaders in the facets
+MAX_UPLOADERS = 20
+
+FACETS_VERSION_KEY = 'wlmaps-facets-version'
+
+_cursor_re = re.compile(r'^(\d{20})\.(\d+)$')
+
+
+def size_q(size):
+    more_than, up_to = SIZES[size]
+    q = Q()
+    if up_to is not None:
+        q &= Q(w__lte=up_to, h__lte=up_to)
+    if more_than:
+        q &= Q(w__gt=more_than) | Q(h__gt=more_than)
+    return q
+
+
+def filter_q(filters, exclude=None):
+    """Returns the Q object for the filters, except for the filter named
+    exclude."""
+    q = Q()
+    for name in FACETS:
+        value = filters.get(name)
+        if name == exclude or value in (None, ''):
+            continue
+        if name == 'size':
+            q &= size_q(value)
+        elif name == 'world_name':
+            q &= Q(world_name='' if value == ONE_WORLD else value)
+        elif name == 'uploader':
+            q &= Q(uploader__username=value)
+        else:
+            q &= Q(**{name: value})
+    return q
+
+
+def make_cursor(map):
+    return '%s.%d' % (map.pub_date.strftime('%Y%m%d%H%M%S%f'), map.pk)
+
+
+def parse_cursor(cursor):
+    """Returns (pub_date, id) of a cursor or None if it is invalid."""
+    match = _cursor_re.match(cursor)
+    if not match:
+        return None
+    try:
+        pub_date = datetime.strptime(match.group(1), '%Y%m%d%H%M%S%f')
+    except ValueError:
+        return None
+    return pub_date, int(match.group(2))
+
+
+def browse(filters, cursor=None, per_page=None):
+    """Returns the maps matching the filters which come after the cursor,
+    and the cursor of the next page or None."""
+    per_page = per_page or settings.MAPS_PER_PAGE
+    maps = Map.objects.filter(filter_q(filters)).select_related(
+        'uploader').order_by('-pub_date', '-id')
+    if cursor is not None:
+        pub_date, pk = cursor
+        maps = maps.filter(Q(pub_date__lt=pub_date) |
+                           Q(pub_date=pub_date, id__lt=pk))
+
+    # One more to know whether there is a next page
+    page = list(maps[:per_page + 1])
+    if len(page) > per_page:
+        return page[:per_page], make_cursor(page[per_page - 1])
+    return page, None
+
+
+def _count_facet(name, q):
+    maps = Map.objects.filter(q)
+    if name == 'size':
+        counts = maps.aggregate(**{
+            size: Sum(Case(When(size_q(size), then=1), default=0,
+                           output_field=IntegerField()))
+            for size in SIZES})
+        return [(size, counts[size]) for size in SIZES if counts[size]]
+
+    field = 'uploader__username' if name == 'uploader' else name
+    counts = maps.exclude(**{field + '__isnull': True}).order_by().values_list(
+        field).annotate(count=Count('id'))
+    if name == 'uploader':
+        return sorted(counts.order_by('-count', field)[:MAX_UPLOADERS],
+                      key=lambda item: item[0].lower())
+    if name == 'world_name':
+        return [(value or ONE_WORLD, count)
+                for value, count in counts.order_by(field)]
+    return list(counts.order_by(field))
+
+
+def _facets_key(filters):
+    version = cache.get_or_set(FACETS_VERSION_KEY, lambda: uuid.uuid4().hex,
+                               None)
+    # 0 is a valid value of wl_version_after
+    values = '\0'.join(
+        '%s=%s' % (name, '' if filters.get(name) is None else filters[name])
+        for name in FACETS)
+    return 'wlmaps-facets-%s-%s' % (
+        version, hashlib.sha1(values.encode('utf-8')).hexdigest())
+
+
+def get_facets(filters):
+    """Returns the number of matching maps and an OrderedDict with a list
+    of (value, number of maps) for each filter."""
+    key = _facets_key(filters)
+    result = cache.get(key)
+    if result is None:
+        facets = OrderedDict(
+            (name, _count_facet(name, filter_q(filters, exclude=name)))
+            for name in FACETS)
+        result = (Map.objects.filter(filter_q(filters)).count(), facets)
+        cache.set(key, result, settings.MAPS_FACETS_CACHE_TIMEOUT)
+    return result
+
+
+def invalidate_facets(update_fields=None, **kwargs):
+    """A map got published, changed or deleted.
+
+    The cache is cleared again after the commit, because other requests
+    may have cached the old state meanwhile.
+    """
+    if update_fields and not set(update_fields) & set(
+            ['nr_players', 'w', 'h', 'world_name', 'wl_version_after',
+             'uploader', 'pub_date']):
+        # E.g. the comment of the uploader changed
+        return
+    cache.delete(FACETS_VERSION_KEY)
+    transaction.on_commit(lambda: cache.delete(FACETS_VERSION_KEY))
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from wlmaps.uploads import process_pending
+
+
+class Command(BaseCommand):
+    help = 'Run wl_map_info for uploaded maps and publish them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wait', type=int, default=0, metavar='SECONDS',
+                            help='Keep running and look for new uploads '
+                                 'every SECONDS seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = process_pending()
+            if processed:
+                self.stdout.write('Processed {} uploads'.format(processed))
+            if not options['wait']:
+                break
+            time.sleep(options['wait'])
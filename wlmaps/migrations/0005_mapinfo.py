@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_map_files(apps, schema_editor):
+    Map = apps.get_model('wlmaps', 'Map')
+    for map in Map.objects.exclude(file='').only('file').iterator():
+        sha256 = hashlib.sha256()
+        try:
+            with open(map.file.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(64 * 1024), b''):
+                    sha256.update(chunk)
+        except OSError:
+            continue
+        Map.objects.filter(pk=map.pk).update(sha256=sha256.hexdigest())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wlmaps', '0004_mapupload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapInfo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('data', models.TextField()),
+                ('minimap', models.ImageField(upload_to='wlmaps/mapinfo', verbose_name='Minimap')),
+                ('created', models.DateTimeField(default=datetime.datetime.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='map',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='mapupload',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.RunPython(hash_map_files, migrations.RunPython.noop),
+    ]
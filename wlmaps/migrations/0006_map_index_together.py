@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('wlmaps', '0005_mapinfo'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='map',
+            index_together=set([('pub_date', 'id'), ('nr_players', 'pub_date'), ('world_name', 'pub_date'), ('wl_version_after', 'pub_date'), ('uploader', 'pub_date'), ('w', 'h')]),
+        ),
+    ]
@@ -9,6 +9,8 @@ from django.db.models.signals import pre_delete
 from django.conf import settings
 
 import datetime
+import hashlib
+import json
 import os
 try:
     from notification import models as notification
@@ -43,10 +45,21 @@ class Map(models.Model):
         verbose_name='WL version after',
         null=True,
         blank=True)
+    # SHA-256 of the map file
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)
 
     class Meta:
         ordering = ('-pub_date',)
         get_latest_by = 'pub_date'
+        # For the filters of wlmaps.catalogue, sorted by date
+        index_together = [
+            ('pub_date', 'id'),
+            ('nr_players', 'pub_date'),
+            ('world_name', 'pub_date'),
+            ('wl_version_after', 'pub_date'),
+            ('uploader', 'pub_date'),
+            ('w', 'h'),
+        ]
 
     def get_absolute_url(self):
         return reverse('wlmaps_view', kwargs={'map_slug': self.slug})
@@ -87,3 +100,79 @@ class Map(models.Model):
         self.minimap.delete()
         self.file.delete()
         super(Map, self).delete(*args, **kwargs)
+
+
+class MapUpload(models.Model):
+    """An uploaded map file waiting to be processed by wl_map_info.
+
+    The map is published by the workers in wlmaps/uploads.py. Failed
+    uploads keep the reason for the uploader.
+
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    PUBLISHED = 'published'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (PUBLISHED, 'Published'),
+        (FAILED, 'Failed'),
+    )
+
+    file = models.FileField(verbose_name='Mapfile',
+                            upload_to='wlmaps/uploads')
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)
+    uploader = models.ForeignKey(User)
+    uploader_comment = models.TextField(
+        verbose_name='Uploader comment', blank=True)
+    created = models.DateTimeField(default=datetime.datetime.now)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING)
+    started = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    map = models.ForeignKey(Map, null=True, blank=True,
+                            on_delete=models.SET_NULL)
+
+    class Meta:
+        ordering = ('-created',)
+        index_together = ('status', 'started')
+
+    def __str__(self):
+        return '%s by %s (%s)' % (os.path.basename(self.file.name),
+                                  self.uploader, self.status)
+
+    @property
+    def is_finished(self):
+        return self.status in (self.PUBLISHED, self.FAILED)
+
+
+class MapInfo(models.Model):
+    """The output of wl_map_info for a map file, identified by the SHA-256
+    of the file.
+
+    Processing the same file again, e.g. after the map was deleted, uses
+    this instead of running wl_map_info.
+
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    data = models.TextField()
+    minimap = models.ImageField(
+        verbose_name='Minimap', upload_to='wlmaps/mapinfo')
+    created = models.DateTimeField(default=datetime.datetime.now)
+
+    def __str__(self):
+        return '%s: %s' % (self.sha256, self.info['name'])
+
+    @property
+    def info(self):
+        """The json data created by wl_map_info."""
+        return json.loads(self.data)
+
+
+def file_sha256(file):
+    """Returns the SHA-256 of a django File."""
+    sha256 = hashlib.sha256()
+    for chunk in file.chunks():
+        sha256.update(chunk)
+    return sha256.hexdigest()
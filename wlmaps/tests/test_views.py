@@ -5,13 +5,20 @@
 from django.test import TestCase as DjangoTest, Client
 from django.urls import reverse
 from django.contrib.auth.models import User
+from django.test import override_settings
 # TODO(Franku): Not used, but should be replaced with python json because it gets removed in django 1.7
 #from django.utils import simplejson as json
 from wlmaps.models import *
+from wlmaps.uploads import claim, process_pending
+from wlmaps import catalogue
 
+import json
 import os
+import shutil
+import tempfile
 
 elven_forests = os.path.dirname(__file__) + '/data/Elven Forests.wmf'
+wl_map_info = os.path.dirname(__file__) + '/data/wl_map_info'
 
 ###########
 # Helpers #
@@ -29,6 +36,24 @@ class _LoginToSite(DjangoTest):
 
         self.user = u
 
+        # Process uploads with the stub of wl_map_info
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, WIDELANDS_SVN_DIR=self.media_root,
+            MAPS_WL_MAP_INFO=wl_map_info, MAPS_UPLOAD_WORKERS=1)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def _upload(self, path=elven_forests):
+        with open(path, 'rb') as f:
+            response = self.client.post(
+                reverse('wlmaps_upload'), {'file': f, 'test': True})
+        process_pending()
+        return response
+
 #############
 # TestCases #
 #############
@@ -40,13 +65,15 @@ class _LoginToSite(DjangoTest):
 class TestWLMaps_ValidUpload_ExceptCorrectResult(_LoginToSite):
 
     def runTest(self):
-        url = reverse('wlmaps_upload')
-        c = self.client.post(
-            url, {'file': open(elven_forests, 'rb'), 'test': True})
+        self._upload()
 
         o = Map.objects.get(pk=1)
         self.assertEqual(o.name, 'Elven Forests')
         self.assertEqual(o.author, 'Winterwind')
+        self.assertEqual(o.nr_players, 4)
+        self.assertEqual(o.uploader, self.user)
+        self.assertTrue(os.path.isfile(o.file.path))
+        self.assertTrue(os.path.isfile(o.minimap.path))
 
 
 class TestWLMaps_AnonUpload_ExceptRedirect(DjangoTest):
@@ -70,22 +97,110 @@ class TestWLMaps_UploadWithoutMap_ExceptError(_LoginToSite):
 class TestWLMaps_UploadTwice_ExceptCorrectResult(_LoginToSite):
 
     def runTest(self):
-        url = reverse('wlmaps_upload')
-        self.client.post(
-            url, {'file': open(elven_forests, 'rb'), 'test': True})
+        self._upload()
         self.assertEqual(len(Map.objects.all()), 1)
 
-        self.client.post(
-            url, {'file': open(elven_forests, 'rb'), 'test': True})
+        self._upload()
         self.assertEqual(len(Map.objects.all()), 1)
+        # Rejected without processing
+        self.assertEqual(1, MapUpload.objects.count())
 
 
 class TestWLMaps_UploadWithInvalidMap_ExceptError(_LoginToSite):
 
     def runTest(self):
-        url = reverse('wlmaps_upload')
-        self.client.post(url, {'file': open(__file__, 'rb'), 'test': True})
+        self._upload(__file__)
         self.assertEqual(len(Map.objects.all()), 0)
+        upload = MapUpload.objects.get()
+        self.assertEqual(MapUpload.FAILED, upload.status)
+        # The uploaded file is removed after processing
+        self.assertFalse(os.listdir(
+            os.path.join(self.media_root, 'wlmaps', 'uploads')))
+
+
+class TestWLMaps_UploadQueue(_LoginToSite):
+
+    def _post(self):
+        with open(elven_forests, 'rb') as f:
+            return self.client.post(reverse('wlmaps_upload'), {'file': f})
+
+    def test_Upload_ExceptPublishedByWorker(self):
+        response = self._post()
+        upload = MapUpload.objects.get()
+        status_url = reverse('wlmaps_upload_status', args=[upload.pk])
+        self.assertRedirects(response, status_url)
+        self.assertEqual(MapUpload.PENDING, upload.status)
+        self.assertFalse(Map.objects.exists())
+        self.assertContains(self.client.get(status_url), 'being processed')
+
+        self.assertEqual(1, process_pending())
+        map = Map.objects.get()
+        self.assertEqual(map, MapUpload.objects.get().map)
+        self.assertRedirects(self.client.get(status_url),
+                             map.get_absolute_url())
+
+    def test_Claim_ExceptEachUploadOnce(self):
+        self._post()
+        self.assertIsNotNone(claim())
+        self.assertIsNone(claim())
+
+    def test_Timeout_ExceptFailed(self):
+        self._post()
+        hanging = os.path.join(self.media_root, 'hanging_wl_map_info')
+        with open(hanging, 'w') as f:
+            f.write('#!/bin/sh\nexec sleep 10\n')
+        os.chmod(hanging, 0o755)
+        with self.settings(MAPS_WL_MAP_INFO=hanging, MAPS_UPLOAD_TIMEOUT=0.5):
+            process_pending()
+        upload = MapUpload.objects.get()
+        self.assertEqual(MapUpload.FAILED, upload.status)
+        self.assertEqual('Processing the map file took too long.', upload.error)
+
+    def test_TooManyPendingUploads_ExceptError(self):
+        with self.settings(MAPS_MAX_PENDING_UPLOADS=1):
+            self._post()
+            response = self._post()
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, MapUpload.objects.count())
+
+    def test_SameFile_ExceptRejectedBeforeProcessing(self):
+        self._post()
+        self.assertContains(self._post(), 'already being processed')
+        process_pending()
+        self.assertContains(self._post(), 'already been uploaded')
+        self.assertEqual(1, MapUpload.objects.count())
+
+    def test_KnownFile_ExceptMapInfoReused(self):
+        self._post()
+        process_pending()
+        self.assertEqual(1, MapInfo.objects.count())
+        Map.objects.get().delete()
+
+        self._post()
+        # wl_map_info isn't needed anymore
+        with self.settings(MAPS_WL_MAP_INFO='/nonexistent/wl_map_info'):
+            process_pending()
+        map = Map.objects.get()
+        self.assertEqual('Elven Forests', map.name)
+        self.assertTrue(os.path.isfile(map.minimap.path))
+        self.assertEqual(MapInfo.objects.get().sha256, map.sha256)
+
+    def test_KnownFileWithExistingName_ExceptRejected(self):
+        self._post()
+        process_pending()
+        # Another file of a map with this name
+        Map.objects.update(sha256='')
+        self.assertContains(self._post(), 'same name already exists')
+        self.assertEqual(1, MapUpload.objects.count())
+
+    def test_StatusOfOtherUser_Except404(self):
+        self._post()
+        self.client.logout()
+        User.objects.create_user('other', password='other')
+        self.client.login(username='other', password='other')
+        response = self.client.get(reverse(
+            'wlmaps_upload_status', args=[MapUpload.objects.get().pk]))
+        self.assertEqual(404, response.status_code)
 
 # Viewing
 
@@ -141,3 +256,204 @@ class TestWLMapsViews_Viewing(DjangoTest):
             reverse('wlmaps_view', args=('a-map-that-doesnt-exist',)))
         self.assertEqual(c.status_code, 404)
 
+
+
+# Downloading
+
+
+class TestWLMapsViews_Download(DjangoTest):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        os.makedirs(os.path.join(self.media_root, 'wlmaps', 'maps'))
+        self.data = bytes(range(256)) * 100
+        with open(os.path.join(self.media_root, 'wlmaps', 'maps', 'Map.wmf'), 'wb') as f:
+            f.write(self.data)
+
+        self.map = Map.objects.create(
+            name='Map', author='Author', w=128, h=64, nr_players=4,
+            descr='a good map to play with', minimap='wlmaps/minimaps/Map.png',
+            file='wlmaps/maps/Map.wmf',
+            uploader=User.objects.create(username='testuser'))
+        self.url = reverse('wlmaps_download', args=('map',))
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def _downloads(self):
+        return Map.objects.get(pk=self.map.pk).nr_downloads
+
+    def test_Download_ExceptStreamedFileAndCount(self):
+        response = self.client.get(self.url)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+        self.assertEqual(self.data, b''.join(response.streaming_content))
+        self.assertEqual(str(len(self.data)), response['Content-Length'])
+        self.assertEqual('attachment; filename="Map.wmf"',
+                         response['Content-Disposition'])
+        self.client.get(self.url)
+        self.assertEqual(2, self._downloads())
+
+    def test_Range_ExceptPartialContent(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(self.data[100:200], b''.join(response.streaming_content))
+        self.assertEqual('bytes 100-199/25600', response['Content-Range'])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(self.data[-10:], b''.join(response.streaming_content))
+        # Continued downloads are not counted
+        self.assertEqual(0, self._downloads())
+
+    def test_ETag_ExceptNotModified(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(1, self._downloads())
+
+        # Range of a changed file sends the whole file
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9',
+                                   HTTP_IF_RANGE='"other"')
+        self.assertEqual(200, response.status_code)
+
+    def test_WeakETag_ExceptNotModified(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='W/' + etag)
+        self.assertEqual(304, response.status_code)
+
+    def test_IfRangeDate_ExceptRangeOnlyIfUnchanged(self):
+        last_modified = self.client.get(self.url)['Last-Modified']
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199',
+                                   HTTP_IF_RANGE=last_modified)
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(self.data[100:200], b''.join(response.streaming_content))
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199',
+                                   HTTP_IF_RANGE='Sat, 01 Jan 2000 00:00:00 GMT')
+        self.assertEqual(200, response.status_code)
+
+        # If-Range needs a strong ETag
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199',
+                                   HTTP_IF_RANGE=etag)
+        self.assertEqual(206, response.status_code)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199',
+                                   HTTP_IF_RANGE='W/' + etag)
+        self.assertEqual(200, response.status_code)
+
+    def test_Sendfile_ExceptHeaderOnly(self):
+        with self.settings(SENDFILE_BACKEND='nginx', SENDFILE_URL='/protected/'):
+            response = self.client.get(self.url)
+        self.assertEqual('/protected/wlmaps/maps/Map.wmf',
+                         response['X-Accel-Redirect'])
+        self.assertEqual(b'', response.content)
+
+        with self.settings(SENDFILE_BACKEND='xsendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(self.map.file.path, response['X-Sendfile'])
+        self.assertEqual(2, self._downloads())
+
+    def test_SendfileRange_ExceptContinuedDownloadNotCounted(self):
+        with self.settings(SENDFILE_BACKEND='xsendfile'):
+            response = self.client.get(self.url, HTTP_RANGE='bytes=100-')
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(0, self._downloads())
+            self.client.get(self.url, HTTP_RANGE='bytes=0-99')
+        self.assertEqual(1, self._downloads())
+
+    def test_MissingFile_Except404(self):
+        os.remove(self.map.file.path)
+        self.assertEqual(404, self.client.get(self.url).status_code)
+        self.assertEqual(0, self._downloads())
+
+
+class TestWLMapsViews_Catalogue(DjangoTest):
+
+    def setUp(self):
+        self.user = User.objects.create(username='testuser')
+        self.other = User.objects.create(username='other')
+        self.maps = [
+            self._add_map('Small', 64, 64, 2, 'greenland', self.user),
+            self._add_map('Medium', 128, 96, 4, 'blackland', self.user),
+            self._add_map('Large', 200, 160, 4, '', self.other),
+            self._add_map('Huge', 512, 512, 8, '', self.other),
+        ]
+        self.url = reverse('wlmaps_catalogue')
+
+    def _add_map(self, name, w, h, nr_players, world_name, uploader):
+        return Map.objects.create(
+            name=name, author='Author', w=w, h=h, nr_players=nr_players,
+            descr='a map', minimap='wlmaps/minimaps/%s.png' % name,
+            world_name=world_name, uploader=uploader)
+
+    def _get(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(200, response.status_code)
+        return json.loads(response.content.decode('utf-8'))
+
+    def _names(self, data):
+        return [map['name'] for map in data['maps']]
+
+    def test_Filters_ExceptMatchingMaps(self):
+        self.assertEqual(['Large', 'Medium'], self._names(
+            self._get(nr_players=4)))
+        self.assertEqual(['Large'], self._names(self._get(size='large')))
+        self.assertEqual(['Huge', 'Large'], self._names(
+            self._get(world_name='one_world')))
+        self.assertEqual(['Medium'], self._names(
+            self._get(uploader='testuser', nr_players=4)))
+
+    def test_Facets_ExceptCountsForOtherFilters(self):
+        data = self._get(nr_players=4)
+        self.assertEqual(2, data['count'])
+        # All player counts are offered
+        self.assertEqual([[2, 1], [4, 2], [8, 1]],
+                         data['facets']['nr_players'])
+        self.assertEqual([['medium', 1], ['large', 1]], data['facets']['size'])
+        self.assertEqual([['one_world', 1], ['blackland', 1]],
+                         data['facets']['world_name'])
+        self.assertEqual([['other', 1], ['testuser', 1]],
+                         data['facets']['uploader'])
+
+    def test_KeysetPagination_ExceptAllMapsOnce(self):
+        names = []
+        after = None
+        with self.settings(MAPS_PER_PAGE=3):
+            while True:
+                data = self._get(after=after) if after else self._get()
+                names += self._names(data)
+                after = data['next']
+                if after is None:
+                    break
+        self.assertEqual(['Huge', 'Large', 'Medium', 'Small'], names)
+
+    def test_InvalidFilter_Except400(self):
+        self.assertEqual(400, self.client.get(
+            self.url, {'nr_players': 'many'}).status_code)
+        self.assertEqual(400, self.client.get(
+            self.url, {'after': 'garbage'}).status_code)
+
+    def test_FacetCache_ExceptInvalidatedOnUploadAndDelete(self):
+        catalogue.get_facets({})
+        with self.assertNumQueries(2):
+            # The version and the facets from the cache
+            catalogue.get_facets({})
+
+        self._add_map('New', 64, 64, 2, '', self.user)
+        self.assertEqual(5, self._get()['count'])
+        self.maps[0].delete()
+        self.assertEqual(4, self._get()['count'])
+
+    def test_FacetCache_VersionZero_ExceptOwnEntry(self):
+        Map.objects.filter(pk=self.maps[0].pk).update(wl_version_after=0)
+        self.assertEqual(4, catalogue.get_facets({})[0])
+        self.assertEqual(1, catalogue.get_facets({'wl_version_after': 0})[0])
+
+    def test_Index_ExceptFilteredPage(self):
+        response = self.client.get(reverse('wlmaps_index'), {'size': 'huge'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([self.maps[3]], response.context['maps'])
+        self.assertEqual(1, response.context['count'])
@@ -0,0 +1,212 @@
+"""Processing of uploaded maps.
+
+Uploading a map only stores the file as a MapUpload, so the request
+doesn't wait for wl_map_info. The management command process_map_uploads
+hands the pending uploads to MAPS_UPLOAD_WORKERS threads. Each of them
+runs wl_map_info on a copy of the map file in a temporary directory, which
+creates the json file with the map information and the minimap, and
+publishes the map.
+
+The output of wl_map_info is kept as MapInfo, keyed by the SHA-256 of the
+map file. Uploading a known file again reuses it without running
+wl_map_info.
+
+wl_map_info is run with WIDELANDS_SVN_DIR as working directory, so it finds
+the data directory, and is killed after MAPS_UPLOAD_TIMEOUT seconds.
+
+"""
+
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+
+from wlmaps.models import Map, MapInfo, MapUpload, file_sha256
+
+logger = logging.getLogger(__name__)
+
+
+class MapInfoError(Exception):
+    """The map can't be published. The message is shown to the
+    uploader."""
+
+
+def _claimable():
+    # The worker of a processing upload died if it takes much longer than
+    # the timeout of wl_map_info
+    stale = datetime.now() - timedelta(seconds=2 * settings.MAPS_UPLOAD_TIMEOUT)
+    return Q(status=MapUpload.PENDING) | Q(status=MapUpload.PROCESSING,
+                                           started__lt=stale)
+
+
+def claim():
+    """Returns the oldest pending upload marked as processing, None if
+    there is none.
+
+    The upload is marked with an UPDATE which checks again that it is still
+    pending, so each upload is claimed by only one worker.
+
+    """
+    while True:
+        upload = MapUpload.objects.filter(
+            _claimable()).order_by('id').first()
+        if upload is None:
+            return None
+        if MapUpload.objects.filter(_claimable(), pk=upload.pk).update(
+                status=MapUpload.PROCESSING, started=datetime.now()):
+            upload.refresh_from_db()
+            return upload
+
+
+def run_map_info(path):
+    """Runs wl_map_info for the map file at path, which creates path.json
+    and the minimap next to it. Returns the map information."""
+    try:
+        subprocess.run([settings.MAPS_WL_MAP_INFO, path],
+                       cwd=settings.WIDELANDS_SVN_DIR or None,
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                       timeout=settings.MAPS_UPLOAD_TIMEOUT, check=True)
+    except subprocess.CalledProcessError as e:
+        logger.info('wl_map_info failed for %s: %s', path,
+                    e.output.decode('utf-8', 'replace'))
+        raise MapInfoError('The map file could not be processed.')
+    except subprocess.TimeoutExpired:
+        logger.warning('wl_map_info timed out for %s', path)
+        raise MapInfoError('Processing the map file took too long.')
+
+    try:
+        with open(path + '.json', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        raise MapInfoError('The map file could not be processed.')
+
+
+def _store_map_info(sha256, path):
+    """Runs wl_map_info and returns the stored MapInfo."""
+    data = run_map_info(path)
+    mapinfo = MapInfo(sha256=sha256, data=json.dumps(data))
+    # data['minimap'] is the absolute path of the image file
+    with open(data['minimap'], 'rb') as f:
+        mapinfo.minimap.save(os.path.basename(data['minimap']), File(f),
+                             save=False)
+    try:
+        with transaction.atomic():
+            mapinfo.save()
+    except IntegrityError:
+        # Another worker processed the same file
+        mapinfo.minimap.delete(save=False)
+        mapinfo = MapInfo.objects.get(sha256=sha256)
+    return mapinfo
+
+
+def get_map_info(upload):
+    """Returns the MapInfo of the uploaded file, running wl_map_info if the
+    file is unknown."""
+    if not upload.sha256:
+        upload.sha256 = file_sha256(upload.file)
+    try:
+        return MapInfo.objects.get(sha256=upload.sha256)
+    except MapInfo.DoesNotExist:
+        pass
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # wl_map_info names the minimap like the map file
+        path = os.path.join(tmpdir, os.path.basename(upload.file.name))
+        with upload.file.storage.open(upload.file.name, 'rb') as source, \
+                open(path, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        return _store_map_info(upload.sha256, path)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _publish(upload, mapinfo):
+    info = mapinfo.info
+    if Map.objects.filter(name=info['name']).exists():
+        raise MapInfoError('A map with the same name already exists.')
+
+    map = Map(
+        name=info['name'],
+        author=info['author'],
+        w=info['width'],
+        h=info['height'],
+        nr_players=info['nr_players'],
+        descr=info['description'],
+        hint=info['hint'],
+        world_name=info['world_name'],
+        wl_version_after=info.get('needs_widelands_version_after'),
+        sha256=upload.sha256,
+        uploader=upload.uploader,
+        uploader_comment=upload.uploader_comment,
+    )
+    filename = os.path.basename(upload.file.name)
+    map.file.save(filename, upload.file, save=False)
+    map.minimap.save(filename + '.png', mapinfo.minimap, save=False)
+    try:
+        with transaction.atomic():
+            map.save()
+    except IntegrityError:
+        # Another upload with this name or slug was faster
+        map.file.delete(save=False)
+        map.minimap.delete(save=False)
+        raise MapInfoError('A map with the same name already exists.')
+    return map
+
+
+def process(upload):
+    """Publishes the map of the claimed upload."""
+    try:
+        upload.map = _publish(upload, get_map_info(upload))
+        upload.status = MapUpload.PUBLISHED
+    except MapInfoError as e:
+        upload.status = MapUpload.FAILED
+        upload.error = str(e)
+    except Exception:
+        logger.exception('Processing map upload %d failed', upload.pk)
+        upload.status = MapUpload.FAILED
+        upload.error = 'The map file could not be processed.'
+
+    upload.file.delete(save=False)
+    upload.save()
+    return upload
+
+
+def _work(worker=0):
+    """Process uploads until there are no pending ones left. Returns the
+    number of processed uploads."""
+    processed = 0
+    upload = claim()
+    while upload is not None:
+        process(upload)
+        processed += 1
+        upload = claim()
+    return processed
+
+
+def _work_in_thread(worker):
+    try:
+        return _work(worker)
+    finally:
+        # Each thread has its own database connection
+        connection.close()
+
+
+def process_pending():
+    """Process all pending uploads with MAPS_UPLOAD_WORKERS threads, which
+    limits the number of wl_map_info processes running at the same time.
+    Returns the number of processed uploads."""
+    workers = settings.MAPS_UPLOAD_WORKERS
+    if workers <= 1:
+        return _work()
+    with ThreadPoolExecutor(workers) as pool:
+        return sum(pool.map(_work_in_thread, range(workers)))
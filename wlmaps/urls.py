@@ -7,7 +7,10 @@ from .views import *
 
 urlpatterns = [
     url(r'^$', index, name='wlmaps_index'),
+    url(r'^catalogue/$', catalogue_json, name='wlmaps_catalogue'),
     url(r'^upload/$', upload, name='wlmaps_upload'),
+    url(r'^upload/(?P<upload_id>\d+)/$',
+        upload_status, name='wlmaps_upload_status'),
 
     url(r'^(?P<map_slug>[-\w]+)/$',
         view, name='wlmaps_view'),
@@ -2,44 +2,128 @@
 # encoding: utf-8
 #
 
-from .forms import UploadMapForm, EditCommentForm
+from .forms import UploadMapForm, EditCommentForm, MapFilterForm
 from django.shortcuts import render, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseRedirect, HttpResponseNotAllowed, HttpResponse, HttpResponseBadRequest
+from django.http import HttpResponseRedirect, HttpResponseNotAllowed, HttpResponse, HttpResponseBadRequest, \
+    JsonResponse
+from django.db.models import F
 from django.urls import reverse
 from django.conf import settings
-from . import models
+from . import catalogue, models
 
 from mainpage.wl_utils import get_real_ip
+from mainpage.protected_files import serve_file, is_complete_download
 import os
 
 
 #########
 # Views #
 #########
+def _facet_links(request, filters, facets):
+    """Returns (label, values, url to remove the filter) for each facet.
+    values are (label, number of maps, url to select, selected)."""
+    def url(name, value):
+        params = request.GET.copy()
+        params.pop('after', None)
+        params.pop(name, None)
+        if value is not None:
+            params[name] = value
+        return '?' + params.urlencode()
+
+    def label(name, value):
+        if name == 'world_name':
+            return 'One World' if value == catalogue.ONE_WORLD else value.title()
+        if name == 'size':
+            return str(value).title()
+        return value
+
+    links = []
+    for name, values in facets.items():
+        selected = filters.get(name)
+        links.append((
+            catalogue.FACETS[name],
+            [(label(name, value), count, url(name, value),
+              str(value) == str(selected)) for value, count in values],
+            url(name, None) if selected not in (None, '') else None))
+    return links
+
+
 def index(request):
-    maps = models.Map.objects.all()
+    form = MapFilterForm(request.GET)
+    # Invalid filters are ignored
+    filters = form.cleaned_data if form.is_valid() else {}
+    maps, next_cursor = catalogue.browse(filters, filters.get('after'))
+    count, facets = catalogue.get_facets(filters)
+
+    next_url = None
+    if next_cursor is not None:
+        params = request.GET.copy()
+        params['after'] = next_cursor
+        next_url = '?' + params.urlencode()
+    first_url = None
+    if filters.get('after'):
+        params = request.GET.copy()
+        del params['after']
+        first_url = '?' + params.urlencode()
+
     return render(request, 'wlmaps/index.html',
                               {'maps': maps,
-                               'maps_per_page': settings.MAPS_PER_PAGE,
+                               'count': count,
+                               'facets': _facet_links(request, filters, facets),
+                               'next_url': next_url,
+                               'first_url': first_url,
                                })
 
 
+def catalogue_json(request):
+    """The maps matching the filters as json, see wlmaps/catalogue.py."""
+    form = MapFilterForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    filters = form.cleaned_data
+    maps, next_cursor = catalogue.browse(filters, filters['after'])
+    count, facets = catalogue.get_facets(filters)
+    return JsonResponse({
+        'count': count,
+        'maps': [{
+            'name': map.name,
+            'slug': map.slug,
+            'url': request.build_absolute_uri(map.get_absolute_url()),
+            'download_url': request.build_absolute_uri(
+                reverse('wlmaps_download', args=[map.slug])),
+            'minimap_url': request.build_absolute_uri(map.minimap.url),
+            'author': map.author,
+            'w': map.w,
+            'h': map.h,
+            'nr_players': map.nr_players,
+            'world_name': map.world_name,
+            'wl_version_after': map.wl_version_after,
+            'uploader': map.uploader.username,
+            'pub_date': map.pub_date.isoformat(),
+            'nr_downloads': map.nr_downloads,
+        } for map in maps],
+        'next': next_cursor,
+        'facets': facets,
+    })
+
+
 def download(request, map_slug):
-    """Very simple view that just returns the binary data of this map and
-    increases the download count."""
-    m = get_object_or_404(models.Map, slug=map_slug)
+    """Send the file of this map and increase the download count.
 
-    file = open(m.file.path, 'rb')
-    data = file.read()
+    Requests for the remaining part of an interrupted download are not
+    counted.
+    """
+    m = get_object_or_404(models.Map, slug=map_slug)
     filename = os.path.basename('%s.wmf' % m.name)
 
-    # Remember that this has been downloaded
-    m.nr_downloads += 1
-    m.save(update_fields=['nr_downloads'])
+    response = serve_file(request, m.file.path, filename=filename)
 
-    response = HttpResponse(data, content_type='application/octet-stream')
-    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    if is_complete_download(request, response):
+        # Remember that this has been downloaded
+        models.Map.objects.filter(pk=m.pk).update(
+            nr_downloads=F('nr_downloads') + 1)
 
     return response
 
@@ -74,15 +158,27 @@ def edit_comment(request, map_slug):
 @login_required
 def upload(request):
     if request.method == 'POST':
-        form = UploadMapForm(request.POST, request.FILES)
+        form = UploadMapForm(request.POST, request.FILES,
+                             instance=models.MapUpload(uploader=request.user))
         if form.is_valid():
-            map = form.save(commit=False)
-            map.uploader = request.user
-            map.save()
-            return HttpResponseRedirect(map.get_absolute_url())
+            # The map is published by the upload workers
+            upload = form.save()
+            return HttpResponseRedirect(
+                reverse('wlmaps_upload_status', args=[upload.pk]))
     else:
         form = UploadMapForm()
 
     context = {'form': form, }
     return render(request, 'wlmaps/upload.html',
                               context)
+
+
+@login_required
+def upload_status(request, upload_id):
+    upload = get_object_or_404(
+        models.MapUpload, pk=upload_id, uploader=request.user)
+    if upload.status == models.MapUpload.PUBLISHED and upload.map:
+        return HttpResponseRedirect(upload.map.get_absolute_url())
+
+    return render(request, 'wlmaps/upload_status.html',
+                  {'upload': upload})
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db.models import Count
+
+from pybb.models import Post
+from wlprofile.models import Profile
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the denormalized number of public posts for all profiles'
+
+    def handle(self, *args, **kwargs):
+        counts = dict(Post.objects.public().order_by().values_list(
+            'user').annotate(count=Count('id')))
+        user_ids = list(counts.keys())
+
+        # Profiles are created on first access, make sure they exist
+        for user in User.objects.filter(pk__in=user_ids, wlprofile__isnull=True):
+            user.wlprofile
+
+        Profile.objects.exclude(user__in=user_ids).exclude(
+            nr_posts=0).update(nr_posts=0)
+        for profile in Profile.objects.filter(user__in=user_ids):
+            nr_posts = counts[profile.user_id]
+            if profile.nr_posts != nr_posts:
+                Profile.objects.filter(pk=profile.pk).update(nr_posts=nr_posts)
+
+        self.stdout.write('Updated post counts of {} users'.format(len(user_ids)))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def set_post_counts(apps, schema_editor):
+    """Same as './manage.py profile_update_post_counts'."""
+
+    Profile = apps.get_model('wlprofile', 'Profile')
+    Post = apps.get_model('pybb', 'Post')
+
+    # Like Post.objects.public()
+    counts = dict(Post.objects.filter(
+        topic__forum__category__internal=False, hidden=False,
+        topic__hidden=False).order_by().values_list('user').annotate(
+        count=Count('id')))
+
+    # Profiles are created on first access, make sure they exist
+    existing = set(Profile.objects.values_list('user_id', flat=True))
+    Profile.objects.bulk_create(
+        Profile(user_id=user_id) for user_id in counts
+        if user_id not in existing)
+
+    for user_id, nr_posts in counts.items():
+        Profile.objects.filter(user_id=user_id).update(nr_posts=nr_posts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wlprofile', '0002_profile_deleted'),
+        ('pybb', '0006_topic_hidden'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='nr_posts',
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name='Number of public posts'),
+        ),
+        migrations.RunPython(set_post_counts, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import signals, Q
 from django.contrib.auth.models import User
 from .fields import ExtendedImageField
 from mainpage.wl_utils import AutoOneToOneField
@@ -50,19 +51,28 @@ class Profile(models.Model):
         _('Show signatures'), blank=True, default=True)
     deleted = models.BooleanField(default=False)
 
+    # Denormalized number of public forum posts, kept up to date by the
+    # signal handlers below. Rebuild with './manage.py profile_update_post_counts'
+    nr_posts = models.PositiveIntegerField(
+        _('Number of public posts'), default=0, editable=False)
+
     class Meta:
         verbose_name = _('Profile')
         verbose_name_plural = _('Profiles')
 
     def post_count(self):
-        """Return the nr of posts the user has.
-
-        This uses djangos filter feature will therefore hit the
-        database. This should maybe be reworked when the database grows
-        to not be always calculated.
+        """Return the nr of public posts the user has.
 
+        The value is read from the denormalized field nr_posts and
+        therefore does not hit the database.
         """
-        return Post.objects.public().filter(user=self.user).count()
+        return self.nr_posts
+
+    def update_post_count(self):
+        """Recount the public posts of this user and store the result."""
+
+        self.nr_posts = Post.objects.public().filter(user=self.user).count()
+        Profile.objects.filter(pk=self.pk).update(nr_posts=self.nr_posts)
 
     def user_status(self):
         nump = self.post_count()
@@ -81,3 +91,32 @@ class Profile(models.Model):
             return {'text': 'Tribe Member', 'image': 'rang_6.png'}
         else:
             return {'text': 'One Elder of Players', 'image': 'rang_7.png'}
+
+
+def update_post_counts(sender, instance, created=False, **kwargs):
+    """Keep Profile.nr_posts in sync when a post is saved or deleted.
+
+    Post.save() tells whether the post got hidden or unhidden and whether
+    this changed the visibility of the whole topic, because it is the first
+    post. In the latter case all users who posted in the topic get
+    recounted. Otherwise only the author of the post is affected.
+    """
+
+    if kwargs['signal'] is signals.post_save and not created and \
+            not getattr(instance, '_hidden_changed', False):
+        # Only the content has changed, not the visibility
+        return
+
+    if getattr(instance, '_topic_hidden_changed', False):
+        users = User.objects.filter(
+            Q(posts__topic_id=instance.topic_id) |
+            Q(pk=instance.user_id)).distinct()
+    else:
+        users = User.objects.filter(pk=instance.user_id)
+
+    for user in users:
+        user.wlprofile.update_post_count()
+
+
+signals.post_save.connect(update_post_counts, sender=Post)
+signals.post_delete.connect(update_post_counts, sender=Post)
@@ -15,7 +15,6 @@ from django.urls import reverse
 from django.utils.safestring import mark_safe
 from django.template.defaultfilters import date as django_date
 from django.core.exceptions import ObjectDoesNotExist
-from django.contrib.auth.models import User
 import re
 from datetime import date as ddate, tzinfo, timedelta, datetime
 from django.conf import settings
@@ -134,7 +133,7 @@ def custom_date(date, user):
     if not user.is_authenticated:
         return do_custom_date(settings.DEFAULT_TIME_DISPLAY, date, float(settings.DEFAULT_TIME_ZONE))
     try:
-        userprofile = User.objects.get(username=user).wlprofile
+        userprofile = user.wlprofile
         return do_custom_date(userprofile.time_display, date, userprofile.time_zone)
     except ObjectDoesNotExist:
         return do_custom_date(settings.DEFAULT_TIME_DISPLAY, date, float(settings.DEFAULT_TIME_ZONE))
@@ -3,7 +3,16 @@
 import unittest
 import datetime
 
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.contrib.auth.models import User
+
 from .templatetags.custom_date import do_custom_date
+from .models import Profile
+from pybb.models import Post
+from pybb.tests.base import ForumTestCase
 
 
 class _CustomDate_Base(unittest.TestCase):
@@ -116,5 +125,62 @@ class TestCustomDate_FaultyDate_ExceptNoop(unittest.TestCase):
         rv = do_custom_date('%c', (93, 93), 0)
         self.assertEqual('%c', rv)
 
+##############
+# Post count #
+##############
+class TestProfile_PostCount(ForumTestCase):
+
+    def setUp(self):
+        super(TestProfile_PostCount, self).setUp()
+        self.other = User.objects.create(username='answerer')
+        self.topic = self._add_topic()
+        self.head = self.topic.head
+        self.answer = self._add_post(self.topic, user=self.other)
+
+    def _counts(self):
+        return (User.objects.get(pk=self.user.pk).wlprofile.post_count(),
+                User.objects.get(pk=self.other.pk).wlprofile.post_count())
+
+    def test_NewPosts_ExceptCounted(self):
+        self.assertEqual((1, 1), self._counts())
+
+    def test_HideAnswer_ExceptOnlyAuthorChanged(self):
+        self.answer.hidden = True
+        self.answer.save()
+        self.assertEqual((1, 0), self._counts())
+
+    def test_HideTopic_ExceptAllPostersChanged(self):
+        self.head.hidden = True
+        self.head.save(update_fields=['hidden'])
+        self.assertEqual((0, 0), self._counts())
+        self.head.hidden = False
+        self.head.save()
+        self.assertEqual((1, 1), self._counts())
+
+    def test_EditFirstPost_ExceptNoRecount(self):
+        head = Post.objects.get(pk=self.head.pk)
+        head.body = 'Hello again'
+        with mock.patch.object(Profile, 'update_post_count') as update:
+            head.save()
+        self.assertEqual(0, update.call_count)
+
+    def test_UnhideAnswer_ExceptOnlyAuthorRecounted(self):
+        self.answer.hidden = True
+        self.answer.save()
+        with mock.patch.object(Profile, 'update_post_count') as update:
+            self.answer.hidden = False
+            self.answer.save()
+        self.assertEqual(1, update.call_count)
+
+    def test_DeletePost_ExceptCountDecreased(self):
+        self.answer.delete()
+        self.assertEqual((1, 0), self._counts())
+
+    def test_RebuildCommand_ExceptCorrectResult(self):
+        Profile.objects.update(nr_posts=42)
+        call_command('profile_update_post_counts', stdout=StringIO())
+        self.assertEqual((1, 1), self._counts())
+
+
 if __name__ == '__main__':
     unittest.main()